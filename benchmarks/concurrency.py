@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Peak amount of jobs starting at the same minute on a node after a re-balance, for every placement.
+
+usage: python -m benchmarks.concurrency [amount of jobs] [amount of nodes]
+"""
+
+import logging
+import sys
+import time
+
+from dcron.cron.crontab import CronItem
+from dcron.protocols.messages import Status
+from dcron.scheduler import Scheduler
+from dcron.storage import Storage
+
+# a third of the jobs start at the top of the hour, a quarter every five minutes, the rest spread over the hour
+patterns = ['0 * * * *'] * 4 + ['*/5 * * * *'] * 3 + ['{0} * * * *', '{0} */2 * * *', '{0} 3 * * *', '{0} 0 * * 1-5', '* * * * *']
+
+
+def cluster(amount, nodes):
+    storage = Storage()
+    storage.cluster_status = [Status('10.0.{0}.{1}'.format(i // 250, i % 250), 0.5, 4) for i in range(nodes)]
+    for i in range(amount):
+        job = CronItem(command="/usr/local/bin/job-{0} --verbose".format(i))
+        job.set_all(patterns[i % len(patterns)].format(i % 60))
+        storage.cluster_jobs.append(job)
+    return storage
+
+
+def measure(amount, nodes, placement):
+    storage = cluster(amount, nodes)
+    scheduler = Scheduler(storage, 60, placement)
+    start = time.perf_counter()
+    storage.cluster_jobs.extend(scheduler.re_balance())
+    elapsed = time.perf_counter() - start
+    peaks = scheduler.peaks['after'].values()
+    print("{0:<8} {1:>4} nodes: peak starts per node max {2:>4} mean {3:>6.1f} min {4:>4}, re-balance in {5:>7.1f} ms".format(
+        placement, nodes, max(peaks), sum(peaks) / len(peaks), min(peaks), elapsed * 1000))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    counts = [int(sys.argv[2])] if len(sys.argv) > 2 else (5, 20, 50)
+    for placement in Scheduler.placements:
+        for nodes in counts:
+            measure(amount, nodes, placement)
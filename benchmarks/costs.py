@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Expected busy hours a day per node after a re-balance, for jobs whose running times differ wildly.
+
+usage: python -m benchmarks.costs [amount of jobs] [amount of nodes]
+"""
+
+import logging
+import random
+import sys
+import time
+
+from benchmarks.placement import cluster
+from dcron.scheduler import Scheduler
+
+
+def measure(amount, nodes, placement):
+    storage = cluster(amount, nodes)
+    generator = random.Random(1)
+    for job in storage.cluster_jobs:
+        # most jobs are short scripts, one in fifty an etl run of ten to forty minutes
+        job.cost.observe(generator.uniform(600, 2400) if generator.random() < 0.02 else generator.uniform(0.2, 5))
+    scheduler = Scheduler(storage, 60, placement)
+    start = time.perf_counter()
+    storage.cluster_jobs.extend(scheduler.re_balance())
+    elapsed = time.perf_counter() - start
+    jobs = list(storage.cluster_jobs)
+    busy = {}
+    for job, seconds in zip(jobs, scheduler.busy(jobs, scheduler.unknown_duration)):
+        busy[job.assigned_to] = busy.get(job.assigned_to, 0) + seconds
+    hours = [seconds / 3600 for seconds in busy.values()]
+    print("{0:<8} {1:>4} nodes: busy hours a day per node max {2:>6.1f} mean {3:>6.1f} min {4:>6.1f}, re-balance in {5:>7.1f} ms".format(
+        placement, nodes, max(hours), sum(hours) / len(hours), min(hours), elapsed * 1000))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    counts = [int(sys.argv[2])] if len(sys.argv) > 2 else (5, 20, 50)
+    for placement in Scheduler.placements:
+        for nodes in counts:
+            measure(amount, nodes, placement)
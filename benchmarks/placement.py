@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Jobs moved and time spent by a re-balance when a node joins or leaves the cluster, for every placement.
+
+usage: python -m benchmarks.placement [amount of jobs]
+"""
+
+import logging
+import sys
+import time
+
+from dcron.cron.crontab import CronItem
+from dcron.protocols.messages import Status
+from dcron.scheduler import Scheduler
+from dcron.storage import Storage
+
+
+def cluster(amount, nodes):
+    storage = Storage()
+    storage.cluster_status = [Status('10.0.{0}.{1}'.format(i // 250, i % 250), 0.5) for i in range(nodes)]
+    for i in range(amount):
+        job = CronItem(command="/usr/local/bin/job-{0} --verbose".format(i))
+        job.set_all("{0} * * * *".format(i % 60))
+        storage.cluster_jobs.append(job)
+    return storage
+
+
+def re_balance(scheduler):
+    start = time.perf_counter()
+    moved = scheduler.re_balance()
+    scheduler.storage.cluster_jobs.extend(moved)
+    return len(moved), time.perf_counter() - start
+
+
+def measure(amount, nodes, placement):
+    storage = cluster(amount, nodes)
+    scheduler = Scheduler(storage, 60, placement)
+    storage.cluster_jobs.extend(scheduler.re_balance())
+    # a node leaves
+    storage.node_state('10.0.0.0').time -= 120
+    left, left_time = re_balance(scheduler)
+    # and comes back
+    storage.cluster_status.append(Status('10.0.0.0', 0.5))
+    joined, joined_time = re_balance(scheduler)
+    print("{0:<8} {1:>4} nodes: leave moves {2:>5} jobs ({3:>5.1f}%) in {4:>6.1f} ms, join moves {5:>5} jobs ({6:>5.1f}%) in {7:>6.1f} ms".format(
+        placement, nodes, left, 100 * left / amount, left_time * 1000, joined, 100 * joined / amount, joined_time * 1000))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for placement in Scheduler.placements:
+        for nodes in (5, 20, 50, 100, 200):
+            measure(amount, nodes, placement)
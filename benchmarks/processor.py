@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Sustained packets per second of the processor, the latency it adds to the event loop and the time messages wait in
+the processor lanes, for a synthetic burst of status messages and rebroadcast jobs with some control messages.
+
+usage: python -m benchmarks.processor [amount of packets]
+"""
+
+import asyncio
+import sys
+import time
+
+from dcron.cron.crontab import CronTab, CronItem
+from dcron.processor import Processor
+from dcron.protocols.messages import Status, Toggle
+from dcron.protocols.udpserializer import UdpSerializer
+from dcron.storage import Storage
+
+
+class NullSender(object):
+
+    async def send(self, packets):
+        return 0
+
+    def stats(self):
+        return {}
+
+
+def burst(amount, nodes=50, unique=100, control=1000):
+    """
+    half status messages, half copies of jobs rebroadcast by every node, with a control message every so often
+    """
+    packets = []
+    jobs = [CronItem(command="/usr/local/bin/job-{0} --verbose".format(i)) for i in range(unique)]
+    for job in jobs:
+        job.assigned_to = '10.0.1.1'
+        job.update_version()
+    for i in range(amount // 2):
+        packets.extend(UdpSerializer.dump(Status('10.0.0.{0}'.format(i % nodes), 0.5)))
+        packets.extend(UdpSerializer.dump(jobs[i % len(jobs)]))
+        if i % control == 0:
+            packets.extend(UdpSerializer.dump(Toggle(jobs[i % len(jobs)])))
+    return jobs, packets
+
+
+async def ticker(interval, lateness):
+    """
+    measure how late the event loop wakes us up
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lateness.append(time.perf_counter() - start - interval)
+
+
+async def measure(jobs, packets, chunk=500):
+    processor = Processor(12345, Storage(), cron=CronTab(tab="* * * * * command"), sender=NullSender())
+    processor.storage.cluster_jobs.extend(jobs)
+    processor.start()
+    lateness = []
+    tick = asyncio.ensure_future(ticker(0.001, lateness))
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for i in range(0, len(packets), chunk):
+        # datagrams arrive in between event loop iterations
+        for packet in packets[i:i + chunk]:
+            processor.put_nowait(packet)
+        await asyncio.sleep(0)
+    while processor.pending():
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    tick.cancel()
+    await processor.stop()
+    lateness.sort()
+    print("{0} packets in {1:.2f} s, {2:.0f} packets/s".format(len(packets), elapsed, len(packets) / elapsed))
+    print("event loop lateness p50 {0:.1f} ms, p99 {1:.1f} ms, max {2:.1f} ms".format(
+        lateness[len(lateness) // 2] * 1000, lateness[len(lateness) * 99 // 100] * 1000, lateness[-1] * 1000))
+    for name, lane in processor.stats()['lanes'].items():
+        print("{0:<8} lane: {1:>6} messages, wait average {2:.1f} ms, max {3:.1f} ms, {4} dropped".format(
+            name, lane['served'], lane['wait']['average'] * 1000, lane['wait']['max'] * 1000, lane['dropped']))
+
+
+if __name__ == '__main__':
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    jobs, packets = burst(amount)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(measure(jobs, packets))
+    loop.close()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Compare the binary wire format against the legacy pickle format (and fixed size packets) for a full job sync.
+
+usage: python -m benchmarks.serializer [amount of jobs]
+"""
+
+import pickle
+import sys
+import timeit
+
+from math import ceil
+from uuid import uuid4
+
+from dcron.cron.crontab import CronTab, CronItem
+from dcron.protocols.messages import Status
+from dcron.protocols.packet import Packet
+from dcron.protocols.udpserializer import UdpSerializer
+
+
+def pickle_dump(obj):
+    buffer = pickle.dumps(obj)
+    total = ceil(len(buffer) / 980)
+    uuid = str(uuid4()).encode('utf-8')
+    return [Packet.legacy_format.pack(uuid, total, i, buffer[i * 980:(i + 1) * 980]) for i in range(total)]
+
+
+def pickle_load(packets):
+    return pickle.loads(b''.join(Packet.decode(p).data for p in packets))
+
+
+def schema_dump(obj):
+    return list(UdpSerializer.dump(obj))
+
+
+def schema_load(packets):
+    return UdpSerializer.load(packets)
+
+
+def jobs(amount, nodes=40):
+    """
+    jobs spread over a cluster, every node keeps the jobs assigned to it in its crontab
+    """
+    tabs = [CronTab(tab="* * * * * command") for _ in range(nodes)]
+    for i in range(amount):
+        tab = tabs[i % nodes]
+        job = CronItem(command="/usr/local/bin/job-{0} --verbose".format(i), user='root', cron=tab)
+        job.set_all('*/5 * * * *')
+        job.assigned_to = '10.0.0.{0}'.format(i % nodes)
+        job.append_log("Jan 01 00:00:00 localhost CRON[1234] exit code: 0, out: b'', err: b''")
+        tab.append(job)
+        yield job
+
+
+def measure(name, dump, load, messages):
+    encoded = [dump(m) for m in messages]
+    size = sum(len(p) for packets in encoded for p in packets)
+    count = sum(len(packets) for packets in encoded)
+    encode = min(timeit.repeat(lambda: [dump(m) for m in messages], number=1, repeat=3))
+    decode = min(timeit.repeat(lambda: [load(p) for p in encoded], number=1, repeat=3))
+    print("{0:<8} {1:>10} packets {2:>12} bytes {3:>10.1f} ms encode {4:>10.1f} ms decode".format(
+        name, count, size, encode * 1000, decode * 1000))
+
+
+if __name__ == '__main__':
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    messages = [Status('10.0.0.1', 0.5)] + list(jobs(amount))
+    print("full sync of {0} jobs and a status message".format(amount))
+    measure('pickle', pickle_dump, pickle_load, messages)
+    measure('schema', schema_dump, schema_load, messages)
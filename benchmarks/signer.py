@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Per packet verification throughput, for valid and forged packets.
+
+usage: python -m benchmarks.signer [amount of packets]
+"""
+
+import os
+import sys
+import timeit
+
+from uuid import uuid4
+
+from dcron.protocols.packet import Packet
+from dcron.protocols.signer import Signer
+
+
+def packets(amount, size):
+    signer = Signer('abracadabra')
+    uuid = uuid4().bytes
+    return [signer.sign(Packet(uuid, Packet.max_total, i % Packet.max_total, os.urandom(size)).encode()) for i in range(amount)]
+
+
+def measure(name, signer, data):
+    duration = min(timeit.repeat(lambda: [signer.verify(p) for p in data], number=1, repeat=3))
+    print("{0:<24} {1:>12.0f} packets/s".format(name, len(data) / duration))
+
+
+if __name__ == '__main__':
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    signer = Signer('abracadabra')
+    forger = Signer('hocus pocus')
+    for size in (64, Packet.data_size, 8900):
+        valid = packets(amount, size)
+        forged = [forger.sign(p[:-Packet.mac_size]) for p in valid]
+        measure("valid {0} bytes".format(size), signer, valid)
+        measure("forged {0} bytes".format(size), signer, forged)
@@ -24,7 +24,10 @@
 # SOFTWARE.
 
 import dcron.application
+import dcron.cost
+import dcron.database
 import dcron.processor
+import dcron.records
 import dcron.scheduler
 import dcron.site
 import dcron.storage
@@ -26,23 +26,22 @@
 import argparse
 import asyncio
 import logging
-import time
-
-from concurrent.futures.thread import ThreadPoolExecutor
-from datetime import datetime
 
 from aiohttp.web_runner import AppRunner, TCPSite
 
+from dcron.cost import RunObserver
 from dcron.cron.crontab import CronTab
-from dcron.datagram.client import client, broadcast
+from dcron.database import SqlStorage
+from dcron.datagram.client import Sender
 from dcron.datagram.server import StatusProtocolServer
 from dcron.processor import Processor
-from dcron.protocols.messages import ReBalance, Status
-from dcron.protocols.udpserializer import UdpSerializer
+from dcron.protocols import Packet
+from dcron.protocols.coalescer import Coalescer
+from dcron.protocols.messages import Reassign, Status
 from dcron.scheduler import Scheduler
 from dcron.site import Site
 from dcron.storage import Storage
-from dcron.utils import get_ip, get_ntp_offset, get_load, check_process
+from dcron.utils import get_ip, get_ntp_offset, get_load, get_cpus, get_rss, check_process, jitter
 
 log_format = "%(asctime)s [%(levelname)-8.8s] %(message)s"
 logging.basicConfig(level=logging.INFO, format=log_format)
@@ -57,6 +56,7 @@ def main():
 
     parser.add_argument('-l', '--log-file', default=None, help='path to store logfile')
     parser.add_argument('-p', '--storage-path', default=None, help='directory where to store cache')
+    parser.add_argument('-t', '--storage-type', choices=('json', 'sqlite'), default='json', help='store the cache in json files with a journal, or in an sqlite database (default: json)')
     parser.add_argument('-u', '--udp-communication-port', type=int, default=12345, help='communication port (default: 12345)')
     parser.add_argument('-i', '--broadcast-interval', type=int, default=5, help='interval for broadcasting data over UDP')
     parser.add_argument('-c', '--cron', default=None, help='crontab to use (default: /etc/crontab, use `memory` to not save to file')
@@ -64,6 +64,15 @@ def main():
     parser.add_argument('-w', '--web-port', type=int, default=8080, help='web hosting port (default: 8080)')
     parser.add_argument('-n', '--ntp-server', default='pool.ntp.org', help='NTP server to detect clock skew (default: pool.ntp.org)')
     parser.add_argument('-s', '--node-staleness', type=int, default=180, help='Time in seconds of non-communication for a node to be marked as stale (defailt: 180s)')
+    parser.add_argument('-a', '--placement', choices=Scheduler.placements, default='shuffle', help='how jobs are placed when re-balancing, hash only moves the jobs of nodes that joined or left, load balances the expected busy seconds of jobs over the spare cpus of nodes, spread keeps jobs starting at the same minute apart (default: shuffle)')
+    parser.add_argument('-r', '--send-rate', type=int, default=5000, help='maximum amount of UDP packets sent per second (default: 5000)')
+    parser.add_argument('-m', '--max-payload', type=int, default=Packet.data_size, help='maximum payload per UDP packet in bytes, use ~8900 for jumbo frames (default: {0})'.format(Packet.data_size))
+    parser.add_argument('-f', '--flush-window', type=float, default=5, help='milliseconds to wait for small messages to share a UDP packet, 0 only combines messages sent together (default: 5)')
+    parser.add_argument('-q', '--queue-size', type=int, default=10000, help='maximum amount of received UDP packets waiting to be processed (default: 10000)')
+    parser.add_argument('-e', '--shed-policy', choices=Processor.shed_policies, default='bulk', help='packets to drop when the queue is full, bulk keeps room for control messages (default: bulk)')
+    parser.add_argument('-b', '--receive-buffer', type=int, default=4 * 1024 * 1024, help='kernel receive buffer for our UDP socket in bytes (default: 4MiB)')
+    parser.add_argument('-j', '--commit-interval', type=float, default=1, help='seconds between fsyncs of the storage journal, changes in between can be lost on a crash (default: 1)')
+    parser.add_argument('--accept-legacy', action='store_true', default=False, help='accept messages of nodes running a pre-schema version, only for rolling upgrades')
     parser.add_argument('-x', '--hash-key', default='abracadabra', help="String to use for verifying UDP traffic (to disable use '')")
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose logging')
 
@@ -72,6 +81,10 @@ def main():
     if get_ntp_offset(args.ntp_server) > 60:
         exit("your clock is not in sync (check system NTP settings)")
 
+    if not 0 < args.max_payload <= Packet.max_data_size:
+        exit("maximum payload should be between 1 and {0} bytes".format(Packet.max_data_size))
+    Packet.data_size = args.max_payload
+
     root_logger = logging.getLogger()
     if args.log_file:
         file_handler = logging.FileHandler(args.log_file)
@@ -83,84 +96,88 @@ def main():
         root_logger.setLevel(logging.INFO)
         logging.getLogger('aiohttp').setLevel(logging.WARNING)
 
-    pool = ThreadPoolExecutor(4)
+    hash_key = None
+    if args.hash_key != '':
+        hash_key = args.hash_key
 
-    storage = Storage(args.storage_path)
+    if args.storage_type == 'sqlite':
+        storage = SqlStorage(args.storage_path)
+    else:
+        storage = Storage(args.storage_path)
+    sender = Sender(args.udp_communication_port, rate=args.send_rate)
+    coalescer = Coalescer(sender, hash_key, window=args.flush_window / 1000)
     if args.cron:
         if args.cron == 'memory':
-            processor = Processor(args.udp_communication_port, storage, cron=CronTab(tab="""* * * * * command"""))
+            processor = Processor(args.udp_communication_port, storage, cron=CronTab(tab="""* * * * * command"""), hash_key=hash_key, sender=sender, coalescer=coalescer, queue_size=args.queue_size, shed_policy=args.shed_policy, accept_legacy=args.accept_legacy)
         elif args.cron_user:
-            processor = Processor(args.udp_communication_port, storage, cron=CronTab(tabfile=args.cron, user=args.cron_user), user=args.cron_user)
+            processor = Processor(args.udp_communication_port, storage, cron=CronTab(tabfile=args.cron, user=args.cron_user), user=args.cron_user, hash_key=hash_key, sender=sender, coalescer=coalescer, queue_size=args.queue_size, shed_policy=args.shed_policy, accept_legacy=args.accept_legacy)
         else:
-            processor = Processor(args.udp_communication_port, storage, cron=CronTab(tabfile=args.cron, user='root'), user='root')
+            processor = Processor(args.udp_communication_port, storage, cron=CronTab(tabfile=args.cron, user='root'), user='root', hash_key=hash_key, sender=sender, coalescer=coalescer, queue_size=args.queue_size, shed_policy=args.shed_policy, accept_legacy=args.accept_legacy)
     else:
-        processor = Processor(args.udp_communication_port, storage, user='root')
+        processor = Processor(args.udp_communication_port, storage, user='root', hash_key=hash_key, sender=sender, coalescer=coalescer, queue_size=args.queue_size, shed_policy=args.shed_policy, accept_legacy=args.accept_legacy)
 
-    hash_key = None
-    if args.hash_key != '':
-        hash_key = args.hash_key
+    with StatusProtocolServer(processor, args.udp_communication_port, processor.signer, sender, args.receive_buffer, args.accept_legacy) as loop:
 
-    with StatusProtocolServer(processor, args.udp_communication_port) as loop:
+        scheduler = Scheduler(storage, args.node_staleness, args.placement)
+        observer = RunObserver()
 
-        running = True
-
-        scheduler = Scheduler(storage, args.node_staleness)
-
-        def timed_broadcast():
+        async def timed_broadcast():
             """
-            periodically broadcast system status and known jobs
+            periodically broadcast system status, the digest of known jobs and the jobs we changed,
+            peers with a different digest send each other what is missing. the processes of our jobs we see
+            between broadcasts give their running time and memory
             """
-            while running:
-                broadcast(args.udp_communication_port, UdpSerializer.dump(Status(get_ip(), get_load()), hash_key))
-                for job in storage.cluster_jobs:
-                    if job.assigned_to == get_ip():
-                        job.pid = check_process(job.command)
-                    for packet in UdpSerializer.dump(job, hash_key):
-                        client(args.udp_communication_port, packet)
-                time.sleep(args.broadcast_interval)
-
-        def timed_schedule():
+            while True:
+                ip = get_ip()
+                own_jobs = storage.cluster_jobs.assigned_to(ip)
+                pids = await loop.run_in_executor(None, lambda: [check_process(job.command) for job in own_jobs])
+                memory = await loop.run_in_executor(None, lambda: [get_rss(pid) if pid else None for pid in pids])
+                messages = [Status(ip, get_load(), get_cpus()), storage.cluster_jobs.digest(ip)]
+                observer.forget({job.identity for job in own_jobs})
+                for job, pid, rss in zip(own_jobs, pids, memory):
+                    # a job that ran since our last check carries its new cost
+                    if observer.check(job, pid, rss) or job.pid != pid:
+                        job.pid = pid
+                        job.update_version()
+                        storage.cluster_jobs.append(job)
+                        messages.append(job)
+                await coalescer.send(messages)
+                await asyncio.sleep(jitter(args.broadcast_interval))
+
+        async def timed_schedule():
             """
-            periodically check if cluster needs re-balancing
+            periodically check if jobs were left behind by nodes that left, and move only those
             """
-            while running:
-                time.sleep(23)
+            while True:
+                await asyncio.sleep(jitter(23))
                 if not scheduler.check_cluster_state():
-                    logger.info("re-balancing cluster")
-                    jobs = storage.cluster_jobs.copy()
-                    for packet in UdpSerializer.dump(ReBalance(timestamp=datetime.now()), hash_key):
-                        client(args.udp_communication_port, packet)
-                    time.sleep(5)
-                    for job in jobs:
-                        for packet in UdpSerializer.dump(job, hash_key):
-                            client(args.udp_communication_port, packet)
-
-        async def scheduled_broadcast():
-            await loop.run_in_executor(pool, timed_broadcast)
-
-        async def scheduled_rebalance():
-            await loop.run_in_executor(pool, timed_schedule)
+                    jobs = scheduler.fail_over(get_ip())
+                    if jobs:
+                        logger.info("reassigning {0} orphaned jobs".format(len(jobs)))
+                        await coalescer.send(Reassign.of(jobs))
 
         async def save_schedule():
             """
-            auto save every 100 seconds
+            group commit the journal, and compact it into a snapshot once it outgrows the previous one
             """
-            while running:
-                await asyncio.sleep(100)
-                await storage.save()
+            while True:
+                await asyncio.sleep(args.commit_interval)
+                await storage.commit()
+                if storage.needs_snapshot():
+                    await storage.save()
+
+        processor.start()
 
         logger.info("setting broadcast interval to {0} seconds".format(args.broadcast_interval))
-        loop.create_task(scheduled_broadcast())
-        loop.create_task(scheduled_rebalance())
-        if args.storage_path:
-            loop.create_task(save_schedule())
+        # also without a storage path, an sqlite storage in memory still commits and expires its history
+        tasks = [loop.create_task(timed_broadcast()), loop.create_task(timed_schedule()), loop.create_task(save_schedule())]
 
         logger.info("starting web application server on http://{0}:{1}/".format(get_ip(), args.web_port))
 
         if args.cron_user:
-            s = Site(scheduler, storage, args.udp_communication_port, cron=processor.cron, user=args.cron_user, hash_key=hash_key)
+            s = Site(scheduler, storage, args.udp_communication_port, cron=processor.cron, user=args.cron_user, hash_key=hash_key, processor=processor, sender=sender, coalescer=coalescer)
         else:
-            s = Site(scheduler, storage, args.udp_communication_port, cron=processor.cron, hash_key=hash_key)
+            s = Site(scheduler, storage, args.udp_communication_port, cron=processor.cron, hash_key=hash_key, processor=processor, sender=sender, coalescer=coalescer)
         runner = AppRunner(s.app)
         loop.run_until_complete(runner.setup())
         site_instance = TCPSite(runner, port=args.web_port)
@@ -174,15 +191,24 @@ def main():
         logger.info("stopping web application")
         loop.run_until_complete(site_instance.stop())
 
-        running = False
+        logger.debug("stopping background tasks")
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+        loop.run_until_complete(processor.stop())
+        loop.run_until_complete(coalescer.flush())
 
         if args.storage_path:
-            loop.create_task(storage.save())
+            loop.run_until_complete(storage.save())
+            storage.close()
 
         logger.debug("waiting for background tasks to finish")
-        pending_tasks = [task for task in asyncio.Task.all_tasks() if not task.done()]
+        pending_tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
         loop.run_until_complete(asyncio.gather(*pending_tasks))
 
+    sender.close()
+
     logger.info("elvis has left the building")
 
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import math
+import time
+
+
+class Cost(object):
+    """
+    Running time and peak memory of a job, estimated from the runs we observed. Keeps exponentially weighted moving
+    averages, so the estimate follows jobs that change, and the variance of the running time for its 95th percentile.
+    """
+
+    # weight of a new run in the moving averages
+    alpha = 0.2
+    # standard score of the 95th percentile, taking running times as roughly normal
+    z95 = 1.645
+
+    def __init__(self, runs=0, duration=None, variance=0.0, rss=None):
+        """
+        :param runs: amount of runs observed
+        :param duration: moving average of the seconds a run takes
+        :param variance: moving variance of the seconds a run takes
+        :param rss: moving average of the peak resident memory of a run in bytes
+        """
+        self.runs = runs
+        self.duration = duration
+        self.variance = variance
+        self.rss = rss
+
+    def observe(self, duration, rss=None):
+        """
+        take a run into our estimate
+        :param duration: seconds the run took
+        :param rss: peak resident memory of the run in bytes, None if unknown
+        """
+        if not self.runs:
+            self.duration = duration
+            self.variance = 0.0
+        else:
+            delta = duration - self.duration
+            self.duration += self.alpha * delta
+            self.variance = (1 - self.alpha) * (self.variance + self.alpha * delta * delta)
+        if rss is not None:
+            self.rss = rss if self.rss is None else int(self.rss + self.alpha * (rss - self.rss))
+        self.runs += 1
+
+    @property
+    def p95(self):
+        """
+        :return: seconds 95% of the runs take at most, None without runs
+        """
+        if not self.runs:
+            return None
+        return self.duration + self.z95 * math.sqrt(self.variance)
+
+    def fields(self):
+        """
+        :return: list of our fields, None without runs
+        """
+        if not self.runs:
+            return None
+        return [self.runs, self.duration, self.variance, self.rss]
+
+    def __eq__(self, other):
+        return isinstance(other, Cost) and self.fields() == other.fields()
+
+    def __repr__(self):
+        return "Cost(runs={0}, duration={1}, p95={2}, rss={3})".format(self.runs, self.duration, self.p95, self.rss)
+
+
+class RunObserver(object):
+    """
+    Follows the processes of our jobs between checks, a run starts when we first see a process of the job and ends
+    when it is gone. Running times are only as precise as the interval between checks, runs shorter than that are
+    mostly not seen at all.
+    """
+
+    def __init__(self):
+        # start and peak memory of the runs in progress by job identity
+        self.running = {}
+
+    def check(self, job, pid, rss=None, now=None):
+        """
+        :param job: CronItem we checked
+        :param pid: process id of the job, None if it is not running
+        :param rss: resident memory of the process and its children in bytes
+        :param now: monotonic time of the check
+        :return: True if a run ended and the cost of the job was updated
+        """
+        now = time.monotonic() if now is None else now
+        identity = job.identity
+        run = self.running.get(identity)
+        ended = False
+        if run and run[0] != pid:
+            del self.running[identity]
+            _, start, peak = run
+            job.cost.observe(now - start, peak)
+            ended = True
+        if pid:
+            if identity not in self.running:
+                self.running[identity] = [pid, now, rss]
+            elif rss is not None:
+                run = self.running[identity]
+                run[2] = rss if run[2] is None else max(run[2], rss)
+        return ended
+
+    def forget(self, keep):
+        """
+        stop following runs of jobs we no longer own
+        :param keep: identities of the jobs to keep following
+        """
+        for identity in [i for i in self.running if i not in keep]:
+            del self.running[identity]
@@ -28,6 +28,7 @@ import re
 
 from datetime import datetime, time, date
 
+from dcron.cost import Cost
 from dcron.cron.utils import items_regex, special_regex, S_INFO, SPECIALS, SPECIAL_IGNORE
 from dcron.cron.orderedvariablelist import OrderedVariableList
 
@@ -39,7 +40,10 @@ class CronItem(object):
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, command='', comment='', user=None, cron=None):
+    # jobs pickled by nodes running a pre-schema version carry no version
+    version = 0
+
+    def __init__(self, command='', comment='', user=None, cron=None, parts=None):
         self.cron = cron
         self.user = user
         self.valid = False
@@ -51,11 +55,13 @@ class CronItem(object):
         self.assigned_to = None
         self.pid = None
         self.remove = False
+        self.version = 0
+        self.cost = Cost()
         self.env = OrderedVariableList(job=self)
         self.marker = None
         self.pre_comment = False
         self._log = []
-        self.parts = CronDateTimeParts()
+        self.parts = CronDateTimeParts() if parts is None else parts
         self.set_comment(comment)
         if command:
             self.set_command(command)
@@ -135,6 +141,20 @@ class CronItem(object):
             self.valid = False
             self.enabled = False
 
+    @property
+    def identity(self):
+        """
+        Return a hashable identity of this job, the command and normalised schedule
+        """
+        return self.command, str(self.parts)
+
+    def update_version(self):
+        """
+        Mark this job as changed, versions are millisecond timestamps so changes made on different nodes are ordered
+        """
+        self.version = max(self.version + 1, int(datetime.now().timestamp() * 1000))
+        return self.version
+
     def enable(self, enabled=True):
         """
         Set if this cron job is enabled or not
@@ -214,6 +234,12 @@ class CronItem(object):
         """
         return self.parts.frequency_per_hour()
 
+    def firings(self, days=1):
+        """
+        Returns the minutes this item starts at in a day, or in a week from sunday midnight when days is 7
+        """
+        return self.parts.firings(days=days)
+
     def append_log(self, line):
         self._log.append(line)
 
@@ -307,7 +333,7 @@ class CronItem(object):
         return self.parts[key]
 
     def __eq__(self, other):
-        if other and (isinstance(other, CronItem)):
+        if isinstance(other, CronItem):
             return self.command == other.command and self.minute == other.minute and self.hour == other.hour and \
                    self.month == other.month and self.dow == other.dow and self.dom == other.dom
         return False
@@ -387,6 +413,16 @@ class CronDateTimeParts(list):
         for set_a, set_b in zip(self, parts):
             set_a.parse(set_b)
 
+    def copy(self):
+        """
+        Return a copy of these parts, without parsing them again
+        """
+        result = CronDateTimeParts.__new__(CronDateTimeParts)
+        list.__init__(result, [part.copy() for part in self])
+        result.special = self.special
+        result.is_valid = result.is_self_valid
+        return result
+
     @staticmethod
     def _parse_value(value):
         """
@@ -467,6 +503,20 @@ class CronDateTimeParts(list):
         """
         return len(self[0])
 
+    def firings(self, days=1):
+        """
+        Returns the minutes this item starts at in a day, or in a week from sunday midnight when days is 7.
+        Items restricted by day of month or month count on every day they could run on.
+        """
+        if self.special == '@reboot':
+            return frozenset()
+        minutes = [hour * 60 + minute for hour in self[1] for minute in self[0]]
+        if days == 1:
+            return frozenset(minutes)
+        # cron runs an item restricted on both day of month and day of week on either
+        weekdays = {day % 7 for day in self[4]} if str(self[2]) == '*' else range(7)
+        return frozenset(day * 1440 + minute for day in weekdays for minute in minutes)
+
     def __str__(self):
         parts = ' '.join([str(s) for s in self])
         if self.special:
@@ -509,6 +559,15 @@ class CronDateTimePart(object):
                     continue
                 self.parts.append(self.parse_value(part, sunday=0))
 
+    def copy(self):
+        """
+        Return a copy of this part, ranges are copied as they can be changed
+        """
+        result = CronDateTimePart.__new__(CronDateTimePart)
+        result.__dict__.update(self.__dict__)
+        result.parts = [part.copy(result) if isinstance(part, CronRange) else part for part in self.parts]
+        return result
+
     def __eq__(self, value):
         return str(self) == str(value)
 
@@ -759,6 +818,15 @@ class CronRange(object):
         else:
             raise ValueError('Unknown cron range value "%s"' % value)
 
+    def copy(self, vpart):
+        """
+        Return a copy of this range for another part
+        """
+        result = CronRange.__new__(CronRange)
+        result.__dict__.update(self.__dict__)
+        result.part = vpart
+        return result
+
     def all(self):
         """
         Set this part to all units between the minimum and maximum
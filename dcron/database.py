@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import math
+import sqlite3
+import time
+
+from datetime import datetime
+from os.path import join
+
+from dcron.cron.cronitem import CronItem, CronDateTimeParts
+from dcron.cron.crontab import CronTab
+from dcron.protocols.messages import Digest, Status
+from dcron.records import RecordSerializer
+from dcron.storage import DigestStore, Storage, epoch
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crontabs (
+    id INTEGER PRIMARY KEY,
+    row TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    command TEXT NOT NULL,
+    schedule TEXT NOT NULL,
+    comment TEXT,
+    user TEXT,
+    enabled INTEGER NOT NULL,
+    last_run REAL,
+    pid INTEGER,
+    assigned_to TEXT,
+    version INTEGER NOT NULL,
+    crontab INTEGER REFERENCES crontabs (id),
+    logged INTEGER NOT NULL DEFAULT 0,
+    runs INTEGER NOT NULL DEFAULT 0,
+    duration REAL,
+    variance REAL,
+    rss INTEGER,
+    PRIMARY KEY (command, schedule)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (assigned_to);
+CREATE TABLE IF NOT EXISTS executions (
+    command TEXT NOT NULL,
+    schedule TEXT NOT NULL,
+    time REAL NOT NULL,
+    line TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS executions_job ON executions (command, schedule, time);
+CREATE TABLE IF NOT EXISTS status (
+    ip TEXT NOT NULL,
+    time REAL NOT NULL,
+    state TEXT,
+    load REAL,
+    cpus INTEGER
+);
+CREATE INDEX IF NOT EXISTS status_node ON status (ip, time);
+"""
+
+
+class SqlJobStore(DigestStore):
+    """
+    Jobs of the cluster in a table keyed by their identity, with an index by the node they are assigned to and the
+    log of every job in a table of executions. Jobs are decoded when they are read, so a changed job has to be
+    appended again, just like for the JobStore. Our digest is kept in memory, so peers comparing digests does not
+    decode the table.
+    """
+
+    _select = "SELECT command, schedule, comment, user, enabled, last_run, pid, assigned_to, version, crontab, " \
+              "runs, duration, variance, rss, (SELECT json_group_array(line) FROM (SELECT line FROM executions e " \
+              "WHERE e.command = j.command AND e.schedule = j.schedule ORDER BY e.time, e.rowid)) FROM jobs j"
+
+    def __init__(self, connection):
+        """
+        :param connection: sqlite3 connection with our schema
+        """
+        super(SqlJobStore, self).__init__()
+        self.connection = connection
+        self._crontabs = {}
+        self._crontab_ids = {}
+        # parsed schedules, every job gets a copy
+        self._schedules = {}
+        for command, schedule, version in connection.execute("SELECT command, schedule, version FROM jobs"):
+            self._digest.add((command, schedule), *Digest.hash((command, schedule), version))
+
+    def _crontab_id(self, cron):
+        if cron is None:
+            return None
+        row = json.dumps([cron._user, cron.in_tab, cron._tabfile, cron._log])
+        crontab = self._crontab_ids.get(row)
+        if crontab is None:
+            found = self.connection.execute("SELECT id FROM crontabs WHERE row = ?", (row,)).fetchone()
+            if found:
+                crontab = found[0]
+            else:
+                crontab = self.connection.execute("INSERT INTO crontabs (row) VALUES (?)", (row,)).lastrowid
+            self._crontab_ids[row] = crontab
+            self._crontabs.setdefault(crontab, cron)
+        return crontab
+
+    def _crontab(self, crontab):
+        if crontab is None:
+            return None
+        cron = self._crontabs.get(crontab)
+        if cron is None:
+            row = self.connection.execute("SELECT row FROM crontabs WHERE id = ?", (crontab,)).fetchone()[0]
+            user, tab, tabfile, log = json.loads(row)
+            cron = self._crontabs[crontab] = CronTab(user=user, tab=tab, tabfile=tabfile, log=log)
+            self._crontab_ids[row] = crontab
+        return cron
+
+    def _job(self, row):
+        command, schedule, comment, user, enabled, last_run, pid, assigned_to, version, crontab = row[:10]
+        cost, log = row[10:14], row[14]
+        parts = self._schedules.get(schedule)
+        if parts is None:
+            parts = self._schedules[schedule] = CronDateTimeParts(schedule)
+        return RecordSerializer.load_job(command, comment, user, bool(enabled), last_run, pid, assigned_to, version,
+                                         json.loads(log), self._crontab(crontab), parts.copy(),
+                                         cost if cost[0] else None)
+
+    def _query(self, where='', parameters=()):
+        return [self._job(row) for row in self.connection.execute("{0} {1}".format(self._select, where), parameters)]
+
+    def _find(self, identity):
+        jobs = self._query("WHERE command = ? AND schedule = ?", identity)
+        return jobs[0] if jobs else None
+
+    def get(self, job, default=None):
+        """
+        :param job: CronItem with the identity to look for
+        :return: the stored job with the same identity
+        """
+        found = self._find(job.identity)
+        return default if found is None else found
+
+    def append(self, job, identity=None):
+        """
+        store a job, replacing the stored job with the same identity, log lines we did not store yet are added to
+        the executions of the job
+        :param job: CronItem
+        :param identity: identity of the job, if it is known already
+        """
+        command, schedule = job.identity if identity is None else identity
+        self._tombstones.discard((command, schedule))
+        self._digest.add((command, schedule), *Digest.hash((command, schedule), job.version))
+        found = self.connection.execute("SELECT logged FROM jobs WHERE command = ? AND schedule = ?", (command, schedule)).fetchone()
+        logged = found[0] if found else 0
+        if len(job._log) < logged:
+            self.connection.execute("DELETE FROM executions WHERE command = ? AND schedule = ?", (command, schedule))
+            logged = 0
+        now = time.time()
+        self.connection.executemany("INSERT INTO executions (command, schedule, time, line) VALUES (?, ?, ?, ?)",
+                                    [(command, schedule, now, line) for line in job._log[logged:]])
+        last_run = job.last_run.timestamp() if isinstance(job.last_run, datetime) else None
+        self.connection.execute("INSERT OR REPLACE INTO jobs (command, schedule, comment, user, enabled, last_run, pid, "
+                                "assigned_to, version, crontab, logged, runs, duration, variance, rss) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (command, schedule, job.comment, job.user, bool(job.enabled), last_run, job.pid,
+                                 job.assigned_to, job.version, self._crontab_id(job.cron), len(job._log),
+                                 job.cost.runs, job.cost.duration, job.cost.variance, job.cost.rss))
+
+    def extend(self, jobs):
+        for job in jobs:
+            self.append(job)
+
+    def remove(self, job):
+        """
+        remove the stored job with the same identity and its executions, and keep a tombstone of it
+        :param job: CronItem
+        :raises ValueError: when there is no such job
+        """
+        identity = job.identity
+        found = self.connection.execute("SELECT version FROM jobs WHERE command = ? AND schedule = ?", identity).fetchone()
+        if not found:
+            raise ValueError("{0} not in job store".format(job))
+        self.connection.execute("DELETE FROM jobs WHERE command = ? AND schedule = ?", identity)
+        self.connection.execute("DELETE FROM executions WHERE command = ? AND schedule = ?", identity)
+        self._entomb(identity, job, found[0])
+
+    def clear(self):
+        self.connection.execute("DELETE FROM jobs")
+        self.connection.execute("DELETE FROM executions")
+        self._reset_digest()
+
+    def copy(self):
+        """
+        :return: list of our jobs
+        """
+        return self._query()
+
+    def assigned_to(self, node):
+        """
+        :param node: ip of the node, None for unassigned jobs
+        :return: list of the jobs assigned to the node
+        """
+        return self._query("WHERE assigned_to IS ?", (node,))
+
+    def nodes(self):
+        """
+        :return: the nodes jobs are assigned to, None for unassigned jobs
+        """
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT assigned_to FROM jobs")]
+
+    def enabled(self, state=True):
+        """
+        :param state: enabled state to look for
+        :return: list of the jobs with the given enabled state
+        """
+        return self._query("WHERE enabled = ?", (bool(state),))
+
+    def ordered(self):
+        """
+        :return: list of our jobs sorted by command and the node they are assigned to
+        """
+        return self._query("ORDER BY command, COALESCE(assigned_to, '*')")
+
+    def __contains__(self, job):
+        return isinstance(job, CronItem) and self.connection.execute("SELECT 1 FROM jobs WHERE command = ? AND schedule = ?", job.identity).fetchone() is not None
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self):
+        return self.connection.execute("SELECT count(*) FROM jobs").fetchone()[0]
+
+    def __getitem__(self, index):
+        return self.copy()[index]
+
+
+class SqlStatusStore(object):
+    """
+    Status history of the cluster in a table keyed by node and time, with the latest state of every node at hand.
+    Load history is aggregated by the database at the resolution a time range needs.
+    """
+
+    def __init__(self, connection):
+        """
+        :param connection: sqlite3 connection with our schema
+        """
+        self.connection = connection
+        self._latest = {}
+        # sqlite takes the other columns from the row with the maximum
+        for ip, state, load, cpus, latest in connection.execute("SELECT ip, state, load, cpus, max(time) FROM status GROUP BY ip"):
+            self._latest[ip] = self._status(ip, latest, state, load, cpus)
+        self._count = connection.execute("SELECT count(*) FROM status").fetchone()[0]
+
+    @staticmethod
+    def _status(ip, timestamp, state, load, cpus):
+        status = Status(ip, load, cpus)
+        status.state = state
+        status.time = timestamp
+        return status
+
+    def append(self, status, rollup=True):
+        """
+        :param status: Status message
+        :param rollup: unused, the database aggregates history when it is asked for
+        """
+        if not isinstance(status.time, float):
+            status.time = epoch(status.time)
+        self.connection.execute("INSERT INTO status (ip, time, state, load, cpus) VALUES (?, ?, ?, ?, ?)", (status.ip, status.time, status.state, status.system_load, status.cpus))
+        self._count += 1
+        latest = self._latest.get(status.ip)
+        if latest is None or status.time >= latest.time:
+            self._latest[status.ip] = status
+
+    def extend(self, statuses, rollup=True):
+        for status in statuses:
+            self.append(status, rollup)
+
+    def latest(self, ip):
+        """
+        :param ip: ip of the node
+        :return: the most recent Status message of the node, None if unknown
+        """
+        return self._latest.get(ip)
+
+    def nodes(self):
+        """
+        :return: ips of the nodes we know
+        """
+        return list(self._latest.keys())
+
+    def history(self, ip):
+        """
+        :param ip: ip of the node
+        :return: list of (time, load) tuples we kept for the node, oldest first
+        """
+        return [(t, float('nan') if load is None else load) for t, load in self.connection.execute("SELECT time, load FROM status WHERE ip = ? ORDER BY time", (ip,))]
+
+    def load_average(self, ip, window=900):
+        """
+        recent load of a node, a single busy heartbeat does not make a busy node
+        :param ip: ip of the node
+        :param window: seconds before the latest heartbeat of the node to average over
+        :return: average load, None if unknown
+        """
+        latest = self._latest.get(ip)
+        if latest is None:
+            return None
+        return self.connection.execute("SELECT avg(load) FROM status WHERE ip = ? AND time >= ? AND load IS NOT NULL", (ip, latest.time - window)).fetchone()[0]
+
+    def series(self, ip, start=None, end=None, max_points=1000):
+        """
+        load history of a node, at a resolution that fits the time range
+        :param ip: ip of the node
+        :param start: start of the range in seconds since epoch (default: an hour before end)
+        :param end: end of the range in seconds since epoch (default: now)
+        :param max_points: maximum amount of points to return
+        :return: dictionary with resolution in seconds (0 for heartbeats) and list of [time, min, avg, max] points
+        """
+        end = datetime.now().timestamp() if end is None else end
+        start = end - 3600 if start is None else start
+        if ip not in self._latest:
+            return None
+        query = "FROM status WHERE ip = ? AND time BETWEEN ? AND ? AND load IS NOT NULL"
+        if self.connection.execute("SELECT count(*) {0}".format(query), (ip, start, end)).fetchone()[0] <= max_points:
+            points = [[t, load, load, load] for t, load in self.connection.execute("SELECT time, load {0} ORDER BY time".format(query), (ip, start, end))]
+            return {'resolution': 0, 'points': points}
+        for width in (60, 3600):
+            if (end - start) / width <= max_points:
+                break
+        else:
+            width = 3600 * math.ceil((end - start) / 3600 / max_points)
+        points = self.connection.execute("SELECT CAST(time / ? AS INTEGER) * ? AS bucket, min(load), avg(load), max(load) {0} "
+                                         "GROUP BY bucket ORDER BY bucket".format(query), (width, width, ip, start, end))
+        return {'resolution': width, 'points': [list(point) for point in points]}
+
+    def expire(self, before):
+        """
+        forget the history before a point in time, and the nodes we did not hear of since
+        :param before: seconds since epoch
+        """
+        self._count -= self.connection.execute("DELETE FROM status WHERE time < ?", (before,)).rowcount
+        for ip in [ip for ip, status in self._latest.items() if status.time < before]:
+            del self._latest[ip]
+
+    def clear(self):
+        self.connection.execute("DELETE FROM status")
+        self._latest.clear()
+        self._count = 0
+
+    def copy(self):
+        """
+        :return: list of the Status messages we kept
+        """
+        return [self._status(*row) for row in self.connection.execute("SELECT ip, time, state, load, cpus FROM status ORDER BY ip, time")]
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self):
+        return self._count
+
+
+class SqlStorage(Storage):
+    """
+    Storage in an sqlite database in WAL mode, for installations with more jobs and history than we want to keep
+    in memory. Changes are made durable in groups by commit, like the journal of our file storage.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    # seconds between housekeeping of the database
+    checkpoint_interval = 100
+
+    def __init__(self, path_prefix=None, retention=1008 * 3600):
+        """
+        :param path_prefix: directory of our database, None keeps it in memory
+        :param retention: seconds of status history to keep (default: six weeks)
+        """
+        self.path_prefix = path_prefix
+        self.retention = retention
+        self.journal = None
+        self.snapshot_size = 0
+        self._lock = None
+        self.path = join(path_prefix, 'cluster.sqlite') if path_prefix else ':memory:'
+        self.logger.debug("opening database {0}".format(self.path))
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # in WAL mode a commit does not wait for an fsync, a crash can only lose the last commits
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        self._cluster_status = SqlStatusStore(self.connection)
+        self._cluster_jobs = SqlJobStore(self.connection)
+        self._checkpoint = time.monotonic()
+
+    async def commit(self):
+        """
+        make the changes since the last commit durable
+        """
+        self.connection.commit()
+
+    def needs_snapshot(self):
+        """
+        :return: True if it is time for housekeeping of the database
+        """
+        return time.monotonic() - self._checkpoint > self.checkpoint_interval
+
+    async def save(self):
+        """
+        commit, expire old history and checkpoint the write-ahead log into the database
+        """
+        self.logger.debug("auto-save")
+        self._cluster_status.expire(time.time() - self.retention)
+        self.connection.commit()
+        self.connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        self._checkpoint = time.monotonic()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
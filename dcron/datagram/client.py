@@ -23,39 +23,121 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
 import logging
 import socket
+import time
 
 
-def client(port, data):
+class Sender(object):
     """
-    broadcast UDP data
-    :param port: port to broadcast to
-    :param data: udp packet to send
+    Long lived UDP broadcast sender
     """
-    logger = logging.getLogger('udp_client')
 
-    addr = ('255.255.255.255', port)
+    logger = logging.getLogger(__name__)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+    # shortest pause between bursts, shorter waits are accumulated to spare event loop wake-ups
+    granularity = 0.01
 
-        if hasattr(socket, 'SO_BROADCAST'):
-            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    def __init__(self, port, rate=None, burst=None, address='255.255.255.255'):
+        """
+        our UDP broadcast sender, uses the datagram transport of our event loop once attached
+        :param port: port to broadcast to
+        :param rate: maximum amount of packets per second (default: unlimited)
+        :param burst: amount of packets that may be sent back to back (default: a tenth of the rate)
+        :param address: address to send to
+        """
+        self.address = (address, port)
+        self.rate = rate
+        self.burst = burst or (max(1, rate // 10) if rate else None)
+        self.sent = 0
+        self.failed = 0
+        self.transport = None
+        self._socket = None
+        self._tokens = self.burst
+        self._last = time.monotonic()
 
+    def attach(self, transport):
+        """
+        send through a datagram transport (with broadcasting allowed) instead of our own socket
+        :param transport: asyncio DatagramTransport
+        """
+        self.transport = transport
+
+    def detach(self):
+        self.transport = None
+
+    @property
+    def socket(self):
+        if not self._socket:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+            if hasattr(socket, 'SO_BROADCAST'):
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        return self._socket
+
+    def _delay(self):
+        """
+        token bucket
+        :return: seconds to wait before we are allowed to send the next packet
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            return -self._tokens / self.rate
+        return 0
+
+    def _send(self, packet):
         try:
-            if udp_socket.sendto(data, addr):
-                logger.debug("sent data {0} to port {1}".format(data, port))
-            else:
-                logger.warning("failed to send data to port {0}".format(port))
+            if self.transport and not self.transport.is_closing():
+                self.transport.sendto(packet, self.address)
+            elif not self.socket.sendto(packet, self.address):
+                self.logger.warning("failed to send data to port {0}".format(self.address[1]))
+                return False
+            return True
         except OSError as e:
-            logger.error("failure sending UDP data: {0}".format(e))
+            self.logger.error("failure sending UDP data: {0}".format(e))
+            return False
 
+    async def send(self, packets):
+        """
+        broadcast a bunch of packets
+        :param packets: packets to send
+        :return: amount of packets sent
+        """
+        sent = 0
+        for packet in packets:
+            if self.rate:
+                delay = self._delay()
+                if delay >= self.granularity:
+                    await asyncio.sleep(delay)
+            if self._send(packet):
+                sent += 1
+            else:
+                self.failed += 1
+        self.sent += sent
+        self.logger.debug("sent {0} packets to port {1}".format(sent, self.address[1]))
+        return sent
 
-def broadcast(udp_port, packets):
-    """
-    broadcast a bunch of packets to a UDP port
-    :param udp_port: port to broadcast to
-    :param packets: packets to send
-    """
-    for packet in packets:
-        client(udp_port, packet)
+    def stats(self):
+        """
+        :return: dictionary with counters of the sender
+        """
+        return {
+            'sent': self.sent,
+            'failed': self.failed
+        }
+
+    def close(self):
+        self.detach()
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
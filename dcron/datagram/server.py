@@ -26,9 +26,12 @@
 import logging
 import asyncio
 import selectors
+import socket
 
 from asyncio import DatagramProtocol
 
+from dcron.protocols.packet import Packet
+
 
 class StatusProtocol(DatagramProtocol):
     """
@@ -37,23 +40,58 @@ class StatusProtocol(DatagramProtocol):
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, queue):
+    def __init__(self, queue, signer=None, sender=None, receive_buffer=None, accept_legacy=False):
         self.logger.debug("initializing transport")
         self.queue = queue
+        self.signer = signer
+        self.sender = sender
+        self.receive_buffer = receive_buffer
+        self.accept_legacy = accept_legacy
 
     def connection_made(self, transport):
         self.logger.debug("connection made for server socket")
         self.transport = transport
+        if self.receive_buffer:
+            self.set_receive_buffer(transport.get_extra_info('socket'), self.receive_buffer)
+        if self.sender:
+            self.sender.attach(transport)
 
     def datagram_received(self, data, addr):
+        # legacy packets are verified once their message is reassembled
+        if self.signer and not (self.accept_legacy and Packet.is_legacy(data)) and not self.signer.verify(data):
+            self.logger.debug("dropping unsigned or forged data from {0}".format(addr))
+            return
         self.logger.debug("data received from {0}, emitting to queue".format(addr))
-        self.queue.put_nowait(data)
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.logger.debug("queue is full, dropping data from {0}".format(addr))
+
+    def set_receive_buffer(self, sock, size):
+        """
+        enlarge the kernel receive buffer of our socket, so bursts are queued instead of dropped by the kernel
+        :param sock: our socket
+        :param size: requested size in bytes
+        """
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+            actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        except OSError as e:
+            self.logger.warning("could not set receive buffer to {0} bytes: {1}".format(size, e))
+            return
+        # linux doubles the requested size for its bookkeeping, and caps it at net.core.rmem_max
+        if actual < size:
+            self.logger.warning("receive buffer is {0} bytes instead of {1}, raise net.core.rmem_max to allow it".format(actual, size))
+        else:
+            self.logger.debug("receive buffer set to {0} bytes".format(actual))
 
     def error_received(self, exc):
         self.logger.error("error received: {0}".format(exc))
 
     def connection_lost(self, exc):
         self.logger.debug("connection closed ({0})".format(exc))
+        if self.sender:
+            self.sender.detach()
 
 
 class StatusProtocolServer(object):
@@ -64,13 +102,21 @@ class StatusProtocolServer(object):
     logger = logging.getLogger(__name__)
     _udp_server_task = None
 
-    def __init__(self, buffer, port):
+    def __init__(self, buffer, port, signer=None, sender=None, receive_buffer=None, accept_legacy=False):
         """
         our UDP server socket
         :param buffer: class with put_nowait (ex. processor or asyncio queue) to emit packets to
         :param port: broadcast port to listen on
+        :param signer: Signer to verify packets with before emitting them
+        :param sender: Sender to broadcast through our socket
+        :param receive_buffer: size of the kernel receive buffer of our socket in bytes (default: system default)
+        :param accept_legacy: let packets of pre-schema nodes through, their messages are verified once reassembled
         """
         self.port = port
+        self.signer = signer
+        self.sender = sender
+        self.receive_buffer = receive_buffer
+        self.accept_legacy = accept_legacy
         self.logger.debug("initializing event loop")
         selector = selectors.SelectSelector()
         self.loop = asyncio.SelectorEventLoop(selector)
@@ -79,7 +125,7 @@ class StatusProtocolServer(object):
 
     def __init_transport__(self, buffer):
         return self.loop.create_datagram_endpoint(
-            lambda: StatusProtocol(buffer), local_addr=('0.0.0.0', self.port)
+            lambda: StatusProtocol(buffer, self.signer, self.sender, self.receive_buffer, self.accept_legacy), local_addr=('0.0.0.0', self.port), allow_broadcast=True
         )
 
     def __enter__(self):
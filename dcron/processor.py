@@ -24,16 +24,24 @@
 # SOFTWARE.
 
 import asyncio
+import hashlib
 import logging
-import subprocess
+import random
+import struct
+import time
 from datetime import datetime
 
 from dcron.cron.crontab import CronTab, CronItem
-from dcron.datagram.client import broadcast
-from dcron.protocols import Packet, group
-from dcron.protocols.messages import Kill, ReBalance, Run, Status, Toggle
+from dcron.datagram.client import Sender
+from dcron.protocols import Packet, schema
+from dcron.protocols.coalescer import Coalescer
+from dcron.protocols.dedup import RecentlySeen
+from dcron.protocols.lanes import Lane
+from dcron.protocols.messages import Batch, Digest, Kill, ReBalance, Reassign, Run, Status, Toggle
+from dcron.protocols.reassembly import ReassemblyBuffer
+from dcron.protocols.signer import Signer
 from dcron.protocols.udpserializer import UdpSerializer
-from dcron.utils import get_ip, check_process, kill_proc_tree
+from dcron.utils import get_ip, get_udp_drops, check_process, execute, kill_proc_tree
 
 
 class Processor(object):
@@ -43,9 +51,40 @@ class Processor(object):
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, udp_port, storage, cron=None, user=None, hash_key=None):
-        self.queue = asyncio.Queue()
-        self._buffer = []
+    # maximum seconds to wait before answering a digest, peers that answer first suppress our answer
+    resend_delay = 1
+    # maximum amount of packets handled before giving other tasks a turn
+    batch_size = 64
+    # seconds between clean ups of our buffers and storage
+    housekeeping_interval = 5
+    # maximum amount of messages waiting in the bulk lane, the oldest are dropped when it is full
+    bulk_size = 10000
+    # seconds removed jobs are remembered, well over the time it takes to declare a node stale
+    tombstone_ttl = 3600
+    # messages that are handled before any job sync
+    _control_tags = {schema.tag_of(t) for t in (Kill, Run, Toggle, ReBalance, Reassign)}
+    _re_balance_tag = schema.tag_of(ReBalance)
+    # what to drop when our ingress queue is full: bulk traffic and duplicates first, the oldest or the newest packets
+    shed_policies = ('bulk', 'oldest', 'newest')
+    # share of the ingress queue bulk traffic may use with the bulk policy
+    bulk_share = 0.8
+    # bytes of partial legacy messages we hold, pre-schema nodes only send messages of a few packets
+    legacy_budget = 256 * 1024
+
+    def __init__(self, udp_port, storage, cron=None, user=None, hash_key=None, sender=None, coalescer=None, queue_size=10000, shed_policy='bulk', accept_legacy=False):
+        if shed_policy not in self.shed_policies:
+            raise ValueError("unknown shed policy {0}, use one of {1}".format(shed_policy, ', '.join(self.shed_policies)))
+        self.queue = asyncio.Queue(queue_size)
+        self.shed_policy = shed_policy
+        # the bulk policy keeps room for control messages
+        self._shed_threshold = int(queue_size * self.bulk_share) if shed_policy == 'bulk' else queue_size
+        self.accepted = 0
+        self.shed = {}
+        self._buffer = ReassemblyBuffer()
+        # legacy packets are not signed, their messages are kept apart so they can not complete a signed message.
+        # only needed during a rolling upgrade from a pre-schema version
+        self.accept_legacy = accept_legacy
+        self._legacy = ReassemblyBuffer(budget=self.legacy_budget)
         self.udp_port = udp_port
         self.storage = storage
         if not cron:
@@ -54,6 +93,59 @@ class Processor(object):
             self.cron = cron
         self.user = user
         self.hash_key = hash_key
+        self.signer = Signer.for_key(hash_key)
+        self.sender = sender or Sender(udp_port)
+        self.coalescer = coalescer or Coalescer(self.sender, hash_key)
+        self._pending = {}
+        self._resend = None
+        # every node rebroadcasts, so most messages we receive are copies of messages we already applied
+        self._seen_ids = RecentlySeen()
+        self._seen_jobs = RecentlySeen()
+        # control messages that span several packets, only their first packet carries the tag
+        self._control_ids = RecentlySeen(1024)
+        self._control = Lane('control')
+        self._bulk = Lane('bulk', self.bulk_size, on_drop=self.forget)
+        self._sequence = 0
+        self._tasks = []
+        self._runs = set()
+        self.processed = 0
+        self.batches = 0
+
+    def stats(self):
+        """
+        counters of our message processing
+        :return: dictionary
+        """
+        stats = {
+            'queue': {
+                'depth': self.queue.qsize(),
+                'capacity': self.queue.maxsize,
+                'policy': self.shed_policy,
+                'accepted': self.accepted,
+                'shed': dict(self.shed),
+                'processed': self.processed,
+                'batches': self.batches
+            },
+            'lanes': {
+                'control': self._control.stats(),
+                'bulk': self._bulk.stats()
+            },
+            'reassembly': self._buffer.stats(),
+            'duplicates': {
+                'ids': self._seen_ids.stats(),
+                'jobs': self._seen_jobs.stats()
+            },
+            'sender': self.sender.stats(),
+            'coalescer': self.coalescer.stats()
+        }
+        if self.accept_legacy:
+            stats['legacy'] = self._legacy.stats()
+        if self.signer:
+            stats['authentication'] = self.signer.stats()
+        kernel = get_udp_drops(self.udp_port)
+        if kernel:
+            stats['kernel'] = kernel
+        return stats
 
     def update_status(self, status_message):
         self.logger.debug("got full status message in buffer ({0}".format(status_message))
@@ -61,7 +153,14 @@ class Processor(object):
 
     def remove_job(self, job):
         self.logger.debug("got full remove in buffer {0}".format(job))
-        if job in self.storage.cluster_jobs:
+        existing = self.storage.cluster_jobs.get(job)
+        self.suppress_resend(job.identity, job.version)
+        if existing and existing.version > job.version:
+            self.logger.debug("ignoring outdated remove of {0}".format(job))
+        elif not existing:
+            # peers that missed the removal may still send the job
+            self.storage.cluster_jobs.bury(job)
+        else:
             self.logger.debug("removing existing job {0}".format(job))
             self.storage.cluster_jobs.remove(job)
             if job.assigned_to == get_ip():
@@ -70,38 +169,103 @@ class Processor(object):
                     if check_process(job.command, job.pid):
                         kill_proc_tree(job.pid)
                 self.logger.info("removing existing, assigned job {0}".format(job))
-                cmd = next(self.cron.find_command(job.command), None)
-                if cmd:
-                    self.logger.info("removing {0} from cron".format(job))
-                    self.cron.remove(cmd)
+                if self.unschedule(job):
                     self.cron.write()
-                else:
-                    self.logger.warning("defined job {0} not found in cron, but assigned to me!".format(job))
 
-    def add_job(self, new_job):
+    def schedule(self, job):
+        """
+        add a job assigned to us to our crontab, without writing it
+        :param job: CronItem
+        :return: True if our crontab changed
+        """
+        existing_job = next(self.cron.find_command(job.command), None)
+        if existing_job and existing_job == job:
+            self.logger.info("job already defined in tab, skipping it")
+            return False
+        if self.user and not job.user:
+            job.user = self.user
+        if self.cron and not job.cron:
+            job.cron = self.cron
+        self.logger.info("adding job {0} to cron {1} for user {2}".format(job, self.cron.filename, job.user))
+        self.cron.append(job)
+        return True
+
+    def unschedule(self, job):
+        """
+        remove a job from our crontab, without writing it
+        :param job: CronItem
+        :return: True if our crontab changed
+        """
+        cmd = next(self.cron.find_command(job.command), None)
+        if not cmd:
+            self.logger.warning("defined job {0} not found in cron, but assigned to me!".format(job))
+            return False
+        self.logger.info("removing {0} from cron".format(job))
+        self.cron.remove(cmd)
+        return True
+
+    def suppress_resend(self, identity, version):
+        """
+        a peer sent a job, so we do not have to resend it if it is not newer than what they sent
+        :param identity: identity of the job
+        :param version: version the peer sent
+        """
+        pending = self._pending.get(identity)
+        if pending and pending.version <= version:
+            self.logger.debug("peer already sent {0}, not resending it".format(pending))
+            del self._pending[identity]
+
+    def add_job(self, new_job, write=True):
+        """
+        store a job, and take it over in or hand it off from our crontab when its assignment changed
+        :param new_job: CronItem
+        :param write: write our crontab when it changed
+        :return: True if our crontab changed
+        """
         self.logger.debug("got full job in buffer {0}".format(new_job))
-        job = next(iter([j for j in self.storage.cluster_jobs if j == new_job]), None)
-        if not job:
-            if new_job.assigned_to == get_ip():
-                existing_job = next(self.cron.find_command(new_job.command), None)
-                if existing_job and existing_job == new_job:
-                    self.logger.info("job already defined in tab, skipping it")
-                else:
-                    if self.user and not new_job.user:
-                        new_job.user = self.user
-                    if self.cron and not new_job.cron:
-                        new_job.cron = self.cron
-                    self.logger.info("adding job {0} to cron {1} for user {2}".format(new_job, self.cron.filename, new_job.user))
-                    self.cron.append(new_job)
-                    self.cron.write()
-        else:
-            idx = self.storage.cluster_jobs.index(job)
-            del (self.storage.cluster_jobs[idx])
+        job = self.storage.cluster_jobs.get(new_job)
+        self.suppress_resend(new_job.identity, new_job.version)
+        if job and job.version > new_job.version:
+            self.logger.debug("ignoring outdated version of {0}".format(new_job))
+            return False
+        tombstone = None if job else self.storage.cluster_jobs.tombstone(new_job)
+        if tombstone and tombstone.version >= new_job.version:
+            self.logger.debug("ignoring version of {0} that was removed".format(new_job))
+            return False
+        changed = False
+        me = get_ip()
+        if not job or job.assigned_to != new_job.assigned_to:
+            if job and job.assigned_to == me:
+                self.logger.info("job {0} moved to {1}, handing it off".format(job, new_job.assigned_to))
+                changed = self.unschedule(job)
+            if new_job.assigned_to == me:
+                changed = self.schedule(new_job) or changed
+        if job and not new_job._log:
+            # logs are local to the node that keeps them, they are not sent over the wire
+            new_job._log = job._log
+        if job and job.cost.runs > new_job.cost.runs:
+            # jobs changed by nodes that did not run them carry no costs
+            new_job.cost = job.cost
         self.storage.cluster_jobs.append(new_job)
+        if changed and write:
+            self.cron.write()
+        return changed
+
+    def reassign(self, reassign):
+        """
+        move jobs of a node that left, our crontab is written once for all of them
+        :param reassign: Reassign message
+        """
+        self.logger.info("got reassignment of {0} jobs".format(len(reassign.jobs)))
+        changed = False
+        for job in reassign.jobs:
+            changed = self.add_job(job, write=False) or changed
+        if changed:
+            self.cron.write()
 
-    def toggle_job(self, toggle):
+    async def toggle_job(self, toggle):
         self.logger.debug("got full toggle in buffer {0}".format(toggle.job))
-        job = next(iter([j for j in self.storage.cluster_jobs if j == toggle.job]), None)
+        job = self.storage.cluster_jobs.get(toggle.job)
         if job:
             if job.assigned_to == get_ip():
                 self.logger.info("am owner for job {0}, toggling it".format(job))
@@ -111,26 +275,60 @@ class Processor(object):
                 if self.cron and not job.cron:
                     job.cron = self.cron
                 self.cron.write()
-                idx = self.storage.cluster_jobs.index(job)
-                del (self.storage.cluster_jobs[idx])
+                job.update_version()
                 self.storage.cluster_jobs.append(job)
+                await self.coalescer.send([job])
 
-    async def run(self, run, uuid):
+    async def run(self, run):
         self.logger.debug("got full run in buffer {0}".format(run.job))
-        job = next(iter([j for j in self.storage.cluster_jobs if j == run.job]), None)
+        job = self.storage.cluster_jobs.get(run.job)
         if job and job.assigned_to == get_ip():
             self.logger.info("am owner for job {0}".format(job))
             run.timestamp = datetime.now()
-            process = subprocess.Popen(run.job.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, shell=True)
             self.logger.info("{0} has been defined, going to execute".format(job.command))
-            std_out, std_err = process.communicate()
-            exit_code = process.wait()
+            pid, exit_code, std_out, std_err, duration, rss = \
+                await asyncio.get_event_loop().run_in_executor(None, execute, run.job.command)
+            # the job may have changed while it ran
+            job = self.storage.cluster_jobs.get(run.job) or job
+            job.cost.observe(duration, rss)
             if std_err:
                 self.logger.warning("error during execution of {0}: {1}".format(run.job.command, std_err))
             self.logger.info("output of {0} with code {1}: {2}".format(job.command, exit_code, std_out))
-            job.append_log("{0:%b %d %H:%M:%S} localhost CRON[{1}] exit code: {2}, out: {3}, err: {4}".format(datetime.now(), process.pid, exit_code, std_out, std_err))
-            broadcast(self.udp_port, UdpSerializer.dump(job, self.hash_key))
-            self.clean_buffer(uuid)
+            job.append_log("{0:%b %d %H:%M:%S} localhost CRON[{1}] exit code: {2}, out: {3}, err: {4}".format(datetime.now(), pid, exit_code, std_out, std_err))
+            self.storage.cluster_jobs.append(job)
+            await self.coalescer.send([job])
+
+    def _ran(self, task):
+        self._runs.discard(task)
+        if not task.cancelled() and task.exception():
+            self.logger.error("failed to run job: {0}".format(task.exception()))
+
+    def compare_digest(self, digest):
+        """
+        compare the digest of a peer with ours, and schedule our jobs in differing buckets to be resent
+        :param digest: Digest of a peer
+        """
+        if digest.ip == get_ip():
+            return
+        size = len(digest.buckets)
+        buckets = self.storage.cluster_jobs.digest(size=size).differences(digest)
+        if not buckets:
+            return
+        self.logger.debug("digest of {0} differs in {1} buckets".format(digest.ip, len(buckets)))
+        for job in self.storage.cluster_jobs.hashed_into(buckets, size):
+            self._pending[job.identity] = job
+        if self._pending and not self._resend:
+            self._resend = asyncio.create_task(self.resend())
+
+    async def resend(self):
+        """
+        send the jobs peers are missing, after a random delay so only a few peers answer the same digest
+        """
+        await asyncio.sleep(random.uniform(0, self.resend_delay))
+        jobs, self._pending, self._resend = list(self._pending.values()), {}, None
+        if jobs:
+            self.logger.debug("resending {0} jobs".format(len(jobs)))
+            await self.coalescer.send(jobs)
 
     def kill(self, kill):
         if not kill.pid:
@@ -144,67 +342,288 @@ class Processor(object):
                 except ValueError:
                     self.logger.warning("got signal to kill self, that's not happening")
 
-    def clean_buffer(self, uuid):
+    async def handle(self, obj):
         """
-        remove packet groups from buffer
-        :param uuid: identifier for the group
+        act on a received message
+        :param obj: message
         """
-        self.logger.debug("removing message {0} from buffer".format(uuid))
-        g = group(self._buffer)
-        if uuid in g:
-            for p in g[uuid]:
-                if p in self._buffer:
-                    self._buffer.remove(p)
-        else:
-            self.logger.warning("message {0} not in buffer, skipping clean".format(uuid))
+        if isinstance(obj, Batch):
+            for message in obj.messages:
+                await self.handle(message)
+        elif isinstance(obj, Status):
+            self.update_status(obj)
+        elif isinstance(obj, ReBalance):
+            self.logger.info("re-balance received")
+            self.storage.cluster_jobs.clear()
+            self.cron.remove_all()
+            self.cron.write()
+            self._buffer.clear()
+            self._legacy.clear()
+        elif isinstance(obj, CronItem):
+            if obj.remove:
+                self.remove_job(obj)
+            else:
+                self.add_job(obj)
+        elif isinstance(obj, Reassign):
+            self.reassign(obj)
+        elif isinstance(obj, Run):
+            # jobs may run for a long time, we keep processing messages meanwhile so a Kill can reach them
+            task = asyncio.ensure_future(self.run(obj))
+            self._runs.add(task)
+            task.add_done_callback(self._ran)
+        elif isinstance(obj, Kill):
+            self.kill(obj)
+        elif isinstance(obj, Toggle):
+            await self.toggle_job(obj)
+        elif isinstance(obj, Digest):
+            self.compare_digest(obj)
 
-    async def process(self):
+    def receive(self, buffer, message_id):
+        """
+        sort the messages of a reassembled payload in our lanes, dropping copies of jobs we already applied
+        :param buffer: payload of the message
+        :param message_id: id of the message
         """
-        processor for our queue
+        try:
+            payloads = schema.unbatch(buffer)
+        except ValueError:
+            self.logger.warning("dropping malformed batch {0}".format(message_id.hex()))
+            return
+        for payload in payloads:
+            key = None
+            tag = schema.tag(payload)
+            if tag == schema.CRON_ITEM_TAG:
+                key = hashlib.blake2b(payload, digest_size=16).digest()
+                if self._seen_jobs.seen(key):
+                    self.suppress_resend(*self._seen_jobs.get(key) or (None, None))
+                    continue
+                self._seen_jobs.add(key)
+            elif tag == self._re_balance_tag:
+                # jobs are resent with the same content after a re-balance
+                self._seen_jobs.clear()
+            self._sequence += 1
+            lane = self._control if tag in self._control_tags else self._bulk
+            lane.put((self._sequence, payload, key, message_id))
+
+    def receive_packet(self, data):
         """
-        data = await self.queue.get()
-        logging.debug("got {0} on processor queue".format(data))
+        reassemble a packet, and sort the message in our lanes once it is complete
+        :param data: UDP packet
+        """
+        self.logger.debug("got {0} on processor queue".format(data))
         packet = Packet.decode(data)
         if packet:
-            self._buffer.append(packet)
-            packet_groups = group(self._buffer)
-            for uuid in packet_groups.keys():
-                self.logger.debug("identifying packet group for {0}".format(uuid))
-                obj = UdpSerializer.load(packet_groups[uuid], self.hash_key)
-                if obj:
-                    self.logger.debug("got object {0} from {1}".format(obj, uuid))
-                    if isinstance(obj, Status):
-                        self.update_status(obj)
-                        self.clean_buffer(uuid)
-                    elif isinstance(obj, ReBalance):
-                        self.logger.info("re-balance received")
-                        self.storage.cluster_jobs.clear()
-                        self.cron.remove_all()
-                        self.cron.write()
-                        self._buffer.clear()
-                    elif isinstance(obj, CronItem):
-                        if obj.remove:
-                            self.remove_job(obj)
-                        else:
-                            self.add_job(obj)
-                        self.clean_buffer(uuid)
-                    elif isinstance(obj, Run):
-                        await self.run(obj, uuid)
-                    elif isinstance(obj, Kill):
-                        self.kill(obj)
-                        self.clean_buffer(uuid)
-                    elif isinstance(obj, Toggle):
-                        self.toggle_job(obj)
-                        self.clean_buffer(uuid)
-        self.storage.prune()
-        self.queue.task_done()
-        if not self.queue.empty():
-            await self.process()
+            if not Packet.is_legacy(data):
+                buffer = self._buffer.add(packet)
+            elif not self.accept_legacy:
+                self.logger.debug("dropping legacy packet {0}".format(packet.id.hex()))
+                return
+            else:
+                buffer = self._legacy.add(packet)
+                if buffer is not None and self.signer:
+                    buffer = self.signer.verify_legacy(buffer)
+                    if buffer is None:
+                        self.logger.warning("invalid signature of legacy message {0}".format(packet.id.hex()))
+            if buffer is not None and not self._seen_ids.seen(packet.id):
+                self._seen_ids.add(packet.id)
+                self.receive(buffer, packet.id)
+
+    def receive_batch(self, batch):
+        """
+        sort a batch of packets from our queue in our lanes
+        :param batch: list of UDP packets
+        """
+        for data in batch:
+            try:
+                self.receive_packet(data)
+            except Exception:
+                self.logger.exception("failed to receive packet")
+            finally:
+                self.queue.task_done()
+        self.processed += len(batch)
+        self.batches += 1
+
+    async def apply(self, item):
+        """
+        decode and handle a message from one of our lanes
+        :param item: sequence number, payload, content hash and message id of the message
+        """
+        sequence, payload, key, message_id = item
+        obj = None
+        try:
+            obj = UdpSerializer.loads(payload)
+            if not obj:
+                self.forget(item)
+                return
+            self.logger.debug("got object {0} from {1}".format(obj, message_id.hex()))
+            if isinstance(obj, ReBalance):
+                # jobs received before a re-balance are outdated, they get resent after it
+                self._bulk.drop_while(lambda i: i[0] < sequence)
+            elif isinstance(obj, (Run, Toggle)) and obj.job not in self.storage.cluster_jobs:
+                # the job may still be waiting in the bulk lane
+                while self._bulk and self._bulk.peek()[0] < sequence:
+                    await self.apply(self._bulk.get())
+            await self.handle(obj)
+        except Exception:
+            # a failing message must not stop our consumer
+            self.logger.exception("failed to handle {0} from {1}".format(obj, message_id.hex()))
+            self.forget(item)
+            return
+        if key and key in self._seen_jobs:
+            self._seen_jobs.add(key, (obj.identity, obj.version))
+
+    def forget(self, item):
+        """
+        a job that was dropped or failed is not applied, so copies of it are not duplicates
+        :param item: sequence number, payload, content hash and message id of the message
+        """
+        key = item[2]
+        if key:
+            self._seen_jobs.discard(key)
+
+    async def serve(self, limit):
+        """
+        handle all control messages, and then at most limit bulk messages
+        :param limit: maximum amount of bulk messages to handle
+        """
+        while self._control:
+            await self.apply(self._control.get())
+        for _ in range(min(limit, len(self._bulk))):
+            await self.apply(self._bulk.get())
+            if self._control:
+                return
+
+    def pending(self):
+        """
+        :return: amount of packets and messages waiting to be processed
+        """
+        return self.queue.qsize() + len(self._control) + len(self._bulk)
+
+    def _drain(self, limit):
+        return [self.queue.get_nowait() for _ in range(min(limit, self.queue.qsize()))]
+
+    def housekeeping(self):
+        """
+        clean up state that builds up while processing messages
+        """
+        self._buffer.expire()
+        self._legacy.expire()
+        self.storage.cluster_jobs.expire(time.time() - self.tombstone_ttl)
+
+    async def process(self):
+        """
+        process everything that is on our queue, and wait for the jobs it runs
+        """
+        while self.pending():
+            self.receive_batch(self._drain(self.batch_size))
+            await self.serve(self.batch_size)
+        if self._runs:
+            await asyncio.wait(self._runs)
+        self.housekeeping()
+
+    async def consume(self):
+        """
+        long-lived consumer of our queue, waits for packets, sorts everything that arrived in our lanes and serves
+        control messages before bulk messages
+        """
+        while True:
+            if self._control or self._bulk:
+                self.receive_batch(self._drain(self.batch_size))
+            else:
+                first = await self.queue.get()
+                self.receive_batch([first] + self._drain(self.batch_size - 1))
+            await self.serve(self.batch_size)
+            # let the event loop receive datagrams and run other tasks in between batches
+            await asyncio.sleep(0)
+
+    async def housekeeper(self):
+        """
+        periodically run our housekeeping
+        """
+        while True:
+            await asyncio.sleep(self.housekeeping_interval)
+            self.housekeeping()
+
+    def start(self):
+        """
+        start consuming our queue on the running event loop
+        """
+        if not self._tasks:
+            # before python 3.10 a queue belongs to the event loop set when it is made, which need not be the one that
+            # runs us, waiting on it from another loop fails
+            queue = asyncio.Queue(self.queue.maxsize)
+            while not self.queue.empty():
+                queue.put_nowait(self.queue.get_nowait())
+            self.queue = queue
+            self._tasks = [asyncio.ensure_future(self.consume()), asyncio.ensure_future(self.housekeeper())]
+
+    async def stop(self):
+        """
+        stop consuming our queue
+        """
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def is_control(self, packet):
+        """
+        check if a packet holds a control message, without reassembling it
+        :param packet: decoded Packet
+        :return: True if the packet is a control message or a batch with one
+        """
+        if packet.total != 1:
+            return packet.id in self._control_ids
+        tag = schema.tag(packet.data)
+        if tag == schema.BATCH_TAG:
+            try:
+                return any(schema.tag(m) in self._control_tags for m in schema.unbatch(packet.data))
+            except ValueError:
+                return False
+        return tag in self._control_tags
+
+    def _remember_control(self, data):
+        """
+        remember the id of a control message that spans several packets by its first packet, so the packets after it
+        are not shed as bulk traffic. batches always fit a single packet
+        :param data: UDP packet
+        """
+        try:
+            magic, _, id, total, index, _ = Packet.header.unpack_from(data)
+        except struct.error:
+            return
+        if magic == Packet.magic and total > 1 and index == 0 and \
+                schema.tag(memoryview(data)[Packet.header.size:]) in self._control_tags:
+            self._control_ids.add(id)
+
+    def _reason_to_shed(self, data):
+        if self.shed_policy == 'bulk':
+            packet = Packet.decode(data)
+            if not packet:
+                return 'invalid'
+            if packet.id in self._seen_ids:
+                return 'duplicate'
+            if not self.is_control(packet):
+                return 'bulk'
+        elif self.shed_policy == 'newest' and self.queue.full():
+            return 'newest'
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.shed['oldest'] = self.shed.get('oldest', 0) + 1
+        return None
 
     def put_nowait(self, packet):
         """
-        put UDP packets on our queue for processing
+        put UDP packets on our queue for processing, when the queue fills up packets are shed following our policy
         :param packet: UDP packet
         """
+        if self.shed_policy == 'bulk':
+            self._remember_control(packet)
+        if self.queue.qsize() >= self._shed_threshold:
+            reason = self._reason_to_shed(packet)
+            if reason:
+                self.shed[reason] = self.shed.get(reason, 0) + 1
+                return
         self.queue.put_nowait(packet)
-        asyncio.create_task(self.process())
+        self.accepted += 1
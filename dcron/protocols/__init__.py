@@ -23,7 +23,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import dcron.protocols.coalescer
+import dcron.protocols.dedup
+import dcron.protocols.lanes
 import dcron.protocols.messages
+import dcron.protocols.schema
+import dcron.protocols.signer
 import dcron.protocols.udpserializer
 
 from dcron.protocols.packet import Packet
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import logging
+
+from dcron.protocols import schema
+from dcron.protocols.packet import Packet
+from dcron.protocols.udpserializer import UdpSerializer
+
+
+class Coalescer(object):
+    """
+    Packs small messages that are sent within a short window into shared datagrams
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, sender, hash_key=None, window=0.005):
+        """
+        :param sender: Sender to send the packets with
+        :param hash_key: key for use in signature
+        :param window: seconds to wait for more messages before sending a partially filled datagram
+        """
+        self.sender = sender
+        self.hash_key = hash_key
+        self.window = window
+        self.messages = 0
+        self.datagrams = 0
+        self._batch = []
+        self._size = schema.header_size
+        self._timer = None
+
+    async def send(self, objects):
+        """
+        queue messages for sending, full datagrams are sent straight away, the rest when the window closes
+        :param objects: messages to send
+        """
+        for obj in objects:
+            buffer = schema.dumps(obj)
+            self.messages += 1
+            if schema.header_size + len(buffer) > Packet.data_size:
+                await self.flush()
+                self.datagrams += 1
+                await self.sender.send(UdpSerializer.dumps(buffer, self.hash_key))
+                continue
+            if self._size + schema.BATCH_ENTRY_SIZE + len(buffer) > Packet.data_size or len(self._batch) == schema.MAX_BATCH:
+                await self.flush()
+            self._batch.append(buffer)
+            self._size += schema.BATCH_ENTRY_SIZE + len(buffer)
+        if self._batch and not self._timer:
+            self._timer = asyncio.get_event_loop().call_later(self.window, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        """
+        send the pending messages
+        """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._batch:
+            return
+        batch, self._batch, self._size = self._batch, [], schema.header_size
+        buffer = batch[0] if len(batch) == 1 else schema.batch(batch)
+        self.datagrams += 1
+        await self.sender.send(UdpSerializer.dumps(buffer, self.hash_key))
+
+    def stats(self):
+        """
+        :return: dictionary with counters of the coalescer
+        """
+        return {
+            'messages': self.messages,
+            'datagrams': self.datagrams
+        }
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+
+from collections import deque
+
+
+class Lane(object):
+    """
+    FIFO of received messages waiting to be handled, that keeps track of how long they wait.
+    A bounded lane drops its oldest messages when it is full.
+    """
+
+    def __init__(self, name, maxsize=0, clock=time.monotonic, on_drop=None):
+        """
+        :param name: name of the lane
+        :param maxsize: maximum amount of messages in the lane, 0 for unbounded
+        :param clock: monotonic clock in seconds
+        :param on_drop: function called with every message that is dropped
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.clock = clock
+        self.on_drop = on_drop
+        self._items = deque()
+        self.enqueued = 0
+        self.served = 0
+        self.dropped = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def put(self, item):
+        """
+        add a message to the lane, dropping the oldest message if the lane is full
+        :param item: message
+        """
+        if self.maxsize and len(self._items) >= self.maxsize:
+            self._drop(self._items.popleft()[1])
+        self._items.append((self.clock(), item))
+        self.enqueued += 1
+
+    def get(self):
+        """
+        :return: the oldest message of the lane
+        :raises IndexError: when the lane is empty
+        """
+        enqueued_at, item = self._items.popleft()
+        wait = self.clock() - enqueued_at
+        self.served += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        return item
+
+    def peek(self):
+        """
+        :return: the oldest message of the lane, without removing it
+        :raises IndexError: when the lane is empty
+        """
+        return self._items[0][1]
+
+    def drop_while(self, predicate):
+        """
+        drop the oldest messages as long as they match
+        :param predicate: function that gets a message and returns True if it should be dropped
+        :return: amount of dropped messages
+        """
+        count = 0
+        while self._items and predicate(self._items[0][1]):
+            self._drop(self._items.popleft()[1])
+            count += 1
+        return count
+
+    def _drop(self, item):
+        self.dropped += 1
+        if self.on_drop:
+            self.on_drop(item)
+
+    def stats(self):
+        """
+        :return: dictionary with depth, counters and wait times (in seconds) of the lane
+        """
+        return {
+            'depth': len(self._items),
+            'enqueued': self.enqueued,
+            'served': self.served,
+            'dropped': self.dropped,
+            'wait': {
+                'average': self._total_wait / self.served if self.served else 0.0,
+                'max': self._max_wait
+            }
+        }
+
+    def __len__(self):
+        return len(self._items)
@@ -23,7 +23,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from datetime import datetime
+import hashlib
+import time
 
 
 class Kill(object):
@@ -47,15 +48,21 @@ class Toggle(object):
 
 class Status(object):
 
-    def __init__(self, ip=None, system_load=None):
+    # statuses pickled by nodes running a pre-schema version carry no cpus
+    cpus = None
+
+    def __init__(self, ip=None, system_load=None, cpus=None):
         """
         our serializable Status Message
         :param ip: ip address
-        :param system_load: system load (0-100%)
+        :param system_load: system load average
+        :param cpus: amount of cpus the node declares, None if unknown
         """
         self.ip = ip
-        self.time = datetime.now().isoformat()
+        # seconds since epoch, at the resolution of the wire format
+        self.time = round(time.time(), 6)
         self.system_load = system_load
+        self.cpus = cpus
         self.state = 'running'
 
     def __eq__(self, other):
@@ -71,3 +78,117 @@ class ReBalance(object):
 
     def __init__(self, timestamp):
         self.timestamp = timestamp
+
+
+class Reassign(object):
+    """
+    Jobs moved to another node because the node they were assigned to left, every job is a field of the message
+    """
+
+    # jobs per message, so a lost datagram only loses a few reassignments
+    size = 32
+
+    def __init__(self, jobs):
+        """
+        our serializable Reassign Message
+        :param jobs: CronItems with their new assignment and version
+        """
+        self.jobs = jobs
+
+    @classmethod
+    def of(cls, jobs):
+        """
+        :param jobs: CronItems with their new assignment and version
+        :return: list of Reassign messages with at most size jobs each
+        """
+        return [cls(jobs[i:i + cls.size]) for i in range(0, len(jobs), cls.size)]
+
+
+class Batch(object):
+
+    def __init__(self, messages):
+        """
+        several small messages sharing a datagram
+        :param messages: list of messages
+        """
+        self.messages = messages
+
+
+class Digest(object):
+    """
+    Summary of the jobs a node knows about, jobs are hashed into buckets by identity and version. Tombstones of
+    removed jobs are part of it, so peers that missed a removal see a difference
+    """
+
+    size = 64
+
+    def __init__(self, ip=None, buckets=None):
+        """
+        our serializable Digest Message
+        :param ip: ip address
+        :param buckets: hash per bucket
+        """
+        self.ip = ip
+        self.buckets = buckets if buckets is not None else [0] * self.size
+
+    @staticmethod
+    def job_hash(job):
+        """
+        hash a job, cached on the job for as long as its version doesn't change
+        :param job: CronItem, or its tombstone
+        :return: tuple of identity hash and version hash
+        """
+        cached = getattr(job, '_digest', None)
+        if cached and cached[0] == (job.version, job.remove):
+            return cached[1], cached[2]
+        key, value = Digest.hash(job.identity, job.version, job.remove)
+        job._digest = ((job.version, job.remove), key, value)
+        return key, value
+
+    @staticmethod
+    def hash(identity, version, removed=False):
+        """
+        :param identity: identity of a job
+        :param version: version of the job
+        :param removed: True for the tombstone of a removed job
+        :return: tuple of identity hash and version hash
+        """
+        identity = '\0'.join(identity).encode('utf-8')
+        key = int.from_bytes(hashlib.blake2b(identity, digest_size=8).digest(), 'big')
+        version = str(version).encode('utf-8') + (b'\0removed' if removed else b'')
+        value = int.from_bytes(hashlib.blake2b(identity + b'\0' + version, digest_size=8).digest(), 'big')
+        return key, value
+
+    @classmethod
+    def bucket(cls, job, size=None):
+        """
+        :param job: CronItem
+        :param size: amount of buckets
+        :return: bucket index of the job
+        """
+        return cls.job_hash(job)[0] % (size or cls.size)
+
+    @classmethod
+    def of(cls, ip, jobs, size=None):
+        """
+        create the digest of a set of jobs
+        :param ip: ip address
+        :param jobs: CronItems
+        :param size: amount of buckets
+        :return: Digest
+        """
+        size = size or cls.size
+        buckets = [0] * size
+        for job in jobs:
+            key, value = cls.job_hash(job)
+            buckets[key % size] ^= value
+        return cls(ip, buckets)
+
+    def differences(self, other):
+        """
+        :param other: Digest to compare with
+        :return: set of bucket indices that differ
+        """
+        if len(self.buckets) != len(other.buckets):
+            return set(range(len(self.buckets)))
+        return {i for i, (a, b) in enumerate(zip(self.buckets, other.buckets)) if a != b}
@@ -25,26 +25,38 @@
 
 import struct
 
+from uuid import UUID
+
 
 class Packet(object):
     """
     UDP Packet
     """
 
-    max_size = 1024
-    uuid_size = 36
-    total_size = 4
-    index_size = 4
-    data_size = 980
+    magic = 0xdc
+    version = 2
+    # magic, version, message id, total, index, data length
+    header = struct.Struct('!BB16sHHH')
+    max_total = 0xFFFF
+    # maximum amount of data per packet, 1400 fits a regular 1500 byte MTU
+    data_size = 1400
+    # signed packets have a truncated MAC appended after the data
+    mac_size = 8
+    max_data_size = 65507 - header.size - mac_size
+
+    # pre-version 2 packets are padded to a fixed size and carry a textual uuid
+    legacy_format = struct.Struct('!36sLL980s')
 
     def __init__(self, id, total, index, data):
         """
         Our UDP Packet structure
-        :param id: uuid
+        :param id: message id (16 bytes or uuid string)
         :param total: total amount of packets for an object
         :param index: current index of total
         :param data: raw byte data
         """
+        if isinstance(id, str):
+            id = UUID(id).bytes
         self.id = id
         self.total = total
         self.index = index
@@ -55,21 +67,38 @@ class Packet(object):
         create the binary data for UDP Packet
         :return: binary data
         """
-        return struct.pack('!36sLL980s', self.id.encode('utf-8'), self.total, self.index, self.data)
+        return self.header.pack(self.magic, self.version, self.id, self.total, self.index, len(self.data)) + self.data
 
     @staticmethod
     def decode(packet):
         """
-        decode a single UDP Packet from raw bytes
+        decode a single UDP Packet from raw bytes, the data references the raw bytes without copying them.
+        A MAC at the end of the packet is ignored, it is verified before packets are decoded.
         :param packet: packet
         :return: UdpPacket or None
         """
         try:
-            lid, ltot, lidx, ldat = struct.unpack('!36sLL980s', packet)
-            return Packet(lid.decode('utf-8'), ltot, lidx, ldat)
+            if packet[0] == Packet.magic:
+                _, version, lid, ltot, lidx, llen = Packet.header.unpack_from(packet)
+                end = Packet.header.size + llen
+                if version != Packet.version or len(packet) not in (end, end + Packet.mac_size):
+                    return None
+                return Packet(lid, ltot, lidx, memoryview(packet)[Packet.header.size:end])
+            if Packet.is_legacy(packet):
+                lid, ltot, lidx, ldat = Packet.legacy_format.unpack(packet)
+                return Packet(lid.decode('utf-8'), ltot, lidx, ldat)
+            return None
         except:
             return None
 
+    @staticmethod
+    def is_legacy(packet):
+        """
+        :param packet: raw datagram
+        :return: True if the datagram is a fixed size packet of a pre-version 2 node
+        """
+        return len(packet) == Packet.legacy_format.size and packet[0] != Packet.magic
+
     def __eq__(self, other):
         if not other or not isinstance(other, Packet):
             return False
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import time
+
+from collections import OrderedDict
+
+
+class PartialMessage(object):
+    """
+    Fragments of a message that has not been fully received yet
+    """
+
+    __slots__ = ('fragments', 'received', 'size', 'deadline')
+
+    # bookkeeping cost of a preallocated slot, so huge announced totals count against the budget
+    slot_size = 8
+
+    def __init__(self, total, deadline):
+        """
+        preallocate a slot for every fragment of the message
+        :param total: total amount of packets for the message
+        :param deadline: time after which the message is considered lost
+        """
+        self.fragments = [None] * total
+        self.received = 0
+        self.size = total * self.slot_size
+        self.deadline = deadline
+
+    def add(self, index, data):
+        """
+        store a fragment in its slot, duplicates are ignored
+        :param index: index of the fragment
+        :param data: fragment data
+        :return: True if the message is complete
+        """
+        if self.fragments[index] is None:
+            self.fragments[index] = data
+            self.received += 1
+            self.size += len(data)
+        return self.received == len(self.fragments)
+
+    def assemble(self):
+        """
+        :return: the payload of the complete message
+        """
+        return b''.join(self.fragments)
+
+
+class ReassemblyBuffer(object):
+    """
+    Reassembles messages from packets, indexed by message id.
+    Partial messages expire after a timeout, and when the buffer exceeds its byte budget the least recently
+    updated partial messages are evicted.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, timeout=30, budget=16 * 1024 * 1024, clock=time.monotonic):
+        """
+        :param timeout: seconds a partial message may take to complete
+        :param budget: maximum amount of bytes held by partial messages
+        :param clock: time source
+        """
+        self.timeout = timeout
+        self.budget = budget
+        self.clock = clock
+        self.size = 0
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+        self._messages = OrderedDict()
+        self._next_sweep = clock() + timeout
+
+    def add(self, packet):
+        """
+        add a packet to the buffer
+        :param packet: decoded Packet
+        :return: payload of the message if this packet completed it, otherwise None
+        """
+        now = self.clock()
+        if now >= self._next_sweep:
+            self.expire(now)
+        if packet.total == 1 and packet.index == 0:
+            self.completed += 1
+            return bytes(packet.data)
+        message = self._messages.get(packet.id)
+        if message is None:
+            if not 0 <= packet.index < packet.total:
+                self.logger.debug("dropping packet with invalid index {0}/{1}".format(packet.index, packet.total))
+                return None
+            message = self._messages[packet.id] = PartialMessage(packet.total, now + self.timeout)
+            self.size += message.size
+        elif packet.total != len(message.fragments) or not 0 <= packet.index < packet.total:
+            self.logger.debug("dropping packet that does not match message {0}".format(packet.id.hex()))
+            return None
+        elif message.deadline < now:
+            self._remove(packet.id)
+            self.expired += 1
+            return None
+        else:
+            self._messages.move_to_end(packet.id)
+        size = message.size
+        if message.add(packet.index, packet.data):
+            del self._messages[packet.id]
+            self.size -= size
+            self.completed += 1
+            return message.assemble()
+        self.size += message.size - size
+        if self.size > self.budget:
+            self._evict()
+        return None
+
+    def _remove(self, id):
+        message = self._messages.pop(id, None)
+        if message:
+            self.size -= message.size
+
+    def _evict(self):
+        while self.size > self.budget and self._messages:
+            id, message = self._messages.popitem(last=False)
+            self.logger.debug("evicting partial message {0} ({1}/{2})".format(id.hex(), message.received, len(message.fragments)))
+            self.size -= message.size
+            self.evicted += 1
+
+    def expire(self, now=None):
+        """
+        drop all partial messages past their deadline
+        :param now: current time of our clock
+        """
+        if now is None:
+            now = self.clock()
+        for id in [i for i, m in self._messages.items() if m.deadline < now]:
+            self.logger.debug("partial message {0} expired".format(id.hex()))
+            self._remove(id)
+            self.expired += 1
+        self._next_sweep = now + self.timeout / 2
+
+    def discard(self, id):
+        """
+        drop all fragments of a message
+        :param id: message id
+        """
+        self._remove(id)
+
+    def clear(self):
+        self._messages.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+        :return: dictionary with counters of the buffer
+        """
+        return {
+            'partial': len(self._messages),
+            'bytes': self.size,
+            'completed': self.completed,
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
+
+    def __contains__(self, id):
+        return id in self._messages
+
+    def __len__(self):
+        return len(self._messages)
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import struct
+
+from datetime import datetime
+
+from dcron.cost import Cost
+from dcron.cron.cronitem import CronItem
+from dcron.protocols.messages import Batch, Digest, Kill, ReBalance, Reassign, Run, Status, Toggle
+
+# version of the wire format, only bumped for incompatible changes.
+# fields are append-only: newer nodes add fields to the end of a message,
+# older nodes ignore fields they don't know and use defaults for missing ones.
+VERSION = 1
+
+# version, tag, field count and length of the fields that follow
+_header = struct.Struct('!BBBI')
+header_size = _header.size
+_length = struct.Struct('!H')
+_integer = struct.Struct('!q')
+_real = struct.Struct('!d')
+_boolean = struct.Struct('!?')
+
+_NULL_LENGTH = 0xFFFF
+_NULL_INTEGER = -2 ** 63
+
+CRON_ITEM_TAG = 1
+BATCH_TAG = 8
+# every message in a batch is a field
+MAX_BATCH = 0xFF
+# overhead of a message in a batch
+BATCH_ENTRY_SIZE = _length.size
+
+
+class Writer(object):
+    """
+    Sequential field writer for a single message
+    """
+
+    def __init__(self):
+        self.fields = 0
+        self.chunks = []
+
+    def string(self, value):
+        self.fields += 1
+        if value is None:
+            self.chunks.append(_length.pack(_NULL_LENGTH))
+            return
+        data = value.encode('utf-8')
+        if len(data) >= _NULL_LENGTH:
+            raise ValueError("string field too long ({0} bytes)".format(len(data)))
+        self.chunks.append(_length.pack(len(data)))
+        self.chunks.append(data)
+
+    def integer(self, value):
+        self.fields += 1
+        self.chunks.append(_integer.pack(_NULL_INTEGER if value is None else value))
+
+    def real(self, value):
+        self.fields += 1
+        self.chunks.append(_real.pack(float('nan') if value is None else value))
+
+    def boolean(self, value):
+        self.fields += 1
+        self.chunks.append(_boolean.pack(bool(value)))
+
+    def blob(self, value):
+        self.fields += 1
+        if value is None:
+            self.chunks.append(_length.pack(_NULL_LENGTH))
+            return
+        if len(value) >= _NULL_LENGTH:
+            raise ValueError("blob field too long ({0} bytes)".format(len(value)))
+        self.chunks.append(_length.pack(len(value)))
+        self.chunks.append(value)
+
+    def timestamp(self, value):
+        """
+        datetimes are sent as microseconds since epoch, so they survive the round-trip exactly
+        """
+        if value is None:
+            self.integer(None)
+        else:
+            self.integer(int(value.replace(microsecond=0).timestamp()) * 1000000 + value.microsecond)
+
+    def message(self, value):
+        self.fields += 1
+        data = dumps(value)
+        self.chunks.append(_length.pack(len(data)))
+        self.chunks.append(data)
+
+    def getvalue(self, tag):
+        body = b''.join(self.chunks)
+        return _header.pack(VERSION, tag, self.fields, len(body)) + body
+
+
+class Reader(object):
+    """
+    Sequential field reader for a single message, returns defaults for fields the sender did not know about
+    """
+
+    def __init__(self, data):
+        self.version, self.tag, self.fields, length = _header.unpack_from(data)
+        self.view = memoryview(data)[:_header.size + length]
+        self.offset = _header.size
+
+    def _next(self):
+        if self.fields == 0:
+            return False
+        self.fields -= 1
+        return True
+
+    def _unpack(self, fmt):
+        value, = fmt.unpack_from(self.view, self.offset)
+        self.offset += fmt.size
+        return value
+
+    def _bytes(self):
+        length = self._unpack(_length)
+        if length == _NULL_LENGTH:
+            return None
+        if self.offset + length > len(self.view):
+            raise ValueError("truncated field")
+        value = self.view[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def string(self, default=None):
+        if not self._next():
+            return default
+        value = self._bytes()
+        return None if value is None else str(value, 'utf-8')
+
+    def integer(self, default=None):
+        if not self._next():
+            return default
+        value = self._unpack(_integer)
+        return None if value == _NULL_INTEGER else value
+
+    def real(self, default=None):
+        if not self._next():
+            return default
+        value = self._unpack(_real)
+        return None if value != value else value
+
+    def boolean(self, default=False):
+        if not self._next():
+            return default
+        return self._unpack(_boolean)
+
+    def blob(self, default=None):
+        if not self._next():
+            return default
+        value = self._bytes()
+        return None if value is None else bytes(value)
+
+    def timestamp(self, default=None):
+        value = self.integer(None)
+        if value is None:
+            return default
+        return datetime.fromtimestamp(value // 1000000).replace(microsecond=value % 1000000)
+
+    def message(self, default=None):
+        if not self._next():
+            return default
+        return loads(self._bytes())
+
+
+def _write_cron_item(writer, job):
+    writer.string(job.command)
+    writer.string(str(job.parts))
+    writer.string(job.user)
+    writer.string(job.assigned_to)
+    writer.boolean(job.enabled)
+    writer.integer(job.pid)
+    writer.boolean(job.remove)
+    writer.integer(job.version)
+    writer.integer(job.cost.runs)
+    writer.real(job.cost.duration)
+    writer.real(job.cost.variance)
+    writer.integer(job.cost.rss)
+
+
+def _read_cron_item(reader):
+    command = reader.string('')
+    parts = reader.string('* * * * *')
+    job = CronItem(command=command, user=reader.string())
+    job.set_all(parts)
+    job.assigned_to = reader.string()
+    job.enable(reader.boolean(True))
+    job.pid = reader.integer()
+    job.remove = reader.boolean(False)
+    job.version = reader.integer(0) or 0
+    job.cost = Cost(reader.integer(0) or 0, reader.real(), reader.real(0.0) or 0.0, reader.integer())
+    return job
+
+
+def _write_status(writer, status):
+    writer.string(status.ip)
+    # microseconds since epoch, like timestamp fields
+    writer.integer(None if status.time is None else round(status.time * 1000000))
+    writer.real(status.system_load)
+    writer.string(status.state)
+    writer.integer(status.cpus)
+
+
+def _read_status(reader):
+    status = Status(reader.string())
+    time = reader.integer()
+    status.time = None if time is None else time / 1000000
+    status.system_load = reader.real()
+    status.state = reader.string('running')
+    status.cpus = reader.integer()
+    return status
+
+
+def _write_kill(writer, kill):
+    writer.message(kill.job)
+    writer.integer(kill.pid)
+
+
+def _read_kill(reader):
+    # Kill.__init__ derives the pid from the job log, which is only possible on the sending side
+    kill = Kill.__new__(Kill)
+    kill.job = reader.message()
+    kill.pid = reader.integer()
+    return kill
+
+
+def _write_job_message(writer, message):
+    writer.message(message.job)
+
+
+def _read_run(reader):
+    return Run(reader.message())
+
+
+def _read_toggle(reader):
+    return Toggle(reader.message())
+
+
+def _write_re_balance(writer, re_balance):
+    writer.timestamp(re_balance.timestamp)
+
+
+def _read_re_balance(reader):
+    return ReBalance(reader.timestamp())
+
+
+def _write_digest(writer, digest):
+    writer.string(digest.ip)
+    writer.blob(struct.pack('!{0}Q'.format(len(digest.buckets)), *digest.buckets))
+
+
+def _read_digest(reader):
+    ip = reader.string()
+    buckets = reader.blob(b'')
+    return Digest(ip, list(struct.unpack('!{0}Q'.format(len(buckets) // 8), buckets[:len(buckets) // 8 * 8])))
+
+
+def _write_reassign(writer, reassign):
+    for job in reassign.jobs:
+        writer.message(job)
+
+
+def _read_reassign(reader):
+    return Reassign([reader.message() for _ in range(reader.fields)])
+
+
+def _write_batch(writer, batch):
+    for message in batch.messages:
+        writer.message(message)
+
+
+def _read_batch(reader):
+    return Batch([reader.message() for _ in range(reader.fields)])
+
+
+# type -> (tag, writer), tags are part of the wire format and should never be reused
+_writers = {
+    CronItem: (CRON_ITEM_TAG, _write_cron_item),
+    Status: (2, _write_status),
+    Kill: (3, _write_kill),
+    Run: (4, _write_job_message),
+    Toggle: (5, _write_job_message),
+    ReBalance: (6, _write_re_balance),
+    Digest: (7, _write_digest),
+    Batch: (BATCH_TAG, _write_batch),
+    Reassign: (9, _write_reassign),
+}
+
+_readers = {
+    CRON_ITEM_TAG: _read_cron_item,
+    2: _read_status,
+    3: _read_kill,
+    4: _read_run,
+    5: _read_toggle,
+    6: _read_re_balance,
+    7: _read_digest,
+    BATCH_TAG: _read_batch,
+    9: _read_reassign,
+}
+
+
+def dumps(obj):
+    """
+    encode a message in our binary wire format
+    :param obj: message to encode
+    :return: bytes
+    """
+    if type(obj) not in _writers:
+        raise TypeError("no schema for {0}".format(type(obj).__name__))
+    tag, write = _writers[type(obj)]
+    writer = Writer()
+    write(writer, obj)
+    return writer.getvalue(tag)
+
+
+def batch(messages):
+    """
+    combine already encoded messages in a batch
+    :param messages: list of encoded messages
+    :return: bytes
+    """
+    if len(messages) > MAX_BATCH:
+        raise ValueError("batch of {0} messages exceeds {1}".format(len(messages), MAX_BATCH))
+    writer = Writer()
+    for message in messages:
+        writer.blob(message)
+    return writer.getvalue(BATCH_TAG)
+
+
+def tag_of(cls):
+    """
+    :param cls: message type
+    :return: tag of the message type on the wire
+    """
+    return _writers[cls][0]
+
+
+def tag(data):
+    """
+    message type of encoded data, without decoding it
+    :param data: bytes
+    :return: tag of the message, None if data is not in our wire format
+    """
+    if len(data) < _header.size or data[0] != VERSION:
+        return None
+    return data[1]
+
+
+def unbatch(data):
+    """
+    split a batch in its encoded messages, without decoding them
+    :param data: bytes
+    :return: list of encoded messages, only data itself if it is not a batch
+    :raises ValueError: when the batch is malformed
+    """
+    if tag(data) != BATCH_TAG:
+        return [data]
+    reader = Reader(data)
+    try:
+        return [reader.blob() for _ in range(reader.fields)]
+    except struct.error as e:
+        raise ValueError("malformed batch: {0}".format(e))
+
+
+def measure(data):
+    """
+    length of the message at the start of data, anything after it (signatures, padding) is not part of it
+    :param data: bytes
+    :return: length in bytes
+    :raises ValueError: when the data does not start with a message header
+    """
+    try:
+        version, _, _, length = _header.unpack_from(data)
+    except struct.error:
+        raise ValueError("truncated message header")
+    if version != VERSION:
+        raise ValueError("unsupported wire format version {0}".format(version))
+    return _header.size + length
+
+
+def loads(data):
+    """
+    decode a message from our binary wire format, trailing data is ignored
+    :param data: bytes
+    :return: message
+    :raises ValueError: when the data is not a valid message
+    """
+    try:
+        reader = Reader(data)
+    except struct.error:
+        raise ValueError("truncated message header")
+    if reader.version != VERSION:
+        raise ValueError("unsupported wire format version {0}".format(reader.version))
+    if reader.tag not in _readers:
+        raise ValueError("unknown message tag {0}".format(reader.tag))
+    try:
+        return _readers[reader.tag](reader)
+    except (struct.error, UnicodeDecodeError, KeyError, TypeError) as e:
+        # a TypeError comes from nested messages that are null
+        raise ValueError("malformed message: {0}".format(e))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import hmac
+import pickletools
+
+from dcron.protocols.packet import Packet
+
+
+class Signer(object):
+    """
+    Per packet authentication with a truncated keyed BLAKE2 MAC. Nodes running a pre-schema version sign whole
+    messages instead, with a HMAC-SHA1 of the pickle appended after a space
+    """
+
+    _instances = {}
+
+    def __init__(self, key):
+        """
+        :param key: shared secret of the cluster
+        """
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        self._key = key
+        if len(key) > hashlib.blake2b.MAX_KEY_SIZE:
+            key = hashlib.blake2b(key).digest()
+        self._mac = hashlib.blake2b(key=key, digest_size=Packet.mac_size)
+        self.verified = 0
+        self.rejected = 0
+
+    @classmethod
+    def for_key(cls, key):
+        """
+        keyed state is set up once per key and shared
+        :param key: shared secret of the cluster
+        :return: Signer or None if there is no key
+        """
+        if not key:
+            return None
+        if key not in cls._instances:
+            cls._instances[key] = cls(key)
+        return cls._instances[key]
+
+    def digest(self, data):
+        mac = self._mac.copy()
+        mac.update(data)
+        return mac.digest()
+
+    def sign(self, packet):
+        """
+        :param packet: encoded packet
+        :return: packet with the MAC appended
+        """
+        return packet + self.digest(packet)
+
+    def verify(self, packet):
+        """
+        :param packet: raw datagram
+        :return: True if the MAC at the end of the datagram is valid
+        """
+        if len(packet) > Packet.mac_size and \
+                hmac.compare_digest(packet[-Packet.mac_size:], self.digest(memoryview(packet)[:-Packet.mac_size])):
+            self.verified += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def verify_legacy(self, buffer):
+        """
+        verify a message reassembled from legacy packets, the end of the pickle is found by parsing its opcodes
+        without executing them, as the padding of the last packet follows the HMAC
+        :param buffer: payload of the legacy packets of a message
+        :return: the pickle if the HMAC after it is valid, otherwise None
+        """
+        try:
+            end = [pos for _, _, pos in pickletools.genops(buffer)][-1] + 1
+        except Exception:
+            end = None
+        if end and buffer[end:end + 1] == b' ':
+            mac = hmac.new(self._key, buffer[:end], hashlib.sha1)
+            if hmac.compare_digest(buffer[end + 1:end + 1 + mac.digest_size], mac.digest()):
+                self.verified += 1
+                return buffer[:end]
+        self.rejected += 1
+        return None
+
+    def stats(self):
+        """
+        :return: dictionary with counters of the signer
+        """
+        return {
+            'verified': self.verified,
+            'rejected': self.rejected
+        }
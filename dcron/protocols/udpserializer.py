@@ -25,14 +25,17 @@
 
 import logging
 import pickle
-import hashlib
-import hmac
 
 from math import ceil
 from uuid import uuid4
 
 
+from dcron.cost import Cost
+from dcron.cron.cronitem import CronItem
+from dcron.protocols import schema
 from dcron.protocols.packet import Packet
+from dcron.protocols.reassembly import ReassemblyBuffer
+from dcron.protocols.signer import Signer
 
 
 class UdpSerializer(object):
@@ -41,7 +44,7 @@ class UdpSerializer(object):
     """
 
     logger = logging.getLogger(__name__)
-    
+
     @staticmethod
     def dump(obj, hash_key=None):
         """
@@ -50,13 +53,25 @@ class UdpSerializer(object):
         :param hash_key: key for use in signature
         :return: udp_packets
         """
-        buffer = pickle.dumps(obj)
-        if hash_key:
-            buffer += b' ' + hmac.new(hash_key.encode('utf-8'), buffer, hashlib.sha1).digest()
+        return UdpSerializer.dumps(schema.dumps(obj), hash_key)
+
+    @staticmethod
+    def dumps(buffer, hash_key=None):
+        """
+        split an encoded message into (raw) udp_packet
+        :param buffer: encoded message
+        :param hash_key: key for use in signature
+        :return: udp_packets
+        """
+        signer = Signer.for_key(hash_key)
+        view = memoryview(buffer)
         total = ceil(len(buffer) / Packet.data_size)
-        uuid = str(uuid4())
+        if total > Packet.max_total:
+            raise ValueError("message of {0} bytes does not fit in {1} packets".format(len(buffer), Packet.max_total))
+        uuid = uuid4().bytes
         for i in range(total):
-            yield Packet(uuid, total, i, buffer[i * Packet.data_size:(i + 1) * Packet.data_size]).encode()
+            packet = Packet(uuid, total, i, view[i * Packet.data_size:(i + 1) * Packet.data_size]).encode()
+            yield signer.sign(packet) if signer else packet
 
     @staticmethod
     def load(data, hash_key=None):
@@ -66,30 +81,62 @@ class UdpSerializer(object):
         :param hash_key: key for use in signature
         :return: the object or None
         """
-        packets = []
+        signer = Signer.for_key(hash_key)
+        buffer = ReassemblyBuffer()
+        legacy = ReassemblyBuffer()
         for elem in data:
             p = Packet.decode(elem)
             if not p:
                 p = elem
-            packets.append(p)
-        # validation
-        if len(packets) == 0:
-            return None
-        expected = range(0, packets[0].total)
-        given = [i.index for i in packets]
-        missing = [x for x in expected if x not in given]
-        if len(missing) > 0:
-            UdpSerializer.logger.debug("packet validation failed, probably partial")
-            return None
-        # validation passed
-        buffer = b''
-        for p in sorted(packets, key=lambda x: x.index):
-            buffer += p.data
-        if hash_key:
-            data, digest = buffer.split(b' ')
-            if digest == hmac.new(hash_key.encode('utf-8'), data, hashlib.sha1).digest():
-                return pickle.loads(data)
+            elif signer and not Packet.is_legacy(elem) and not signer.verify(elem):
+                UdpSerializer.logger.warning("invalid packet signature")
+                continue
+            if not Packet.is_legacy(elem):
+                payload = buffer.add(p)
             else:
-                UdpSerializer.logger.warning("invalid message signature")
+                # legacy packets are not signed, nodes running a pre-schema version sign the whole message
+                payload = legacy.add(p)
+                if payload is not None and signer:
+                    payload = signer.verify_legacy(payload)
+                    if payload is None:
+                        UdpSerializer.logger.warning("invalid message signature")
+                        return None
+            if payload is not None:
+                return UdpSerializer.loads(payload)
+        UdpSerializer.logger.debug("packet validation failed, probably partial")
+        return None
+
+    @staticmethod
+    def loads(buffer):
+        """
+        construct object from a reassembled message payload, signatures are verified before reassembly
+        :param buffer: payload of all packets of a message
+        :return: the object or None
+        """
+        if buffer[:1] == pickle.PROTO:
+            # nodes running a pre-schema version pickle their messages, the pickle stream ends itself so the
+            # packet padding and the signature of the message after it are ignored.
+            try:
+                return UdpSerializer.upgrade(pickle.loads(buffer))
+            except Exception as e:
+                # unpickling raises about any exception on malformed data
+                UdpSerializer.logger.warning("could not unpickle message: {0}".format(e))
                 return None
-        return pickle.loads(buffer)
+        try:
+            return schema.loads(buffer)
+        except ValueError as e:
+            UdpSerializer.logger.warning("could not decode message: {0}".format(e))
+            return None
+
+    @staticmethod
+    def upgrade(obj):
+        """
+        give the jobs of a message pickled by a pre-schema node the fields that were added since
+        :param obj: unpickled message
+        :return: the message
+        """
+        job = obj if isinstance(obj, CronItem) else getattr(obj, 'job', None)
+        if isinstance(job, CronItem) and 'cost' not in vars(job):
+            # a shared class level default would be mutated by every legacy job that runs
+            job.cost = Cost()
+        return obj
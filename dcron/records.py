@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from datetime import datetime
+
+from dcron.cost import Cost
+from dcron.cron.cronitem import CronItem, CronDateTimeParts
+from dcron.cron.crontab import CronTab
+from dcron.protocols.messages import Status
+
+# version of our record format, older caches are lists of JSON objects
+FORMAT = 2
+
+
+class RecordSerializer(object):
+    """
+    Flat records for our on-disk cache, a job or status is a list of its fields that is encoded and decoded in a single
+    pass. Crontabs and schedules are stored once in tables that job records refer to by index, schedules are parsed
+    once per table instead of once per job.
+    """
+
+    def __init__(self):
+        self.crontabs = []
+        self.schedules = []
+        self._crontabs = {}
+        self._schedules = {}
+
+    def _crontab(self, cron):
+        if cron is None:
+            return None
+        key = (cron._user, cron.in_tab, cron._tabfile, cron._log)
+        index = self._crontabs.get(key)
+        if index is None:
+            index = self._crontabs[key] = len(self.crontabs)
+            self.crontabs.append(list(key))
+        return index
+
+    def _schedule(self, parts):
+        key = str(parts)
+        index = self._schedules.get(key)
+        if index is None:
+            index = self._schedules[key] = len(self.schedules)
+            self.schedules.append(key)
+        return index
+
+    def job(self, job):
+        """
+        :param job: CronItem
+        :return: list of the fields of the job, referring to our tables
+        """
+        last_run = job.last_run.timestamp() if isinstance(job.last_run, datetime) else None
+        return [job.command, job.comment, job.user, job.enabled, last_run, job.pid, job.assigned_to, job.version,
+                job._log, self._crontab(job.cron), self._schedule(job.parts), job.cost.fields()]
+
+    def dump_jobs(self, jobs, tombstones=None):
+        """
+        :param jobs: iterable of CronItems
+        :param tombstones: iterable of removed CronItems and the time they were removed
+        :return: dictionary with our tables and the job records, for encoding as JSON
+        """
+        records = [self.job(job) for job in jobs]
+        data = {'format': FORMAT, 'crontabs': self.crontabs, 'schedules': self.schedules, 'jobs': records}
+        if tombstones:
+            data['tombstones'] = [[self.job(job), removed] for job, removed in tombstones]
+        return data
+
+    @staticmethod
+    def load_jobs(data, crontabs=None, identities=None, tombstones=None):
+        """
+        :param data: dictionary made by dump_jobs
+        :param crontabs: dictionary of CronTabs by their table row, to share them between loads
+        :param identities: list to append the identity of every job to, saves rendering their schedules again
+        :param tombstones: list to append the removed jobs and the time they were removed to
+        :return: list of CronItems
+        """
+        crontabs = {} if crontabs is None else crontabs
+        tabs = []
+        for row in data['crontabs']:
+            key = tuple(row)
+            if key not in crontabs:
+                user, tab, tabfile, log = row
+                crontabs[key] = CronTab(user=user, tab=tab, tabfile=tabfile, log=log)
+            tabs.append(crontabs[key])
+        schedules = [CronDateTimeParts(schedule) for schedule in data['schedules']]
+        rendered = [str(schedule) for schedule in schedules]
+
+        def load(record):
+            cron, schedule = record[9:11]
+            # records written before costs were kept end at the schedule
+            return RecordSerializer.load_job(*record[:9], None if cron is None else tabs[cron],
+                                             schedules[schedule].copy(), *record[11:])
+
+        jobs = []
+        for record in data['jobs']:
+            job = load(record)
+            jobs.append(job)
+            if identities is not None:
+                identities.append((job.command, rendered[record[10]]))
+        if tombstones is not None:
+            tombstones.extend((load(record), removed) for record, removed in data.get('tombstones', []))
+        return jobs
+
+    @staticmethod
+    def load_job(command, comment, user, enabled, last_run, pid, assigned_to, version, log, cron, parts, cost=None):
+        """
+        :return: CronItem with the given fields, cron and parsed parts are used as they are
+        """
+        job = CronItem(command=command, user=user, cron=cron, parts=parts)
+        job.enable(enabled)
+        job.comment = comment
+        job.assigned_to = assigned_to
+        job.version = version
+        job.pid = pid
+        job._log = log
+        if cost:
+            job.cost = Cost(*cost)
+        if last_run is not None:
+            job.last_run = datetime.fromtimestamp(last_run)
+        return job
+
+    @staticmethod
+    def status(status):
+        """
+        :param status: Status message
+        :return: list of the fields of the status
+        """
+        return [status.ip, status.state, status.system_load, status.time, status.cpus]
+
+    @staticmethod
+    def load_status(record):
+        """
+        :param record: list made by status
+        :return: Status message
+        """
+        status = Status(record[0], record[2], record[4] if len(record) > 4 else None)
+        status.state = record[1]
+        status.time = record[3]
+        return status
+
+    @staticmethod
+    def dump_statuses(statuses):
+        """
+        :param statuses: iterable of Status messages
+        :return: dictionary with the status records, for encoding as JSON
+        """
+        return {'format': FORMAT, 'statuses': [RecordSerializer.status(status) for status in statuses]}
+
+    @staticmethod
+    def load_statuses(data):
+        """
+        :param data: dictionary made by dump_statuses
+        :return: list of Status messages
+        """
+        return [RecordSerializer.load_status(record) for record in data['statuses']]
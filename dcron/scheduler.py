@@ -23,12 +23,47 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
+import heapq
 import logging
 
-from datetime import timedelta, datetime
-from random import shuffle
+import time
 
-from dateutil import parser
+from bisect import bisect
+from copy import copy
+from random import randrange, shuffle
+
+
+def point(key):
+    """
+    :param key: string to hash
+    :return: position of the key on our hash ring
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing(object):
+    """
+    Consistent hash ring with virtual nodes, a node joining or leaving only moves the keys of its own arcs
+    """
+
+    def __init__(self, nodes, replicas=128):
+        """
+        :param nodes: ips of the nodes on the ring
+        :param replicas: amount of virtual nodes per node, more spreads keys more evenly
+        """
+        ring = sorted((point("{0}#{1}".format(node, i)), node) for node in nodes for i in range(replicas))
+        self.points = [p for p, _ in ring]
+        self.nodes = [n for _, n in ring]
+
+    def get(self, key):
+        """
+        :param key: string to place
+        :return: the node that owns the key, None if the ring is empty
+        """
+        if not self.points:
+            return None
+        return self.nodes[bisect(self.points, point(key)) % len(self.points)]
 
 
 class Scheduler(object):
@@ -38,79 +73,327 @@ class Scheduler(object):
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, storage, staleness):
+    # shuffle deals all jobs out again, hash keeps jobs on their node unless the node owning them changes,
+    # load gives nodes a share of the busy seconds of the jobs that follows their spare capacity, spread keeps the jobs that start at the
+    # same minute apart
+    placements = ('shuffle', 'hash', 'load', 'spread')
+
+    # virtual nodes per node on the hash ring
+    replicas = 128
+    # seconds of status history the load of a node is averaged over
+    load_window = 900
+    # how far a node may go over its share of the busy seconds before jobs move off it
+    hysteresis = 0.25
+    # share of its cpus a fully loaded node still counts for, so it keeps some jobs
+    idle_floor = 0.1
+    # seconds a run takes when we did not see any job run yet
+    unknown_duration = 1
+    # days jobs starting at the same minute are counted over, 7 tells the days of the week apart
+    horizon = 1
+
+    def __init__(self, storage, staleness, placement='shuffle'):
         """
         Our simplistic CronJob scheduler
         :param storage: storage class
         :param staleness: amount of seconds of non-communication to declare a node as stale
+        :param placement: how jobs are placed on nodes when re-balancing, one of placements
         """
+        if placement not in self.placements:
+            raise ValueError("unknown placement {0}, should be one of {1}".format(placement, self.placements))
         self.storage = storage
         self.staleness = staleness
+        self.placement = placement
+        # peak concurrency per node before and after the last re-balance
+        self.peaks = None
 
     def active_nodes(self):
+        now = time.time()
         for node in self.storage.cluster_state():
-            if datetime.utcnow() - parser.parse(node.time) < timedelta(seconds=self.staleness):
+            if now - node.time < self.staleness:
                 yield node
             else:
                 node.state = 'disconnected'
                 yield node
 
+    def connected_nodes(self):
+        """
+        :return: ips of the nodes we heard of within the staleness period
+        """
+        return [n.ip for n in self.active_nodes() if n.state != 'disconnected']
+
+    def orphans(self):
+        """
+        :return: list of the jobs that are not assigned, or assigned to a node that is not connected
+        """
+        connected = set(self.connected_nodes())
+        orphans = []
+        for node in self.storage.cluster_jobs.nodes():
+            if node not in connected:
+                orphans.extend(self.storage.cluster_jobs.assigned_to(node))
+        return orphans
+
     def check_cluster_state(self):
         """
         check cluster state
         :return False if invalid otherwise True
         """
-        left = list(self.storage.cluster_state())
-        right = list(self.active_nodes())
-        inactive_nodes = [i for i in left + right if i not in left or i not in right]
-        for job in self.storage.cluster_jobs:
-            if not job.assigned_to:
-                self.logger.info("detected unassigned job ({0})".format(job.command))
-                self.re_balance()
-                return False
-            if job.assigned_to in inactive_nodes:
-                self.logger.warning("detected job ({0}) on inactive node".format(job.command))
-                self.re_balance()
-                return False
+        connected = set(self.connected_nodes())
+        for node in self.storage.cluster_jobs.nodes():
+            if node in connected:
+                continue
+            jobs = self.storage.cluster_jobs.assigned_to(node)
+            if not node:
+                self.logger.info("detected unassigned job ({0})".format(jobs[0].command))
+            else:
+                self.logger.warning("detected job ({0}) on inactive node".format(jobs[0].command))
+            return False
         return True
 
-    def re_balance(self):
+    def fail_over(self, ip):
         """
-        Redistribute CronJobs over the cluster
-        """
-        def partition(lst, keys):
-            """
-            divide a list over a given set of keys
-            :param lst: list to split in roughly equals chunks
-            :param keys: keys for the chunks
-            :return: dictionary of keys with list chunks
-            """
-            shuffle(lst)
-            return {keys[i]: lst[i::len(keys)] for i in range(len(keys))}
-        
-        def first_key_by_value(dct, jb):
-            """
-            find the first key in a dictionary where jb is in the values
-            :param dct: dictionary to analyse
-            :param jb: value to search for
-            :return: key or None
-            """
-            for n, jbs in dct.items():
-                if jb in jbs:
-                    return n
-            return None
+        assign the jobs of nodes that left to the connected nodes, other jobs stay where they are. the jobs are not
+        stored, every node applies them when the Reassign message with them comes in, which updates its crontab.
+        every node detects the nodes that left, only the node with the lowest ip moves their jobs so nodes do not
+        send conflicting assignments
+        :param ip: ip of our node
+        :return: list of copies of the orphaned jobs with their new assignment and version
+        """
+        nodes = self.connected_nodes()
+        if not nodes or ip != min(nodes):
+            return []
+        jobs = self.orphans()
+        if not jobs:
+            return []
+        placement = getattr(self, "_place_{0}".format(self.placement))(jobs, nodes)
+        moved = []
+        for job, node in zip(jobs, placement):
+            self.logger.info("failing over job {0} from {1} to node {2}".format(job, job.assigned_to, node))
+            job = copy(job)
+            job.assigned_to = node
+            job.update_version()
+            moved.append(job)
+        return moved
 
-        nodes = [n for n in self.active_nodes()]
+    def re_balance(self):
+        """
+        Redistribute CronJobs over the connected nodes of the cluster. like a fail over the jobs are not stored,
+        every node applies them when the Reassign message with them comes in, which updates its crontab
+        :return: list of copies of the jobs that moved to another node with their new assignment and version
+        """
+        nodes = self.connected_nodes()
         jobs = list(self.storage.cluster_jobs)
+        if not nodes:
+            self.logger.warning("no connected nodes to assign jobs to")
+            return []
+
+        # only the nodes of the jobs change, so they start at the same minutes after placing them
+        groups = self.firings(jobs)
+        before = self.peak_concurrency(jobs, groups)
+        placement = getattr(self, "_place_{0}".format(self.placement))(jobs, nodes)
+
+        moved = []
+        placed = []
+        for job, node in zip(jobs, placement):
+            if job.assigned_to != node:
+                self.logger.info("assigning job {0} to node {1}".format(job, node))
+                job = copy(job)
+                job.assigned_to = node
+                job.update_version()
+                moved.append(job)
+            placed.append(job)
+        self.peaks = {'before': before, 'after': self.peak_concurrency(placed, groups), 'time': time.time()}
+        self.logger.info("peak concurrency per node {0[before]} before and {0[after]} after re-balancing".format(self.peaks))
+        return moved
+
+    def firings(self, jobs):
+        """
+        group jobs that start at the same minutes of our horizon
+        :param jobs: list of CronItems
+        :return: dictionary of the indices of the jobs by the minutes they start at
+        """
+        minutes = {}
+        groups = {}
+        for i, job in enumerate(jobs):
+            pattern = str(job.parts)
+            if pattern not in minutes:
+                minutes[pattern] = job.firings(self.horizon)
+            groups.setdefault(minutes[pattern], []).append(i)
+        return groups
 
-        partitions = partition(jobs, nodes)
+    def starts(self, jobs, nodes, groups=None):
+        """
+        :param jobs: list of CronItems
+        :param nodes: ips of the nodes to count
+        :param groups: the jobs grouped by firings, when known
+        :return: dictionary of the jobs starting at every minute of our horizon by node
+        """
+        starts = {node: [0] * (self.horizon * 1440) for node in nodes}
+        for minutes, indices in (groups or self.firings(jobs)).items():
+            amounts = {}
+            for i in indices:
+                node = jobs[i].assigned_to
+                if node in starts:
+                    amounts[node] = amounts.get(node, 0) + 1
+            for node, amount in amounts.items():
+                counts = starts[node]
+                for minute in minutes:
+                    counts[minute] += amount
+        return starts
 
+    def peak_concurrency(self, jobs=None, groups=None):
+        """
+        the most jobs that start at the same minute on a node
+        :param jobs: list of CronItems, all stored jobs by default
+        :param groups: the jobs grouped by firings, when known
+        :return: dictionary of peak by node, for the nodes that have jobs
+        """
+        if jobs is None:
+            jobs = list(self.storage.cluster_jobs)
+        nodes = {job.assigned_to for job in jobs if job.assigned_to}
+        return {node: max(counts) for node, counts in self.starts(jobs, nodes, groups).items()}
+
+    @staticmethod
+    def _place_shuffle(jobs, nodes):
+        """
+        deal the jobs round-robin over the nodes in a random order
+        :param jobs: list of CronItems
+        :param nodes: ips of the nodes
+        :return: the node of every job
+        """
+        order = list(range(len(jobs)))
+        shuffle(order)
+        # a random first node, so a few jobs do not always end up on the same nodes
+        offset = randrange(len(nodes))
+        placement = [None] * len(jobs)
+        for i, index in enumerate(order):
+            placement[index] = nodes[(offset + i) % len(nodes)]
+        return placement
+
+    def weights(self, nodes):
+        """
+        spare capacity of nodes, the cpus they declare minus their recent load
+        :param nodes: ips of the nodes
+        :return: dictionary of weight by node
+        """
+        weights = {}
+        for node in nodes:
+            status = self.storage.node_state(node)
+            # peers that do not declare their cpus count as one
+            cpus = status.cpus if status and status.cpus else 1
+            load = self.storage.cluster_status.load_average(node, self.load_window) or 0
+            weights[node] = max(cpus - load, cpus * self.idle_floor)
+        return weights
+
+    def busy(self, jobs, duration):
+        """
+        expected seconds a day jobs run, from the average running time of their observed runs. every job counts for at
+        least a second a day, so jobs that hardly run are still spread
+        :param jobs: list of CronItems
+        :param duration: seconds a run of a job we did not see run takes
+        :return: list of seconds
+        """
+        busy = []
         for job in jobs:
-            node = first_key_by_value(partitions, job)
-            if not node:
-                self.logger.error("could not find node assignment for job {0}".format(job))
-            else:
-                self.logger.info("assigning job {0} to node {1}".format(job, node.ip))
-                job.assigned_to = node.ip
+            starts = 0 if job.parts.special == '@reboot' else job.frequency_per_day()
+            busy.append(max(starts * (job.cost.duration if job.cost.runs else duration), 1))
+        return busy
+
+    def _place_load(self, jobs, nodes):
+        """
+        give every node a share of the expected busy seconds of all jobs by its weight. jobs stay on their node unless
+        it is over its share by more than our hysteresis, then it gives up jobs until it is back at its share. jobs
+        without a node go to the nodes furthest below their share, the busiest jobs first
+        :param jobs: list of CronItems
+        :param nodes: ips of the nodes
+        :return: the node of every job
+        """
+        stored = list(self.storage.cluster_jobs)
+        observed = [job.cost.duration for job in stored or jobs if job.cost.runs]
+        # jobs we did not see run yet take as long as the average job we did
+        duration = sum(observed) / len(observed) if observed else self.unknown_duration
+        loads = {node: 0 for node in nodes}
+        amount = 0
+        for job, seconds in zip(stored, self.busy(stored, duration)):
+            amount += seconds
+            if job.assigned_to in loads:
+                loads[job.assigned_to] += seconds
+        costs = self.busy(jobs, duration)
+        amount = max(amount, sum(costs))
+        weights = self.weights(nodes)
+        total = sum(weights.values())
+        targets = {node: amount * weights[node] / total for node in nodes}
+        relieved = {node for node in nodes if loads[node] > targets[node] * (1 + self.hysteresis)}
+        placement = []
+        homeless = []
+        for i, job in enumerate(jobs):
+            node = job.assigned_to
+            if node in loads and (node not in relieved or loads[node] <= targets[node]):
+                placement.append(node)
+                continue
+            if node in loads:
+                loads[node] -= costs[i]
+            placement.append(None)
+            homeless.append(i)
+        deficits = [(loads[node] - targets[node], node) for node in nodes]
+        heapq.heapify(deficits)
+        for i in sorted(homeless, key=lambda i: -costs[i]):
+            _, node = heapq.heappop(deficits)
+            placement[i] = node
+            loads[node] += costs[i]
+            heapq.heappush(deficits, (loads[node] - targets[node], node))
+        return placement
 
-        self.storage.cluster_jobs = jobs
+    def _place_spread(self, jobs, nodes):
+        """
+        place the jobs that start at the same minutes together, the ones starting most often first, each on the nodes
+        with the lowest peak over these minutes so far, then the fewest jobs. jobs keep their node when it gets jobs
+        starting at their minutes, so spreading the same jobs again moves nothing
+        :param jobs: list of CronItems
+        :param nodes: ips of the nodes
+        :return: the node of every job
+        """
+        placing = {job.identity for job in jobs}
+        staying = [job for job in self.storage.cluster_jobs if job.identity not in placing and job.assigned_to in nodes]
+        starts = self.starts(staying, nodes)
+        totals = {node: 0 for node in nodes}
+        for job in staying:
+            totals[job.assigned_to] += 1
+        placement = [None] * len(jobs)
+        groups = self.firings(jobs)
+        for minutes in sorted(groups, key=lambda m: (-len(m), -len(groups[m]))):
+            indices = groups[minutes]
+            # a job on a node adds one start at all of its minutes, so also one to its peak over them
+            heap = [(max((starts[node][m] for m in minutes), default=0), totals[node], node) for node in nodes]
+            heapq.heapify(heap)
+            quota = {}
+            for _ in indices:
+                peak, total, node = heapq.heappop(heap)
+                quota[node] = quota.get(node, 0) + 1
+                heapq.heappush(heap, (peak + 1, total + 1, node))
+            for node, amount in quota.items():
+                counts = starts[node]
+                for minute in minutes:
+                    counts[minute] += amount
+                totals[node] += amount
+            homeless = []
+            for i in indices:
+                node = jobs[i].assigned_to
+                if quota.get(node):
+                    quota[node] -= 1
+                    placement[i] = node
+                else:
+                    homeless.append(i)
+            free = [node for node, amount in quota.items() for _ in range(amount)]
+            for i, node in zip(homeless, free):
+                placement[i] = node
+        return placement
+
+    def _place_hash(self, jobs, nodes):
+        """
+        place every job on the node owning its identity on a consistent hash ring
+        :param jobs: list of CronItems
+        :param nodes: ips of the nodes
+        :return: the node of every job
+        """
+        ring = HashRing(nodes, self.replicas)
+        return [ring.get('\0'.join(job.identity)) for job in jobs]
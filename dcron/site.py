@@ -26,19 +26,17 @@
 import json
 import logging
 import pathlib
-import time
 from datetime import datetime
 
 import jinja2
 
 from aiohttp import web
-from dateutil import parser, tz
 import aiohttp_jinja2 as aiohttp_jinja2
 
 from dcron.cron.cronitem import CronItem
-from dcron.datagram.client import broadcast
-from dcron.protocols.messages import Kill, Run, Toggle, ReBalance
-from dcron.protocols.udpserializer import UdpSerializer
+from dcron.datagram.client import Sender
+from dcron.protocols.coalescer import Coalescer
+from dcron.protocols.messages import Kill, Reassign, Run, Toggle
 from dcron.storage import CronEncoder
 from dcron.utils import get_ip
 
@@ -52,20 +50,26 @@ class Site(object):
 
     root = pathlib.Path(__file__).parent
 
-    def __init__(self, scheduler, storage, udp_port, cron=None, user=None, hash_key=None):
+    def __init__(self, scheduler, storage, udp_port, cron=None, user=None, hash_key=None, processor=None, sender=None, coalescer=None):
         self.scheduler = scheduler
         self.storage = storage
         self.udp_port = udp_port
         self.cron = cron
         self.user = user
         self.hash_key = hash_key
+        self.processor = processor
+        self.sender = sender or Sender(udp_port)
+        self.coalescer = coalescer or Coalescer(self.sender, hash_key)
         self.app = web.Application()
-        aiohttp_jinja2.setup(self.app, loader=jinja2.PackageLoader('dcron', 'templates'))
+        aiohttp_jinja2.setup(self.app, loader=jinja2.PackageLoader('dcron', 'templates'), filters={'localtime': self.localtime})
         self.app.router.add_static('/static/', path=self.root/'static', name='static')
         self.app.add_routes([web.get('/', self.get),
                              web.get('/list_nodes', self.get_nodes),
                              web.get('/cron_in_sync', self.cron_in_sync),
                              web.get('/status', self.status),
+                             web.get('/stats', self.stats),
+                             web.get('/concurrency', self.concurrency),
+                             web.get('/node_history', self.node_history),
                              web.get('/list_jobs', self.get_jobs),
                              web.get('/jobs', self.jobs),
                              web.post('/add_job', self.add_job),
@@ -84,29 +88,56 @@ class Site(object):
 
     @aiohttp_jinja2.template('nodestable.html')
     async def get_nodes(self, request):
-        nodes = []
-        for node in self.storage.cluster_state():
-            node.time = parser.parse(node.time).astimezone(tz.tzlocal()).strftime('%d.%m.%Y %H:%M:%S')
-            nodes.append(node)
-        return dict(nodes=sorted(nodes, key=lambda n: n.ip))
+        return dict(nodes=sorted(self.storage.cluster_state(), key=lambda n: n.ip))
+
+    @staticmethod
+    def localtime(timestamp):
+        """
+        render a time in our timezone
+        :param timestamp: seconds since epoch
+        :return: formatted time
+        """
+        if timestamp is None:
+            return ''
+        return datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M:%S')
 
     async def cron_in_sync(self, request):
-        for job in self.storage.cluster_jobs:
-            if job.assigned_to == get_ip():
-                found = next(iter([j for j in self.cron.find_command(job.command) if j == job]), None)
-                if not found:
-                    return web.HTTPConflict(text="stored job {0} not matched to actual cron".format(job))
+        for job in self.storage.cluster_jobs.assigned_to(get_ip()):
+            found = next(iter([j for j in self.cron.find_command(job.command) if j == job]), None)
+            if not found:
+                return web.HTTPConflict(text="stored job {0} not matched to actual cron".format(job))
         return web.HTTPOk()
 
     async def status(self, request):
         return web.json_response(sorted(self.storage.cluster_state(), key=lambda n: n.ip), dumps=CronEncoder().default)
 
+    async def stats(self, request):
+        if not self.processor:
+            raise web.HTTPNotFound(text='no processor statistics available')
+        return web.json_response(self.processor.stats())
+
+    async def concurrency(self, request):
+        return web.json_response({'current': self.scheduler.peak_concurrency(), 're_balance': self.scheduler.peaks})
+
+    async def node_history(self, request):
+        if 'ip' not in request.query:
+            return web.Response(status=500, text='no ip submitted')
+        try:
+            start = float(request.query['start']) if 'start' in request.query else None
+            end = float(request.query['end']) if 'end' in request.query else None
+        except ValueError:
+            return web.Response(status=500, text='start and end should be seconds since epoch')
+        series = self.storage.cluster_status.series(request.query['ip'], start, end)
+        if series is None:
+            raise web.HTTPNotFound(text='node not found')
+        return web.json_response(series)
+
     @aiohttp_jinja2.template('jobstable.html')
     async def get_jobs(self, request):
-        return dict(jobs=sorted(self.storage.cluster_jobs, key=lambda j: (j.command, j.assigned_to if j.assigned_to else '*')))
+        return dict(jobs=self.storage.cluster_jobs.ordered())
 
     async def jobs(self, request):
-        return web.json_response(sorted(self.storage.cluster_jobs, key=lambda j: (j.command, j.assigned_to if j.assigned_to else '*')), dumps=CronEncoder().default)
+        return web.json_response(self.storage.cluster_jobs.ordered(), dumps=CronEncoder().default)
 
     @aiohttp_jinja2.template('joblogs.html')
     async def get_job_log(self, request):
@@ -126,23 +157,16 @@ class Site(object):
 
         self.logger.debug("returning log result")
 
-        for job in self.storage.cluster_jobs:
-            if job == cron_item:
-                return dict(job=job)
-        return dict(job=cron_item)
+        return dict(job=self.storage.cluster_jobs.get(cron_item, cron_item))
 
     async def re_balance(self, request):
         self.logger.debug("rebalance request received")
 
-        self.scheduler.re_balance()
-
-        jobs = self.storage.cluster_jobs.copy()
+        moved = self.scheduler.re_balance()
 
-        broadcast(self.udp_port, UdpSerializer.dump(ReBalance(timestamp=datetime.now()), self.hash_key))
+        self.logger.info("re-balancing moves {0} jobs".format(len(moved)))
 
-        time.sleep(5)
-        for job in jobs:
-            broadcast(self.udp_port, UdpSerializer.dump(job, self.hash_key))
+        await self.coalescer.send(Reassign.of(moved))
 
         raise web.HTTPAccepted()
 
@@ -166,7 +190,7 @@ class Site(object):
 
         self.logger.debug("broadcasting kill result")
 
-        broadcast(self.udp_port, UdpSerializer.dump(Kill(cron_item), self.hash_key))
+        await self.coalescer.send([Kill(cron_item)])
 
         raise web.HTTPAccepted()
 
@@ -190,7 +214,7 @@ class Site(object):
 
         self.logger.debug("broadcasting run result")
 
-        broadcast(self.udp_port, UdpSerializer.dump(Run(cron_item), self.hash_key))
+        await self.coalescer.send([Run(cron_item)])
 
         raise web.HTTPAccepted()
 
@@ -214,7 +238,7 @@ class Site(object):
 
         self.logger.debug("broadcasting run result")
 
-        broadcast(self.udp_port, UdpSerializer.dump(Toggle(cron_item), self.hash_key))
+        await self.coalescer.send([Toggle(cron_item)])
 
         raise web.HTTPAccepted()
 
@@ -239,9 +263,11 @@ class Site(object):
         if cron_item in self.storage.cluster_jobs:
             raise web.HTTPConflict(text='job already exists')
 
+        cron_item.update_version()
+
         self.logger.debug("broadcasting add result")
 
-        broadcast(self.udp_port, UdpSerializer.dump(cron_item, self.hash_key))
+        await self.coalescer.send([cron_item])
 
         raise web.HTTPCreated()
 
@@ -260,12 +286,16 @@ class Site(object):
 
         cron_item = self.generate_cron_item(data, removable=True)
 
-        if cron_item not in self.storage.cluster_jobs:
+        job = self.storage.cluster_jobs.get(cron_item)
+        if not job:
             raise web.HTTPConflict(text='job not found')
 
+        cron_item.version = job.version
+        cron_item.update_version()
+
         self.logger.debug("broadcasting remove result")
 
-        broadcast(self.udp_port, UdpSerializer.dump(cron_item, self.hash_key))
+        await self.coalescer.send([cron_item])
 
         raise web.HTTPAccepted()
 
@@ -301,8 +331,9 @@ class Site(object):
                     cron_item = CronItem(command=line['command'])
                     cron_item.set_all(line['pattern'])
                     cron_item.enable(line['enabled'])
+                    cron_item.update_version()
                     self.logger.debug("received new job from import {0}, broadcasting it.".format(cron_item))
-                    broadcast(self.udp_port, UdpSerializer.dump(cron_item, self.hash_key))
+                    await self.coalescer.send([cron_item])
                 else:
                     self.logger.error("import element invalid: {0}".format(line))
             return web.HTTPOk()
@@ -24,104 +24,1061 @@
 # SOFTWARE.
 
 import asyncio
+import gc
 import logging
 import json
+import itertools
 import os
+import time
 
-from datetime import datetime
+from array import array
+from copy import copy
+
+from datetime import datetime, timezone
 from dateutil import parser
 from json import JSONEncoder, JSONDecoder
 
 from os.path import join, exists
 
-import aiofiles
-
+from dcron.cost import Cost
 from dcron.cron.cronitem import CronItem
 from dcron.cron.crontab import CronTab
-from dcron.protocols.messages import Status
+from dcron.protocols.messages import Digest, Status
+from dcron.records import RecordSerializer
+
+
+class Tombstones(object):
+    """
+    Jobs that were removed, by identity. They are kept for a while, so versions of them a peer that missed the removal
+    still sends are not stored again.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+
+    def add(self, job, identity=None, now=None):
+        """
+        :param job: CronItem that was removed
+        :param identity: identity of the job, if it is known already
+        :param now: time of the removal in seconds since epoch
+        :return: the tombstone, a copy of the job marked as removed
+        """
+        key = job.identity if identity is None else identity
+        existing = self._jobs.get(key)
+        if existing and existing[0].version >= job.version:
+            return existing[0]
+        tombstone = copy(job)
+        tombstone.remove = True
+        self._jobs[key] = (tombstone, time.time() if now is None else now)
+        return tombstone
+
+    def get(self, identity):
+        found = self._jobs.get(identity)
+        return found[0] if found else None
+
+    def discard(self, identity):
+        return self._jobs.pop(identity, (None,))[0]
+
+    def expire(self, before):
+        """
+        :param before: seconds since epoch before which tombstones are forgotten
+        :return: list of the forgotten tombstones
+        """
+        expired = [key for key, (_, removed) in self._jobs.items() if removed < before]
+        return [self._jobs.pop(key)[0] for key in expired]
+
+    def removals(self):
+        """
+        :return: list of the tombstones and the time they were removed
+        """
+        return list(self._jobs.values())
+
+    def __iter__(self):
+        return iter([tombstone for tombstone, _ in self._jobs.values()])
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+class JobDigest(object):
+    """
+    Digest buckets of the jobs and tombstones of a store, kept up to date as the store changes, so a digest is not
+    built from every job each time a peer sends theirs
+    """
+
+    def __init__(self, size=Digest.size):
+        """
+        :param size: amount of buckets
+        """
+        self.size = size
+        self.buckets = [0] * size
+        # bucket and hash of every identity
+        self._hashes = {}
+
+    def set(self, identity, job):
+        """
+        :param identity: identity of the job
+        :param job: the stored CronItem, or its tombstone
+        """
+        self.add(identity, *Digest.job_hash(job))
+
+    def add(self, identity, key, value):
+        """
+        :param identity: identity of the job
+        :param key: identity hash of the job
+        :param value: version hash of the job
+        """
+        self.discard(identity)
+        bucket = key % self.size
+        self.buckets[bucket] ^= value
+        self._hashes[identity] = (bucket, value)
+
+    def identities(self, buckets):
+        """
+        :param buckets: bucket indices
+        :return: list of the identities hashed into the buckets
+        """
+        return [identity for identity, (bucket, _) in self._hashes.items() if bucket in buckets]
+
+    def discard(self, identity):
+        found = self._hashes.pop(identity, None)
+        if found:
+            self.buckets[found[0]] ^= found[1]
+
+    def clear(self):
+        self.buckets = [0] * self.size
+        self._hashes.clear()
+
+
+class DigestStore(object):
+    """
+    Tombstones of removed jobs and the digest buckets of the jobs and tombstones of a job store, shared by our job
+    stores. They find stored jobs by identity with _find and list them with copy.
+    """
+
+    journal = None
+
+    def __init__(self):
+        self._tombstones = Tombstones()
+        self._digest = JobDigest()
+
+    def _find(self, identity):
+        raise NotImplementedError()
+
+    def _entomb(self, identity, job, version):
+        """
+        keep a tombstone of a removed job
+        :param identity: identity of the job
+        :param job: CronItem that was removed
+        :param version: version of the stored job, the tombstone gets the newest version
+        """
+        if version > job.version:
+            job = copy(job)
+            job.version = version
+        self._digest.set(identity, self._tombstones.add(job, identity))
+
+    def _reset_digest(self):
+        # tombstones are kept, so removed jobs do not come back when jobs are resent
+        self._digest.clear()
+        for tombstone in self._tombstones:
+            self._digest.set(tombstone.identity, tombstone)
+
+    def bury(self, job, removed=None):
+        """
+        keep a tombstone of a job we did not have when it was removed
+        :param job: CronItem
+        :param removed: time of the removal in seconds since epoch, now by default
+        """
+        key = job.identity
+        self._digest.set(key, self._tombstones.add(job, key, removed))
+        if self.journal:
+            self.journal.record('remove', job)
+
+    def tombstone(self, job):
+        """
+        :param job: CronItem with the identity to look for
+        :return: the tombstone of the removed job with the same identity, None if it was not removed
+        """
+        return self._tombstones.get(job.identity)
+
+    def tombstones(self):
+        """
+        :return: list of the tombstones of removed jobs
+        """
+        return list(self._tombstones)
+
+    def removals(self):
+        """
+        :return: list of the tombstones of removed jobs and the time they were removed
+        """
+        return self._tombstones.removals()
+
+    def expire(self, before):
+        """
+        forget jobs that were removed a while ago
+        :param before: seconds since epoch
+        """
+        for tombstone in self._tombstones.expire(before):
+            self._digest.discard(tombstone.identity)
+
+    def digest(self, ip=None, size=None):
+        """
+        :param ip: ip address to put in the digest
+        :param size: amount of buckets, our own amount is kept up to date
+        :return: Digest of our jobs and tombstones
+        """
+        if size and size != self._digest.size:
+            return Digest.of(ip, self.copy() + self.tombstones(), size)
+        return Digest(ip, list(self._digest.buckets))
+
+    def hashed_into(self, buckets, size=None):
+        """
+        :param buckets: bucket indices of a digest
+        :param size: amount of buckets of the digest
+        :return: list of our jobs and tombstones hashed into the buckets
+        """
+        if size and size != self._digest.size:
+            return [job for job in self.copy() + self.tombstones() if Digest.bucket(job, size) in buckets]
+        return [self._find(identity) or self._tombstones.get(identity) for identity in self._digest.identities(buckets)]
+
+
+class JobStore(DigestStore):
+    """
+    Jobs of the cluster keyed by their identity (command and normalised schedule), with indexes by node and by
+    enabled state. It behaves like the list it replaces, but a job is stored only once and lookups are O(1).
+    Jobs should be added again after changing their assignment or enabled state, to keep the indexes up to date.
+    """
+
+    def __init__(self, jobs=None, journal=None):
+        """
+        :param jobs: jobs to start with
+        :param journal: Journal to record our mutations in
+        """
+        super(JobStore, self).__init__()
+        self.journal = journal
+        self._jobs = {}
+        self._by_node = {}
+        self._by_enabled = {True: {}, False: {}}
+        # where a job was indexed, jobs can be changed after they were stored
+        self._indexed = {}
+        for job in jobs or []:
+            self.append(job)
+
+    def _index(self, key, job):
+        node, enabled = job.assigned_to, bool(job.enabled)
+        self._by_node.setdefault(node, {})[key] = job
+        self._by_enabled[enabled][key] = job
+        self._indexed[key] = (node, enabled)
+
+    def _unindex(self, key):
+        node, enabled = self._indexed.pop(key)
+        jobs = self._by_node[node]
+        del jobs[key]
+        if not jobs:
+            del self._by_node[node]
+        del self._by_enabled[enabled][key]
+
+    def _find(self, identity):
+        return self._jobs.get(identity)
+
+    def get(self, job, default=None):
+        """
+        :param job: CronItem with the identity to look for
+        :return: the stored job with the same identity
+        """
+        return self._jobs.get(job.identity, default)
+
+    def append(self, job, identity=None):
+        """
+        store a job, replacing the stored job with the same identity
+        :param job: CronItem
+        :param identity: identity of the job, if it is known already
+        """
+        key = job.identity if identity is None else identity
+        existing = self._jobs.pop(key, None)
+        if existing is not None:
+            self._unindex(key)
+        self._tombstones.discard(key)
+        self._jobs[key] = job
+        self._index(key, job)
+        self._digest.set(key, job)
+        if self.journal:
+            self.journal.record('job', job)
+
+    def extend(self, jobs):
+        for job in jobs:
+            self.append(job)
+
+    def remove(self, job):
+        """
+        remove the stored job with the same identity, and keep a tombstone of it
+        :param job: CronItem
+        :raises ValueError: when there is no such job
+        """
+        key = job.identity
+        existing = self._jobs.pop(key, None)
+        if existing is None:
+            raise ValueError("{0} not in job store".format(job))
+        self._unindex(key)
+        self._entomb(key, job, existing.version)
+        if self.journal:
+            self.journal.record('remove', existing)
+
+    def clear(self):
+        self._jobs.clear()
+        self._by_node.clear()
+        self._indexed.clear()
+        for jobs in self._by_enabled.values():
+            jobs.clear()
+        self._reset_digest()
+        if self.journal:
+            self.journal.record('clear', 'jobs')
+
+    def copy(self):
+        """
+        :return: list of our jobs
+        """
+        return list(self._jobs.values())
+
+    def assigned_to(self, node):
+        """
+        :param node: ip of the node, None for unassigned jobs
+        :return: list of the jobs assigned to the node
+        """
+        return list(self._by_node.get(node, {}).values())
+
+    def nodes(self):
+        """
+        :return: the nodes jobs are assigned to, None for unassigned jobs
+        """
+        return list(self._by_node.keys())
+
+    def enabled(self, state=True):
+        """
+        :param state: enabled state to look for
+        :return: list of the jobs with the given enabled state
+        """
+        return list(self._by_enabled[bool(state)].values())
+
+    def ordered(self):
+        """
+        :return: list of our jobs sorted by command and the node they are assigned to
+        """
+        return sorted(self._jobs.values(), key=lambda j: (j.command, j.assigned_to if j.assigned_to else '*'))
+
+    def __contains__(self, job):
+        return isinstance(job, CronItem) and job.identity in self._jobs
+
+    def __iter__(self):
+        # a snapshot, so jobs can be added and removed while iterating
+        return iter(list(self._jobs.values()))
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __getitem__(self, index):
+        return self.copy()[index]
+
+
+def epoch(time):
+    """
+    parse the time of a status message once, to seconds since epoch
+    :param time: seconds since epoch, ISO formatted string or datetime
+    :return: float
+    """
+    if isinstance(time, (int, float)):
+        return float(time)
+    if isinstance(time, datetime):
+        return time.timestamp()
+    try:
+        return datetime.fromisoformat(time).timestamp()
+    except ValueError:
+        return parser.parse(time).timestamp()
+
+
+class Rollup(object):
+    """
+    Fixed capacity ring buffer of min/avg/max buckets of a fixed width, for keeping load history at lower resolution
+    """
+
+    def __init__(self, width, capacity):
+        """
+        :param width: width of a bucket in seconds
+        :param capacity: maximum amount of buckets to keep, older buckets are overwritten
+        """
+        self.width = width
+        self.capacity = capacity
+        self.starts = array('d', bytes(8 * capacity))
+        self.mins = array('d', bytes(8 * capacity))
+        self.maxs = array('d', bytes(8 * capacity))
+        self.sums = array('d', bytes(8 * capacity))
+        self.counts = array('L', bytes(array('L').itemsize * capacity))
+        self.start = 0
+        self.count = 0
+
+    def _slot(self, i):
+        return (self.start + i) % self.capacity
+
+    def add(self, time, load):
+        """
+        account a load in the bucket of its time, loads older than our oldest bucket are ignored
+        :param time: seconds since epoch
+        :param load: load of the node
+        """
+        if load != load:
+            return
+        bucket = time - time % self.width
+        for i in range(self.count - 1, -1, -1):
+            index = self._slot(i)
+            if self.starts[index] == bucket:
+                self.mins[index] = min(self.mins[index], load)
+                self.maxs[index] = max(self.maxs[index], load)
+                self.sums[index] += load
+                self.counts[index] += 1
+                return
+            if self.starts[index] < bucket:
+                if i != self.count - 1:
+                    # a gap in between buckets we have, not worth shifting buckets for
+                    return
+                break
+        else:
+            if self.count:
+                return
+        self._append(bucket, load, load, load, 1)
+
+    def _append(self, bucket, minimum, maximum, total, count):
+        if self.count == self.capacity:
+            index = self.start
+            self.start = self._slot(1)
+        else:
+            index = self._slot(self.count)
+            self.count += 1
+        self.starts[index] = bucket
+        self.mins[index] = minimum
+        self.maxs[index] = maximum
+        self.sums[index] = total
+        self.counts[index] = count
+
+    def oldest(self):
+        """
+        :return: start of our oldest bucket, None if we have none
+        """
+        return self.starts[self.start] if self.count else None
+
+    def __iter__(self):
+        """
+        :return: (start, min, avg, max) tuples, oldest first
+        """
+        for i in range(self.count):
+            index = self._slot(i)
+            yield self.starts[index], self.mins[index], self.sums[index] / self.counts[index], self.maxs[index]
+
+    def __len__(self):
+        return self.count
+
+    def dump(self):
+        """
+        :return: list of [start, min, max, sum, count] rows, oldest first
+        """
+        return [[self.starts[i], self.mins[i], self.maxs[i], self.sums[i], self.counts[i]] for i in map(self._slot, range(self.count))]
+
+    def load(self, rows):
+        """
+        replace our buckets
+        :param rows: list of [start, min, max, sum, count] rows, oldest first
+        """
+        self.start = self.count = 0
+        for row in rows[-self.capacity:]:
+            self._append(*row)
+
+
+class NodeHistory(object):
+    """
+    Fixed capacity ring buffer with the loads reported by a node and when they were reported, and rollups of them
+    that go back further in time
+    """
+
+    def __init__(self, ip, capacity, minutes=1440, hours=1008):
+        """
+        :param ip: ip of the node
+        :param capacity: maximum amount of heartbeats to keep, older heartbeats are overwritten
+        :param minutes: amount of 1 minute buckets to keep (default: a day)
+        :param hours: amount of 1 hour buckets to keep (default: six weeks)
+        """
+        self.ip = ip
+        self.rollups = (Rollup(60, minutes), Rollup(3600, hours))
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.loads = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+        self.latest = None
+        self.latest_time = None
+        # when we first heard of the node, no resolution goes back further than this
+        self.first_time = None
+
+    def append(self, status, time, rollup=True):
+        """
+        :param status: Status message of the node
+        :param time: time of the message in seconds since epoch
+        :param rollup: account the load in our rollups, not needed when the rollups are restored afterwards
+        :return: True if a heartbeat was overwritten
+        """
+        full = self.count == self.capacity
+        if full:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        else:
+            index = (self.start + self.count) % self.capacity
+            self.count += 1
+        if self.first_time is None or time < self.first_time:
+            self.first_time = time
+        self.times[index] = time
+        self.loads[index] = float('nan') if status.system_load is None else status.system_load
+        if rollup:
+            for r in self.rollups:
+                r.add(time, self.loads[index])
+        if self.latest is None or time >= self.latest_time:
+            self.latest = status
+            self.latest_time = time
+        return full
+
+    def __iter__(self):
+        """
+        :return: (time, load) tuples, oldest first
+        """
+        for i in range(self.count):
+            index = (self.start + i) % self.capacity
+            yield self.times[index], self.loads[index]
+
+    def __len__(self):
+        return self.count
+
+    def load_average(self, window):
+        """
+        :param window: seconds before our latest heartbeat to average over
+        :return: average load of the node in the window, None if it reported none
+        """
+        total = count = 0
+        for i in range(self.count - 1, -1, -1):
+            index = (self.start + i) % self.capacity
+            if self.times[index] < self.latest_time - window:
+                break
+            if self.loads[index] == self.loads[index]:
+                total += self.loads[index]
+                count += 1
+        return total / count if count else None
+
+    def series(self, start, end, max_points):
+        """
+        load of the node in a time range, at the finest resolution that goes back far enough and fits in max_points
+        :param start: start of the range in seconds since epoch
+        :param end: end of the range in seconds since epoch
+        :param max_points: maximum amount of points to return
+        :return: resolution in seconds (0 for heartbeats) and list of (time, min, avg, max) tuples
+        """
+        start = max(start, self.first_time) if self.first_time is not None else start
+        raw = [(t, l, l, l) for t, l in self if start <= t <= end and l == l]
+        if self.count and self.times[self.start] <= start and len(raw) <= max_points:
+            return 0, raw
+        for rollup in self.rollups:
+            oldest = rollup.oldest()
+            if (oldest is not None and oldest <= start or rollup is self.rollups[-1]) and (end - start) / rollup.width <= max_points:
+                return rollup.width, [b for b in rollup if start - rollup.width < b[0] <= end]
+        rollup = self.rollups[-1]
+        return rollup.width, [b for b in rollup if start - rollup.width < b[0] <= end][-max_points:]
+
+
+class StatusStore(object):
+    """
+    Status history of the cluster in a ring buffer per node, with the latest state of every node at hand.
+    It behaves like the list of Status messages it replaces.
+    """
+
+    def __init__(self, capacity=720, minutes=1440, hours=1008, journal=None):
+        """
+        :param capacity: amount of heartbeats to keep per node (default: an hour at the default broadcast interval)
+        :param minutes: amount of 1 minute min/avg/max buckets to keep per node (default: a day)
+        :param hours: amount of 1 hour min/avg/max buckets to keep per node (default: six weeks)
+        :param journal: Journal to record our mutations in
+        """
+        self.journal = journal
+        self.capacity = capacity
+        self.minutes = minutes
+        self.hours = hours
+        self._nodes = {}
+        self._count = 0
+
+    def append(self, status, rollup=True):
+        """
+        :param status: Status message
+        :param rollup: account the load in the rollups of the node
+        """
+        node = self._nodes.get(status.ip)
+        if node is None:
+            node = self._nodes[status.ip] = NodeHistory(status.ip, self.capacity, self.minutes, self.hours)
+        if not isinstance(status.time, float):
+            # statuses of legacy peers and older caches carry ISO formatted times
+            status.time = epoch(status.time)
+        if not node.append(status, status.time, rollup):
+            self._count += 1
+        if self.journal:
+            self.journal.record('status', status)
+
+    def extend(self, statuses, rollup=True):
+        for status in statuses:
+            self.append(status, rollup)
+
+    def latest(self, ip):
+        """
+        :param ip: ip of the node
+        :return: the most recent Status message of the node, None if unknown
+        """
+        node = self._nodes.get(ip)
+        return node.latest if node else None
+
+    def nodes(self):
+        """
+        :return: ips of the nodes we know
+        """
+        return list(self._nodes.keys())
+
+    def history(self, ip):
+        """
+        :param ip: ip of the node
+        :return: list of (time, load) tuples we kept for the node, oldest first
+        """
+        node = self._nodes.get(ip)
+        return list(node) if node else []
+
+    def load_average(self, ip, window=900):
+        """
+        recent load of a node, a single busy heartbeat does not make a busy node
+        :param ip: ip of the node
+        :param window: seconds before the latest heartbeat of the node to average over
+        :return: average load, None if unknown
+        """
+        node = self._nodes.get(ip)
+        return node.load_average(window) if node else None
+
+    def series(self, ip, start=None, end=None, max_points=1000):
+        """
+        load history of a node, at a resolution that fits the time range
+        :param ip: ip of the node
+        :param start: start of the range in seconds since epoch (default: an hour before end)
+        :param end: end of the range in seconds since epoch (default: now)
+        :param max_points: maximum amount of points to return
+        :return: dictionary with resolution in seconds (0 for heartbeats) and list of [time, min, avg, max] points
+        """
+        end = datetime.now().timestamp() if end is None else end
+        start = end - 3600 if start is None else start
+        node = self._nodes.get(ip)
+        if node is None:
+            return None
+        resolution, points = node.series(start, end, max_points)
+        return {'resolution': resolution, 'points': [list(p) for p in points]}
+
+    def dump_rollups(self):
+        """
+        :return: dictionary with the rollups of every node, for saving them
+        """
+        return {ip: dict({str(r.width): r.dump() for r in node.rollups}, first=node.first_time) for ip, node in self._nodes.items()}
+
+    def load_rollups(self, data):
+        """
+        restore saved rollups
+        :param data: dictionary made by dump_rollups
+        """
+        for ip, rollups in data.items():
+            node = self._nodes.get(ip)
+            if node is None:
+                node = self._nodes[ip] = NodeHistory(ip, self.capacity, self.minutes, self.hours)
+            for rollup in node.rollups:
+                rollup.load(rollups.get(str(rollup.width), []))
+            first = rollups.get('first')
+            if first is not None and (node.first_time is None or first < node.first_time):
+                node.first_time = first
+
+    def clear(self):
+        self._nodes.clear()
+        self._count = 0
+        if self.journal:
+            self.journal.record('clear', 'status')
+
+    def copy(self):
+        """
+        :return: list of Status messages rebuilt from our history, the latest message of every node is kept as is
+        """
+        result = []
+        for node in self._nodes.values():
+            for time, load in node:
+                if time == node.latest_time:
+                    continue
+                status = Status(node.ip, None if load != load else load)
+                status.time = time
+                result.append(status)
+            result.append(node.latest)
+        return result
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self):
+        return self._count
+
+
+class Journal(object):
+    """
+    Append-only log of the mutations of our stores, one JSON record per line. Records are buffered and written with a
+    single fsync per commit, so a burst of mutations costs one disk flush.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, path):
+        """
+        :param path: file to append our records to
+        """
+        self.path = path
+        self.size = os.stat(path).st_size if exists(path) else 0
+        self.records = 0
+        self.commits = 0
+        self._pending = []
+        self._handle = None
+        # crontabs of replayed jobs, so they are created once
+        self._crontabs = {}
+
+    def record(self, kind, value):
+        """
+        buffer a mutation until the next commit
+        :param kind: kind of mutation (job, remove, status or clear)
+        :param value: the job or status that changed, or which store was cleared
+        """
+        # encode now, jobs are changed in place after they were stored
+        if kind in ('job', 'remove'):
+            value = RecordSerializer().dump_jobs([value])
+        elif kind == 'status':
+            value = RecordSerializer.status(value)
+        self._pending.append(json.dumps({kind: value}) + '\n')
+
+    def pending(self):
+        """
+        :return: amount of records not committed yet
+        """
+        return len(self._pending)
+
+    def discard(self):
+        """
+        forget the records not committed yet, a snapshot of the stores they changed makes them redundant
+        """
+        self._pending = []
+
+    def _write(self, data):
+        if self._handle is None:
+            self._handle = open(self.path, 'a')
+        self._handle.write(data)
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+    async def commit(self):
+        """
+        write and fsync all buffered records at once
+        """
+        if not self._pending:
+            return
+        records, self._pending = self._pending, []
+        data = ''.join(records)
+        await asyncio.get_event_loop().run_in_executor(None, self._write, data)
+        self.size += len(data)
+        self.records += len(records)
+        self.commits += 1
+
+    def truncate(self):
+        """
+        drop the committed records, after a snapshot made them redundant
+        """
+        self.close()
+        with open(self.path, 'w') as handle:
+            os.fsync(handle.fileno())
+        self.size = 0
+
+    def replay(self):
+        """
+        :return: generator of (kind, value) tuples of the committed records, a torn last record is skipped
+        """
+        if not exists(self.path):
+            return
+        with open(self.path, 'r') as handle:
+            for line in handle:
+                try:
+                    kind, value = next(iter(json.loads(line).items()))
+                except ValueError:
+                    self.logger.warning("skipping incomplete journal record in {0}".format(self.path))
+                    continue
+                if kind in ('job', 'remove'):
+                    value = RecordSerializer.load_jobs(value, self._crontabs)[0]
+                elif kind == 'status':
+                    value = RecordSerializer.load_status(value)
+                yield kind, value
+
+    def stats(self):
+        """
+        :return: dictionary with our size in bytes, pending records, committed records and commits
+        """
+        return {'size': self.size, 'pending': len(self._pending), 'records': self.records, 'commits': self.commits}
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+
+def write_atomically(path, data):
+    """
+    replace a file by writing a temporary file first, so a crash leaves either the old or the new file
+    :param path: file to write
+    :param data: string to write
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as handle:
+        handle.write(data)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmp, path)
+
+
+def sync_directory(path):
+    """
+    fsync a directory, so renames in it are durable
+    :param path: the directory
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 class Storage(object):
     """
-    Our storage abstraction
+    Our storage abstraction, snapshots of our stores on disk with a journal of the mutations since
     """
 
     logger = logging.getLogger(__name__)
 
+    # minimum journal size in bytes before we write a new snapshot, a snapshot is also postponed until the journal
+    # outgrows the previous one, so disk writes follow the rate of change rather than the size of our state
+    snapshot_threshold = 1024 * 1024
+
     def __init__(self, path_prefix=None):
         """
         our storage class
         :param path_prefix: directory where to save our storage
         """
-        self.cluster_status = []
-        self.cluster_jobs = []
+        self._cluster_status = StatusStore()
+        self._cluster_jobs = JobStore()
         self.path_prefix = path_prefix
+        self.journal = None
+        self.snapshot_size = 0
+        self._lock = None
         if self.path_prefix:
-            path = join(self.path_prefix, 'cluster_status.json')
-            if not exists(path):
-                self.logger.info("no previous cache detected on {0}".format(path))
-            elif os.stat(path).st_size == 0:
-                self.logger.error("{0} size is zero, something went wrong while saving it! deleting the emtpy file".format(path))
-                os.remove(path)
-            else:
-                self.logger.debug("loading cache from {0}".format(path))
-                with open(path, 'r') as handle:
-                    self.cluster_status = json.loads(handle.readline(), cls=CronDecoder)
-            path = join(self.path_prefix, 'cluster_jobs.json')
-            if not exists(path):
-                self.logger.info("no previous cache detected on {0}".format(path))
-            elif os.stat(path).st_size == 0:
-                self.logger.error("{0} size is zero, something went wrong while saving it! deleting the emtpy file".format(path))
-                os.remove(path)
-            else:
-                self.logger.debug("loading cache from {0}".format(path))
-                with open(path, 'r') as handle:
-                    self.cluster_jobs = json.loads(handle.readline(), cls=CronDecoder)
+            # loading creates many objects that live on, collecting garbage in between only slows it down
+            collecting = gc.isenabled()
+            gc.disable()
+            try:
+                self.restore()
+            finally:
+                if collecting:
+                    gc.enable()
+            self._cluster_status.journal = self.journal
+            self._cluster_jobs.journal = self.journal
+
+    def restore(self):
+        """
+        load the snapshot in our path and replay the journal
+        """
+        history = join(self.path_prefix, 'cluster_history.json')
+        path = join(self.path_prefix, 'cluster_status.json')
+        if not exists(path):
+            self.logger.info("no previous cache detected on {0}".format(path))
+        elif os.stat(path).st_size == 0:
+            self.logger.error("{0} size is zero, something went wrong while saving it! deleting the emtpy file".format(path))
+            os.remove(path)
+        else:
+            self.logger.debug("loading cache from {0}".format(path))
+            self.snapshot_size += os.stat(path).st_size
+            with open(path, 'r') as handle:
+                statuses = self.decode(handle.readline(), RecordSerializer.load_statuses)
+            # the saved rollups replace the ones we would build from these statuses
+            self._cluster_status.extend(statuses, rollup=not exists(history) or os.stat(history).st_size == 0)
+        path = history
+        if exists(path) and os.stat(path).st_size > 0:
+            self.logger.debug("loading load history from {0}".format(path))
+            self.snapshot_size += os.stat(path).st_size
+            with open(path, 'r') as handle:
+                self.cluster_status.load_rollups(json.loads(handle.readline()))
+        path = join(self.path_prefix, 'cluster_jobs.json')
+        if not exists(path):
+            self.logger.info("no previous cache detected on {0}".format(path))
+        elif os.stat(path).st_size == 0:
+            self.logger.error("{0} size is zero, something went wrong while saving it! deleting the emtpy file".format(path))
+            os.remove(path)
+        else:
+            self.logger.debug("loading cache from {0}".format(path))
+            self.snapshot_size += os.stat(path).st_size
+            identities = []
+            tombstones = []
+            with open(path, 'r') as handle:
+                jobs = self.decode(handle.readline(), lambda data: RecordSerializer.load_jobs(data, identities=identities, tombstones=tombstones))
+            for job, identity in itertools.zip_longest(jobs, identities):
+                self._cluster_jobs.append(job, identity)
+            for job, removed in tombstones:
+                self._cluster_jobs.bury(job, removed)
+        self.journal = Journal(join(self.path_prefix, 'cluster_journal.log'))
+        self.replay()
+
+    @staticmethod
+    def decode(line, loader):
+        """
+        :param line: a cache file
+        :param loader: function to turn the decoded records into objects
+        :return: list of the objects in the cache file
+        """
+        if line.startswith('['):
+            # caches saved before we had flat records
+            return json.loads(line, cls=CronDecoder)
+        return loader(json.loads(line))
+
+    def replay(self):
+        """
+        apply the journal to the snapshot we loaded, records of mutations the snapshot already has are harmless
+        """
+        replayed = 0
+        # a crash between writing a snapshot and truncating the journal leaves statuses the snapshot has
+        known = {ip: self._cluster_status.latest(ip).time for ip in self._cluster_status.nodes()}
+        for kind, value in self.journal.replay():
+            replayed += 1
+            if kind == 'job':
+                self._cluster_jobs.append(value)
+            elif kind == 'remove':
+                if value in self._cluster_jobs:
+                    self._cluster_jobs.remove(value)
+                else:
+                    self._cluster_jobs.bury(value)
+            elif kind == 'status':
+                if value.ip not in known or value.time > known[value.ip]:
+                    self._cluster_status.append(value)
+            elif kind == 'clear' and value == 'jobs':
+                self._cluster_jobs.clear()
+            elif kind == 'clear' and value == 'status':
+                self._cluster_status.clear()
+                known.clear()
+        if replayed:
+            self.logger.info("replayed {0} journal records from {1}".format(replayed, self.journal.path))
+
+    @property
+    def cluster_status(self):
+        """
+        :return: StatusStore with the status history of the cluster
+        """
+        return self._cluster_status
+
+    @cluster_status.setter
+    def cluster_status(self, statuses):
+        if isinstance(statuses, StatusStore):
+            self._cluster_status = statuses
+            if self.journal:
+                self.journal.record('clear', 'status')
+                for status in statuses.copy():
+                    self.journal.record('status', status)
+                statuses.journal = self.journal
+            return
+        statuses = list(statuses)
+        self._cluster_status.clear()
+        self._cluster_status.extend(statuses)
+
+    @property
+    def cluster_jobs(self):
+        """
+        :return: JobStore with the jobs of the cluster
+        """
+        return self._cluster_jobs
+
+    @cluster_jobs.setter
+    def cluster_jobs(self, jobs):
+        jobs = list(jobs)
+        self._cluster_jobs.clear()
+        self._cluster_jobs.extend(jobs)
+
+    async def commit(self):
+        """
+        make the mutations since the last commit durable
+        """
+        if self.journal:
+            async with self.lock:
+                await self.journal.commit()
+
+    @property
+    def lock(self):
+        """
+        :return: lock that serializes our writes, created on first use so it belongs to the event loop running us
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def needs_snapshot(self):
+        """
+        :return: True if the journal grew large enough to be compacted into a snapshot
+        """
+        return self.journal is not None and self.journal.size > max(self.snapshot_threshold, self.snapshot_size)
+
+    def _write_snapshot(self, files):
+        for path, data in files:
+            write_atomically(path, data)
+        sync_directory(self.path_prefix)
 
     async def save(self):
         """
-        save our cache to disk
+        save a snapshot of our cache to disk, and truncate the journal it makes redundant
         """
         self.logger.debug("auto-save")
         if self.path_prefix:
-            path = join(self.path_prefix, 'cluster_status.json')
-            cluster_status = self.cluster_status.copy()
-            if cluster_status:
-                self.logger.debug("saving status cache to {0}".format(path))
-                async with aiofiles.open(path, 'w') as handle:
-                    await handle.write(json.dumps(cluster_status, cls=CronEncoder))
-            else:
-                self.logger.debug("cluster status empty, not saving it.")
-            path = join(self.path_prefix, 'cluster_jobs.json')
-            cluster_jobs = self.cluster_jobs.copy()
-            if cluster_jobs:
-                self.logger.debug("saving job cache to {0}".format(path))
-                async with aiofiles.open(path, 'w') as handle:
-                    await handle.write(json.dumps(cluster_jobs, cls=CronEncoder))
-            else:
-                self.logger.debug("cluster jobs empty, not saving it.")
+            async with self.lock:
+                files = []
+                cluster_status = self.cluster_status.copy()
+                if cluster_status:
+                    files.append((join(self.path_prefix, 'cluster_status.json'), json.dumps(RecordSerializer.dump_statuses(cluster_status))))
+                else:
+                    self.logger.debug("cluster status empty, not saving it.")
+                cluster_history = self.cluster_status.dump_rollups()
+                if cluster_history:
+                    files.append((join(self.path_prefix, 'cluster_history.json'), json.dumps(cluster_history)))
+                cluster_jobs = self.cluster_jobs.copy()
+                # tombstones are saved with the jobs, so peers that missed a removal do not bring the job back
+                removals = self.cluster_jobs.removals()
+                if cluster_jobs or removals:
+                    files.append((join(self.path_prefix, 'cluster_jobs.json'), json.dumps(RecordSerializer().dump_jobs(cluster_jobs, removals))))
+                else:
+                    self.logger.debug("cluster jobs empty, not saving it.")
+                    path = join(self.path_prefix, 'cluster_jobs.json')
+                    if exists(path):
+                        # an empty job list is not saved, so a removed last job should not come back
+                        files.append((path, json.dumps(RecordSerializer().dump_jobs([]))))
+                # the snapshot has everything up to here, mutations made while writing it stay in the journal
+                self.journal.discard()
+                for path, _ in files:
+                    self.logger.debug("saving snapshot to {0}".format(path))
+                await asyncio.get_event_loop().run_in_executor(None, self._write_snapshot, files)
+                self.snapshot_size = sum(len(data) for _, data in files)
+                self.journal.truncate()
         else:
             self.logger.warning("no path specified for cache, cannot save")
             await asyncio.sleep(0.1)
 
-    def prune(self):
-        """
-        clean up our memory when it exceeds a given amount of values
-        """
-        if len(self.cluster_status) >= 10000000:
-            self.logger.debug("pruning memory")
-            for ip in [status.ip for status in self.cluster_status]:
-                states = self.cluster_status[ip]
-                previous_status = None
-                prune_list = []
-                for index, status in enumerate(sorted(states, key=lambda x: x.time)):
-                    if previous_status and previous_status.load == status.load:
-                        prune_list.append(index)
-                    else:
-                        previous_status = status
-                for index in sorted(prune_list, reverse=True):
-                    self.logger.debug("pruning memory: index {0}".format(index))
-                    del (self.cluster_status[index])
+    def close(self):
+        if self.journal:
+            self.journal.close()
 
     def node_state(self, ip):
         """
@@ -129,21 +1086,15 @@ class Storage(object):
         :param ip: ip of the node
         :return: last known state
         """
-        node_status = [status for status in self.cluster_status if status.ip == ip]
-        if len(node_status) == 0:
-            return None
-        sorted_status = sorted(node_status, key=lambda s: parser.parse(s.time), reverse=True)
-        if not sorted_status:
-            return None
-        return sorted_status[0]
+        return self._cluster_status.latest(ip)
 
     def cluster_state(self):
         """
         get state of all known nodes of the cluster
         :return: generator of node states
         """
-        for ip in set([status.ip for status in self.cluster_status]):
-            yield self.node_state(ip)
+        for ip in self._cluster_status.nodes():
+            yield self._cluster_status.latest(ip)
 
 
 DATE_FORMAT = "%Y-%m-%d"
@@ -167,7 +1118,9 @@ class CronEncoder(JSONEncoder):
                 'last_run': last_run,
                 'pid': o.pid,
                 'assigned_to': o.assigned_to,
+                'version': o.version,
                 'log': o._log,
+                'cost': o.cost.fields(),
                 'parts': str(o.parts)
             }
         elif isinstance(o, CronTab):
@@ -185,7 +1138,8 @@ class CronEncoder(JSONEncoder):
                 'ip': o.ip,
                 'state': o.state,
                 'load': o.system_load,
-                'time': o.time
+                'cpus': o.cpus,
+                'time': datetime.fromtimestamp(o.time, timezone.utc).isoformat() if o.time is not None else None
             }
         elif isinstance(o, list):
             return json.dumps(o, cls=CronEncoder)
@@ -208,8 +1162,11 @@ class CronDecoder(JSONDecoder):
             cron_item.enable(obj['enabled'])
             cron_item.comment = obj['comment']
             cron_item.assigned_to = obj['assigned_to']
+            cron_item.version = obj.get('version', 0)
             cron_item.pid = obj['pid']
             cron_item._log = obj['log']
+            if obj.get('cost'):
+                cron_item.cost = Cost(*obj['cost'])
             if obj['last_run'] != '':
                 cron_item.last_run = parser.parse(obj['last_run'])
             cron_item.set_all(obj['parts'])
@@ -219,9 +1176,10 @@ class CronDecoder(JSONDecoder):
         elif obj['_type'] == 'status':
             status = Status()
             status.system_load = obj['load']
+            status.cpus = obj.get('cpus')
             status.state = obj['state']
             status.ip = obj['ip']
-            status.time = obj['time']
+            status.time = epoch(obj['time']) if obj['time'] else None
             return status
         return obj
 
@@ -24,8 +24,14 @@
 # SOFTWARE.
 
 import os
+import random
 import signal
 import socket
+import subprocess
+import sys
+import tempfile
+import time
+
 import psutil
 
 import ntplib as ntplib
@@ -54,10 +60,20 @@ def get_ip():
     return ip
 
 
+def jitter(interval, spread=0.1):
+    """
+    randomize an interval, so periodic tasks of nodes don't synchronize
+    :param interval: interval in seconds
+    :param spread: maximum relative deviation (default: 10%)
+    :return: interval in seconds
+    """
+    return interval * random.uniform(1 - spread, 1 + spread)
+
+
 def get_load():
     """
     get system load
-    :return: 0-100%
+    :return: load average of the last minute, in runnable processes
     """
     try:
         return os.getloadavg()[0]
@@ -65,6 +81,50 @@ def get_load():
         return 0
 
 
+def get_cpus():
+    """
+    get the amount of cpus we may run on
+    :return: amount of cpus
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return psutil.cpu_count() or 1
+
+
+def get_udp_drops(port, proc='/proc/net'):
+    """
+    get the counters the (linux) kernel keeps for datagrams it could not deliver to us
+    :param port: UDP port we listen on
+    :param proc: location of the kernel network statistics
+    :return: dictionary with drops and queued bytes of our sockets and UDP wide errors, None if not available
+    """
+    try:
+        with open(os.path.join(proc, 'snmp')) as f:
+            lines = [line.split() for line in f if line.startswith('Udp:')]
+        counters = dict(zip(lines[0][1:], [int(v) for v in lines[1][1:]]))
+        drops = queued = 0
+        for table in ('udp', 'udp6'):
+            try:
+                with open(os.path.join(proc, table)) as f:
+                    next(f)
+                    for line in f:
+                        fields = line.split()
+                        if int(fields[1].split(':')[1], 16) == port:
+                            queued += int(fields[4].split(':')[1], 16)
+                            drops += int(fields[-1])
+            except FileNotFoundError:
+                pass
+    except (OSError, IndexError, ValueError):
+        return None
+    return {
+        'socket_drops': drops,
+        'receive_queue': queued,
+        'in_errors': counters.get('InErrors', 0),
+        'receive_buffer_errors': counters.get('RcvbufErrors', 0)
+    }
+
+
 def check_process(command, pid=None):
     """
     check for the existence of a unix process with a given command (by pid if given).
@@ -84,6 +144,46 @@ def check_process(command, pid=None):
     return None
 
 
+def get_rss(pid):
+    """
+    get the resident memory of a process and its children
+    :param pid: process id
+    :return: bytes, None if the process is gone
+    """
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return None
+    rss = 0
+    for proc in processes:
+        try:
+            rss += proc.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def execute(command):
+    """
+    run a shell command until it exits, and measure it
+    :param command: command line
+    :return: tuple of pid, exit code, output, errors, seconds it ran and its peak resident memory in bytes
+    """
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        start = time.monotonic()
+        process = subprocess.Popen(command, stdout=out, stderr=err, shell=True)
+        # reaping the process ourselves gives us its resource usage, which includes the children it waited for
+        _, status, usage = os.wait4(process.pid, 0)
+        duration = time.monotonic() - start
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        out.seek(0)
+        err.seek(0)
+        # linux reports kilobytes, macos bytes
+        rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+        return process.pid, process.returncode, out.read(), err.read(), duration, rss
+
+
 def kill_proc_tree(pid, sig=signal.SIGTERM, include_parent=True, timeout=None, on_terminate=None):
     """
     Kill a process tree (including grandchildren) with signal "sig" and return a (gone, still_alive) tuple.
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+
+# MIT License
+#
+# Copyright (c) 2019 Pim Witlox
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import socket
+import time
+
+from dcron.datagram.client import Sender
+from dcron.datagram.server import StatusProtocol
+from dcron.utils import get_udp_drops
+
+
+def receiver():
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.bind(('127.0.0.1', 0))
+    udp_socket.settimeout(1)
+    return udp_socket
+
+
+def test_sender_sends_list_over_one_socket():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    with receiver() as udp_socket:
+        with Sender(udp_socket.getsockname()[1], address='127.0.0.1') as sender:
+            assert 3 == loop.run_until_complete(sender.send([b'a', b'b', b'c']))
+            first = sender.socket
+            assert 1 == loop.run_until_complete(sender.send([b'd']))
+            assert first is sender.socket
+            assert [b'a', b'b', b'c', b'd'] == [udp_socket.recv(16) for _ in range(4)]
+            assert {'sent': 4, 'failed': 0} == sender.stats()
+
+    loop.close()
+
+
+def test_sender_paces_bursts():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    with receiver() as udp_socket:
+        with Sender(udp_socket.getsockname()[1], rate=200, burst=10, address='127.0.0.1') as sender:
+            start = time.monotonic()
+            assert 30 == loop.run_until_complete(sender.send([b'x'] * 30))
+            assert time.monotonic() - start >= 0.09
+
+    loop.close()
+
+
+def test_sender_uses_attached_transport():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    with receiver() as udp_socket:
+        transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(asyncio.DatagramProtocol, local_addr=('127.0.0.1', 0)))
+        with Sender(udp_socket.getsockname()[1], address='127.0.0.1') as sender:
+            sender.attach(transport)
+            assert 1 == loop.run_until_complete(sender.send([b'a']))
+            assert (b'a', transport.get_extra_info('sockname')) == udp_socket.recvfrom(16)
+            assert sender._socket is None
+        transport.close()
+
+    loop.close()
+
+
+def test_receive_buffer_is_enlarged():
+    udp_socket = receiver()
+    default = udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    StatusProtocol(asyncio.Queue()).set_receive_buffer(udp_socket, default * 2)
+    assert default < udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    udp_socket.close()
+
+
+def test_kernel_drop_counters(tmp_path):
+    (tmp_path / 'snmp').write_text(
+        "Udp: InDatagrams NoPorts InErrors OutDatagrams RcvbufErrors SndbufErrors\n"
+        "Udp: 126 0 7 788 5 0\n")
+    (tmp_path / 'udp').write_text(
+        "   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops\n"
+        "  1: 00000000:3039 00000000:0000 07 00000000:00000400 00:00000000 00000000     0        0 1 2 0000000000000000 42\n"
+        "  2: 00000000:0035 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 2 2 0000000000000000 3\n")
+    assert {'socket_drops': 42, 'receive_queue': 1024, 'in_errors': 7, 'receive_buffer_errors': 5} == get_udp_drops(12345, str(tmp_path))
+    assert get_udp_drops(12345, str(tmp_path / 'missing')) is None
@@ -24,13 +24,18 @@
 # SOFTWARE.
 
 import asyncio
+import time
+from datetime import datetime
 
 from dcron.cron.crontab import CronTab, CronItem
 from dcron.processor import Processor
-from dcron.protocols.messages import Run
+from dcron.protocols import Packet, schema
+from dcron.protocols.messages import Digest, Kill, ReBalance, Reassign, Run, Status, Toggle
 from dcron.protocols.udpserializer import UdpSerializer
+from dcron.scheduler import Scheduler
 from dcron.storage import Storage
 from dcron.utils import get_ip
+from tests.test_protocols import LEGACY_JOB, LEGACY_STATUS, legacy_packets
 
 
 def test_message_deserialization_and_assignment():
@@ -118,7 +123,543 @@ def test_manual_run_is_executed_exactly_once():
 
     assert 1 == len(storage.cluster_jobs[0].log)
     assert 'exit code: 0' in storage.cluster_jobs[0].log[0] and 'hello world' in storage.cluster_jobs[0].log[0]
+    assert 1 == storage.cluster_jobs[0].cost.runs and storage.cluster_jobs[0].cost.rss > 0
 
     assert processor.queue.empty()
 
     loop.close()
+
+
+def test_runs_do_not_hold_up_other_messages():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    jobs = [CronItem(command="sleep 0.5; echo {0}".format(i)) for i in range(4)]
+    for job in jobs:
+        job.assigned_to = get_ip()
+        for packet in UdpSerializer.dump(job):
+            processor.queue.put_nowait(packet)
+    for job in jobs:
+        for packet in UdpSerializer.dump(Run(job)):
+            processor.queue.put_nowait(packet)
+
+    start = time.perf_counter()
+    loop.run_until_complete(processor.process())
+    assert time.perf_counter() - start < 1.5
+    assert all(1 == storage.cluster_jobs.get(job).cost.runs for job in jobs)
+
+    loop.close()
+
+
+class RecordingSender(object):
+
+    def __init__(self):
+        self.packets = []
+
+    async def send(self, packets):
+        packets = list(packets)
+        self.packets.extend(packets)
+        return len(packets)
+
+    def stats(self):
+        return {}
+
+
+def test_outdated_job_version_is_ignored():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""))
+
+    cron_job = CronItem(command="echo 'hello world'")
+    cron_job.assigned_to = 'node1'
+    cron_job.update_version()
+    outdated = CronItem(command="echo 'hello world'")
+    outdated.assigned_to = 'node2'
+
+    for packet in list(UdpSerializer.dump(cron_job)) + list(UdpSerializer.dump(outdated)):
+        processor.queue.put_nowait(packet)
+
+    loop.run_until_complete(processor.process())
+
+    assert 1 == len(storage.cluster_jobs)
+    assert 'node1' == storage.cluster_jobs[0].assigned_to
+
+    loop.close()
+
+
+def test_differing_digest_resends_missing_jobs():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    sender = RecordingSender()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=sender)
+    processor.resend_delay = 0
+    jobs = [CronItem(command="echo 'hello world {0}'".format(i)) for i in range(10)]
+    storage.cluster_jobs.extend(jobs)
+
+    for packet in UdpSerializer.dump(Digest.of('peer', jobs[1:])):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+    loop.run_until_complete(processor._resend)
+    loop.run_until_complete(processor.coalescer.flush())
+
+    resent = [job for packet in sender.packets for job in UdpSerializer.load([packet]).messages]
+    assert jobs[0] in resent
+    assert all(Digest.bucket(job) == Digest.bucket(jobs[0]) for job in resent)
+
+    loop.close()
+
+
+def test_peer_answer_suppresses_resend():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    sender = RecordingSender()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=sender)
+    job = CronItem(command="echo 'hello world'")
+    storage.cluster_jobs.append(job)
+
+    for packet in list(UdpSerializer.dump(Digest('peer'))) + list(UdpSerializer.dump(job)):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+    loop.run_until_complete(processor._resend)
+
+    assert [] == sender.packets
+
+    # a copy of a job we already have suppresses the resend as well
+    for packet in list(UdpSerializer.dump(Digest('peer'))) + list(UdpSerializer.dump(job)):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+    loop.run_until_complete(processor._resend)
+
+    assert [] == sender.packets
+    assert 1 == processor.stats()['duplicates']['jobs']['hits']
+
+    loop.close()
+
+
+def test_batched_messages_are_processed_separately():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    jobs = [CronItem(command="echo 'hello world {0}'".format(i)) for i in range(5)]
+    buffer = schema.batch([schema.dumps(Status('127.0.0.1', 0))] + [schema.dumps(job) for job in jobs])
+
+    for packet in UdpSerializer.dumps(buffer):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+
+    assert 1 == len(storage.cluster_status)
+    assert jobs == list(storage.cluster_jobs)
+
+    loop.close()
+
+
+def test_duplicate_messages_are_dropped():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    job = CronItem(command="echo 'hello world'")
+    job.update_version()
+    status = list(UdpSerializer.dump(Status('127.0.0.1', 0)))
+
+    # the same datagram received twice, and the same job rebroadcast by 3 peers
+    for packet in status + status + [packet for _ in range(3) for packet in UdpSerializer.dump(job)]:
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+
+    assert 1 == len(storage.cluster_status)
+    assert 1 == len(storage.cluster_jobs)
+    stats = processor.stats()['duplicates']
+    assert 1 == stats['ids']['hits'] and 4 == stats['ids']['misses']
+    assert 2 == stats['jobs']['hits'] and 1 == stats['jobs']['misses']
+
+    # jobs are resent unchanged after a re-balance
+    for packet in list(UdpSerializer.dump(ReBalance(timestamp=datetime.now()))) + list(UdpSerializer.dump(job)):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+
+    assert 1 == len(storage.cluster_jobs)
+
+    loop.close()
+
+
+def test_consumer_drains_queue_in_batches():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    processor.batch_size = 8
+
+    async def burst():
+        processor.start()
+        processor.put_nowait(b'garbage')
+        for i in range(20):
+            for packet in UdpSerializer.dump(Status('10.0.0.{0}'.format(i), 0)):
+                processor.put_nowait(packet)
+        while processor.pending():
+            await asyncio.sleep(0.001)
+        await processor.stop()
+
+    loop.run_until_complete(burst())
+
+    assert 20 == len(storage.cluster_status)
+    stats = processor.stats()['queue']
+    assert 0 == stats['depth'] and 21 == stats['processed'] and 3 == stats['batches']
+    assert not [task for task in asyncio.all_tasks(loop) if not task.done()]
+
+    loop.close()
+
+
+def test_consumer_runs_on_a_loop_set_after_construction(tmp_path):
+    # the daemon builds storage and processor before the server sets up its event loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    storage = Storage(str(tmp_path))
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    asyncio.get_event_loop().close()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def later():
+        processor.start()
+        # the consumer waits on the empty queue
+        await asyncio.sleep(0.01)
+        for packet in UdpSerializer.dump(Status('10.0.0.1', 0)):
+            processor.put_nowait(packet)
+        for _ in range(1000):
+            if not processor.pending():
+                break
+            await asyncio.sleep(0.001)
+        await storage.commit()
+        await storage.save()
+        await processor.stop()
+
+    loop.run_until_complete(later())
+    assert 1 == len(storage.cluster_status)
+    assert 1 == len(Storage(str(tmp_path)).cluster_status)
+
+    loop.close()
+
+
+def test_consumer_survives_messages_that_fail_to_decode():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    # a kill without a job, the null nested message only fails when it is decoded
+    writer = schema.Writer()
+    writer.fields += 1
+    writer.chunks.append(schema._length.pack(schema._NULL_LENGTH))
+    kill = writer.getvalue(schema.tag_of(Kill))
+
+    async def attack():
+        processor.start()
+        for buffer in (b'\x80garbage', kill):
+            for packet in UdpSerializer.dumps(buffer):
+                processor.put_nowait(packet)
+            await asyncio.sleep(0.01)
+        for packet in UdpSerializer.dump(Status('10.0.0.1', 0)):
+            processor.put_nowait(packet)
+        for _ in range(1000):
+            if not processor.pending():
+                break
+            await asyncio.sleep(0.001)
+        alive = all(not task.done() for task in processor._tasks)
+        await processor.stop()
+        return alive
+
+    assert loop.run_until_complete(attack())
+    assert 1 == len(storage.cluster_status)
+
+    loop.close()
+
+
+def test_control_messages_are_handled_before_bulk():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    handled = []
+
+    async def handle(obj):
+        handled.append(type(obj))
+    processor.handle = handle
+
+    job = CronItem(command="echo 'hello world'")
+    storage.cluster_jobs.append(job)
+    messages = [Status('127.0.0.1', 0), Digest('127.0.0.1'), Toggle(job), Status('127.0.0.2', 0)]
+    for message in messages:
+        for packet in UdpSerializer.dump(message):
+            processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+
+    assert [Toggle, Status, Digest, Status] == handled
+    stats = processor.stats()['lanes']
+    assert 1 == stats['control']['served'] and 3 == stats['bulk']['served']
+
+    loop.close()
+
+
+def test_re_balance_drops_jobs_received_before_it():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    outdated = CronItem(command="echo 'hello world'")
+    outdated.assigned_to = 'node1'
+    job = CronItem(command="echo 'hello world'")
+    job.assigned_to = 'node2'
+
+    for message in [outdated, ReBalance(timestamp=datetime.now()), job]:
+        for packet in UdpSerializer.dump(message):
+            processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+
+    assert 1 == len(storage.cluster_jobs)
+    assert 'node2' == storage.cluster_jobs[0].assigned_to
+    assert 1 == processor.stats()['lanes']['bulk']['dropped']
+
+    loop.close()
+
+
+def test_bulk_traffic_is_shed_before_control_messages():
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender(), queue_size=10)
+    job = CronItem(command="echo 'hello world'")
+    status = next(UdpSerializer.dump(Status('127.0.0.1', 0)))
+
+    for i in range(12):
+        processor.put_nowait(next(UdpSerializer.dump(Status('10.0.0.{0}'.format(i), 0))))
+    for i in range(3):
+        processor.put_nowait(next(UdpSerializer.dump(Toggle(job))))
+
+    assert 10 == processor.queue.qsize()
+    stats = processor.stats()['queue']
+    assert 11 == stats['accepted']
+    assert {'bulk': 4, 'oldest': 1} == stats['shed']
+
+    processor._seen_ids.add(Packet.decode(status).id)
+    processor.put_nowait(status)
+    assert 1 == processor.stats()['queue']['shed']['duplicate']
+
+
+def test_control_messages_spanning_several_packets_are_not_shed():
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender(), queue_size=10)
+    jobs = [CronItem(command="echo 'hello world {0}'".format(i)) for i in range(Reassign.size)]
+    reassign = list(UdpSerializer.dump(Reassign.of(jobs)[0]))
+    jobs = list(UdpSerializer.dump(CronItem(command="echo '{0}'".format('hello world' * 200))))
+    assert 1 < len(reassign) and 1 < len(jobs)
+
+    processor.put_nowait(reassign[0])
+    for i in range(12):
+        processor.put_nowait(next(UdpSerializer.dump(Status('10.0.0.{0}'.format(i), 0))))
+    for packet in reassign[1:] + jobs:
+        processor.put_nowait(packet)
+
+    # the room kept for control messages takes the rest of the reassignment, the large job is shed like the statuses
+    assert {'bulk': 5 + len(jobs)} == processor.stats()['queue']['shed']
+    queued = [Packet.decode(processor.queue.get_nowait()) for _ in range(processor.queue.qsize())]
+    assert len(reassign) == len([p for p in queued if p.id == Packet.decode(reassign[0]).id])
+
+
+def test_shed_policies_drop_oldest_or_newest():
+    for policy, kept in (('oldest', ['10.0.0.2', '10.0.0.3']), ('newest', ['10.0.0.0', '10.0.0.1'])):
+        storage = Storage()
+        processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender(), queue_size=2, shed_policy=policy)
+        for i in range(4):
+            processor.put_nowait(next(UdpSerializer.dump(Status('10.0.0.{0}'.format(i), 0))))
+        assert kept == [UdpSerializer.load([processor.queue.get_nowait()]).ip for _ in range(2)]
+        assert {policy: 2} == processor.stats()['queue']['shed']
+
+
+def test_reassign_moves_jobs_in_and_out_of_our_crontab():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    tab = CronTab(tab="""* * * * * command""")
+    processor = Processor(12345, storage, cron=tab)
+
+    leaving = CronItem(command="echo 'leaving'")
+    leaving.assigned_to = get_ip()
+    arriving = CronItem(command="echo 'arriving'")
+    arriving.assigned_to = 'node1'
+    for job in (leaving, arriving):
+        job.update_version()
+        for packet in UdpSerializer.dump(job):
+            processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+    assert 1 == len(list(tab.find_command("echo 'leaving'")))
+    assert 0 == len(list(tab.find_command("echo 'arriving'")))
+
+    moved = []
+    for job, node in ((leaving, 'node2'), (arriving, get_ip())):
+        job = schema.loads(schema.dumps(job))
+        job.assigned_to = node
+        job.version += 1
+        moved.append(job)
+    messages = Reassign.of(moved)
+    assert 1 == len(messages)
+    for packet in UdpSerializer.dump(messages[0]):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+
+    assert 0 == len(list(tab.find_command("echo 'leaving'")))
+    assert 1 == len(list(tab.find_command("echo 'arriving'")))
+    assert 'node2' == storage.cluster_jobs.get(leaving).assigned_to
+    assert get_ip() == storage.cluster_jobs.get(arriving).assigned_to
+    assert 1 == processor.stats()['lanes']['control']['served']
+
+    # an older reassignment does not undo it
+    for packet in UdpSerializer.dump(Reassign([leaving, arriving])):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+    assert 'node2' == storage.cluster_jobs.get(leaving).assigned_to
+    assert 1 == len(list(tab.find_command("echo 'arriving'")))
+
+    loop.close()
+
+
+def test_jobs_dropped_from_the_bulk_lane_are_applied_when_resent():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=RecordingSender())
+    processor._bulk.maxsize = 5
+    jobs = [CronItem(command="echo 'hello world {0}'".format(i)) for i in range(10)]
+
+    for _ in range(2):
+        for job in jobs:
+            for packet in UdpSerializer.dump(job):
+                processor.queue.put_nowait(packet)
+        loop.run_until_complete(processor.process())
+
+    assert 10 == len(storage.cluster_jobs)
+    stats = processor.stats()
+    assert 5 == stats['lanes']['bulk']['dropped']
+    assert 5 == stats['duplicates']['jobs']['hits']
+
+    loop.close()
+
+
+def test_removed_jobs_are_not_stored_again():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    sender = RecordingSender()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), sender=sender)
+    processor.resend_delay = 0
+    job = CronItem(command="echo 'hello world'")
+    job.assigned_to = 'node1'
+    job.version = 1
+    removal = CronItem(command="echo 'hello world'")
+    removal.remove = True
+    removal.version = 2
+    # a peer that missed the removal sends the job it still has
+    stale = CronItem(command="echo 'hello world'")
+    stale.assigned_to = 'node1'
+    stale.pid = 42
+    stale.version = 1
+
+    for message in [job, removal, stale]:
+        for packet in UdpSerializer.dump(message):
+            processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+
+    assert 0 == len(storage.cluster_jobs)
+    assert 2 == storage.cluster_jobs.tombstone(job).version
+
+    # the peer is told about the removal when digests differ
+    for packet in UdpSerializer.dump(Digest.of('peer', [stale])):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+    loop.run_until_complete(processor._resend)
+    loop.run_until_complete(processor.coalescer.flush())
+
+    resent = [UdpSerializer.load([packet]) for packet in sender.packets]
+    assert [(True, 2)] == [(message.remove, message.version) for message in resent]
+
+    # tombstones are forgotten after a while
+    processor.tombstone_ttl = -1
+    processor.housekeeping()
+    assert not storage.cluster_jobs.tombstones()
+
+    loop.close()
+
+
+def test_messages_of_pre_schema_nodes_are_applied():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), hash_key='abracadabra')
+    for packet in legacy_packets(LEGACY_JOB, 'abracadabra'):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+    assert 0 == len(storage.cluster_jobs) and 'legacy' not in processor.stats()
+
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""), hash_key='abracadabra', accept_legacy=True)
+    for buffer in [LEGACY_JOB, LEGACY_STATUS]:
+        for packet in legacy_packets(buffer, 'abracadabra'):
+            processor.queue.put_nowait(packet)
+    # unsigned they are dropped
+    forged = LEGACY_JOB.replace(b'hello world', b'rm -rf /ld;')
+    for packet in legacy_packets(forged) + legacy_packets(forged, 'other secret'):
+        processor.queue.put_nowait(packet)
+
+    loop.run_until_complete(processor.process())
+
+    assert 1 == len(storage.cluster_jobs)
+    job = storage.cluster_jobs[0]
+    assert "echo 'hello world'" == job.command and '10.0.0.1' == job.assigned_to
+    assert 0 == job.version and 0 == job.cost.runs
+    assert '10.0.0.1' in [node.ip for node in storage.cluster_state()]
+    assert 4 == processor.stats()['legacy']['completed']
+
+    loop.close()
+
+
+def test_re_balance_is_applied_through_the_reassignment():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = Storage()
+    storage.cluster_status = [Status(get_ip(), 0)]
+    tab = CronTab(tab="""* * * * * command""")
+    processor = Processor(12345, storage, cron=tab)
+
+    job = CronItem(command="echo 'hello world'")
+    job.assigned_to = 'node1'
+    storage.cluster_jobs.append(job)
+
+    moved = Scheduler(storage, 60).re_balance()
+    assert [get_ip()] == [job.assigned_to for job in moved]
+    # nothing changed until the reassignment comes in
+    assert 'node1' == storage.cluster_jobs.get(job).assigned_to
+
+    for message in Reassign.of(moved):
+        for packet in UdpSerializer.dump(message):
+            processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+
+    assert get_ip() == storage.cluster_jobs.get(job).assigned_to
+    assert 1 == len(list(tab.find_command("echo 'hello world'")))
+
+    loop.close()
@@ -23,15 +23,61 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
+import base64
+import hashlib
+import hmac
+import pickle
 import random
 import string
+from datetime import datetime
 from uuid import uuid4
 
 from dcron.cron.cronitem import CronItem
-from dcron.protocols import Packet
-from dcron.protocols.messages import Status
+from dcron.cron.crontab import CronTab
+from dcron.datagram.server import StatusProtocol
+from dcron.protocols import Packet, schema
+from dcron.protocols.coalescer import Coalescer
+from dcron.protocols.dedup import RecentlySeen
+from dcron.protocols.lanes import Lane
+from dcron.protocols.messages import Batch, Digest, Kill, ReBalance, Run, Status, Toggle
+from dcron.protocols.reassembly import ReassemblyBuffer
+from dcron.protocols.signer import Signer
 from dcron.protocols.udpserializer import UdpSerializer
 
+# pickles made by a node running the pre-schema release, CronItem(command="echo 'hello world'") assigned to
+# 10.0.0.1 and Status('10.0.0.1', 0.5), these lack the fields added since (version, cost and cpus)
+LEGACY_JOB = base64.b64decode(
+    'gASV8gIAAAAAAACME2Rjcm9uLmNyb24uY3Jvbml0ZW2UjAhDcm9uSXRlbZSTlCmBlH2UKIwEY3JvbpROjAR1c2VylE6MBXZhbGlk'
+    'lIiMB2VuYWJsZWSUiIwHc3BlY2lhbJSJjAdjb21tZW50lIwAlIwHY29tbWFuZJSMEmVjaG8gJ2hlbGxvIHdvcmxkJ5SMCGxhc3Rf'
+    'cnVulE6MC2Fzc2lnbmVkX3RvlIwIMTAuMC4wLjGUjANwaWSUTowGcmVtb3ZllImMA2VudpSMHmRjcm9uLmNyb24ub3JkZXJlZHZh'
+    'cmlhYmxlbGlzdJSME09yZGVyZWRWYXJpYWJsZUxpc3SUk5QpUpR9lIwDam9ilGgDc2KMBm1hcmtlcpROjAtwcmVfY29tbWVudJSJ'
+    'jARfbG9nlF2UjAVwYXJ0c5RoAIwRQ3JvbkRhdGVUaW1lUGFydHOUk5QpgZQoaACMEENyb25EYXRlVGltZVBhcnSUk5QpgZR9lCiM'
+    'A21pbpRLAIwDbWF4lEs7jARuYW1llIwHTWludXRlc5SMBGVudW2UTmgeXZR1YmgjKYGUfZQoaCZLAGgnSxdoKIwFSG91cnOUaCpO'
+    'aB5dlHViaCMpgZR9lChoJksBaCdLH2gojAxEYXkgb2YgTW9udGiUaCpOaB5dlHViaCMpgZR9lChoJksBaCdLDGgojAVNb250aJRo'
+    'Kl2UKE6MA2phbpSMA2ZlYpSMA21hcpSMA2FwcpSMA21heZSMA2p1bpSMA2p1bJSMA2F1Z5SMA3NlcJSMA29jdJSMA25vdpSMA2Rl'
+    'Y5RlaB5dlHViaCMpgZR9lChoJksAaCdLBmgojAtEYXkgb2YgV2Vla5RoKl2UKIwDc3VulIwDbW9ulIwDdHVllIwDd2VklIwDdGh1'
+    'lIwDZnJplIwDc2F0lGhJZWgeXZR1YmV9lChoCU6MCGlzX3ZhbGlklIwIYnVpbHRpbnOUjAdnZXRhdHRylJOUaCGMDWlzX3NlbGZf'
+    'dmFsaWSUhpRSlHVidWIu')
+LEGACY_STATUS = base64.b64decode(
+    'gASVjAAAAAAAAACMGGRjcm9uLnByb3RvY29scy5tZXNzYWdlc5SMBlN0YXR1c5STlCmBlH2UKIwCaXCUjAgxMC4wLjAuMZSMBHRp'
+    'bWWUjBoyMDI2LTEwLTE3VDA3OjA5OjI4LjgxNDYxM5SMC3N5c3RlbV9sb2FklEc/4AAAAAAAAIwFc3RhdGWUjAdydW5uaW5nlHVi'
+    'Lg==')
+
+
+def legacy_packets(buffer, hash_key=None):
+    """
+    packets of a message as a node running the pre-schema release sends them
+    :param buffer: pickled message
+    :param hash_key: key the message is signed with
+    :return: list of fixed size packets
+    """
+    if hash_key:
+        buffer += b' ' + hmac.new(hash_key.encode('utf-8'), buffer, hashlib.sha1).digest()
+    uuid = str(uuid4()).encode('utf-8')
+    chunks = [buffer[i:i + 980] for i in range(0, len(buffer), 980)]
+    return [Packet.legacy_format.pack(uuid, len(chunks), i, chunk) for i, chunk in enumerate(chunks)]
+
 
 def test_packet_encoding_and_decoding():
     data = b'hello world'
@@ -40,6 +86,36 @@ def test_packet_encoding_and_decoding():
     assert p == Packet.decode(encoded)
 
 
+def test_packet_is_sized_to_its_data():
+    p = Packet(uuid4().bytes, 1, 0, b'hello world')
+    encoded = p.encode()
+    assert Packet.header.size + 11 == len(encoded)
+    assert b'hello world' == bytes(Packet.decode(encoded).data)
+    assert Packet.decode(encoded[:-1]) is None
+
+
+def test_legacy_packet_decoding():
+    uuid = str(uuid4())
+    p = Packet.decode(Packet.legacy_format.pack(uuid.encode('utf-8'), 2, 1, b'hello world'))
+    assert Packet(uuid, 2, 1, b'') == p
+    assert 2 == p.total and 1 == p.index
+
+
+def test_packet_data_size_is_configurable():
+    cj = CronItem(command=''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6000)))
+    data_size = Packet.data_size
+    try:
+        Packet.data_size = 512
+        small = list(UdpSerializer.dump(cj))
+        Packet.data_size = 8900
+        jumbo = list(UdpSerializer.dump(cj))
+    finally:
+        Packet.data_size = data_size
+    assert all(len(p) <= Packet.header.size + 512 for p in small)
+    assert len(small) > 1 and len(jumbo) == 1
+    assert cj == UdpSerializer.load(small) == UdpSerializer.load(jumbo)
+
+
 def test_status_message_dumps_loads():
     sm = Status('127.0.0.1', 0)
     packets = list(UdpSerializer.dump(sm))
@@ -58,3 +134,267 @@ def test_cron_with_message_larger_then_max():
     packets = list(UdpSerializer.dump(cj))
     assert len(packets) > 1
     assert cj == UdpSerializer.load(packets)
+
+
+def test_cron_job_fields_survive_round_trip():
+    cj = CronItem(command="echo 'hello world'", user='root')
+    cj.set_all('*/5 1 * * MON')
+    cj.assigned_to = '10.0.0.1'
+    cj.pid = 1234
+    cj.enable(False)
+    cj.remove = True
+    cj.cost.observe(1.5, 2 ** 20)
+    result = UdpSerializer.load(list(UdpSerializer.dump(cj)))
+    assert cj == result
+    assert str(cj.parts) == str(result.parts)
+    assert 'root' == result.user
+    assert '10.0.0.1' == result.assigned_to
+    assert 1234 == result.pid
+    assert not result.enabled
+    assert result.remove
+    assert cj.cost == result.cost
+
+
+def test_control_messages_dumps_loads():
+    cj = CronItem(command="echo 'hello world'")
+    assert cj == UdpSerializer.load(list(UdpSerializer.dump(Run(cj)))).job
+    assert cj == UdpSerializer.load(list(UdpSerializer.dump(Toggle(cj)))).job
+    kill = Kill.__new__(Kill)
+    kill.job = cj
+    kill.pid = 42
+    result = UdpSerializer.load(list(UdpSerializer.dump(kill)))
+    assert cj == result.job and 42 == result.pid
+    now = datetime.now()
+    assert now == UdpSerializer.load(list(UdpSerializer.dump(ReBalance(now)))).timestamp
+    assert 8 == UdpSerializer.load(list(UdpSerializer.dump(Status('127.0.0.1', 0.5, 8)))).cpus
+
+
+def test_signed_message_dumps_loads():
+    sm = Status('127.0.0.1', 0.5)
+    packets = list(UdpSerializer.dump(sm, 'secret'))
+    assert sm == UdpSerializer.load(packets, 'secret')
+    assert UdpSerializer.load(packets, 'other secret') is None
+
+
+def test_wire_format_is_smaller_than_pickle():
+    cj = CronItem(command="echo 'hello world'", cron=CronTab(tab="* * * * * command"))
+    assert len(schema.dumps(cj)) * 4 < len(pickle.dumps(cj))
+
+
+def test_wire_format_ignores_unknown_fields():
+    writer = schema.Writer()
+    writer.string('127.0.0.1')
+    writer.timestamp(datetime.now())
+    writer.real(0.5)
+    writer.string('running')
+    writer.string('field from the future')
+    sm = schema.loads(writer.getvalue(2))
+    assert '127.0.0.1' == sm.ip and 0.5 == sm.system_load and 'running' == sm.state
+
+
+def test_wire_format_defaults_missing_fields():
+    writer = schema.Writer()
+    writer.string("echo 'hello world'")
+    cj = schema.loads(writer.getvalue(1))
+    assert "echo 'hello world'" == cj.command
+    assert cj.enabled and not cj.remove and cj.assigned_to is None
+
+
+def test_legacy_pickle_message_is_readable():
+    cj = UdpSerializer.load(legacy_packets(LEGACY_JOB))
+    assert CronItem(command="echo 'hello world'") == cj
+    assert 0 == cj.version and 0 == cj.cost.runs
+    assert cj.cost is not CronItem(command='other').cost
+    sm = UdpSerializer.load(legacy_packets(LEGACY_STATUS))
+    assert '10.0.0.1' == sm.ip and sm.cpus is None
+
+
+def test_reassembly_of_interleaved_out_of_order_packets():
+    cj1 = CronItem(command=''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6000)))
+    cj2 = CronItem(command=''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6000)))
+    p1 = [Packet.decode(p) for p in UdpSerializer.dump(cj1)]
+    p2 = [Packet.decode(p) for p in UdpSerializer.dump(cj2)]
+    buffer = ReassemblyBuffer()
+    completed = []
+    for p in reversed([p for pair in zip(p1, p2) for p in pair]):
+        payload = buffer.add(p)
+        if payload is not None:
+            completed.append(UdpSerializer.loads(payload))
+    assert [cj2, cj1] == completed
+    assert 0 == len(buffer)
+
+
+def test_reassembly_drops_inconsistent_packets():
+    packets = [Packet.decode(p) for p in UdpSerializer.dump(CronItem(command='x' * 3000))]
+    buffer = ReassemblyBuffer()
+    assert buffer.add(packets[0]) is None
+    assert buffer.add(Packet(packets[0].id, packets[0].total + 1, 1, b'')) is None
+    assert buffer.add(Packet(packets[0].id, packets[0].total, packets[0].total, b'')) is None
+    assert packets[0].id in buffer
+    buffer.discard(packets[0].id)
+    assert 0 == len(buffer)
+
+
+def test_reassembly_expires_partial_messages():
+    now = [0]
+    buffer = ReassemblyBuffer(timeout=10, clock=lambda: now[0])
+    packets = [Packet.decode(p) for p in UdpSerializer.dump(CronItem(command='x' * 3000))]
+    buffer.add(packets[0])
+    now[0] = 11
+    assert buffer.add(packets[1]) is None
+    assert 1 == buffer.stats()['expired']
+    now[0] = 30
+    buffer.expire()
+    assert 0 == len(buffer) and 0 == buffer.size
+    assert 2 == buffer.stats()['expired']
+
+
+def test_reassembly_evicts_least_recently_updated():
+    buffer = ReassemblyBuffer(budget=4000)
+    first, second, third = [[Packet.decode(p) for p in UdpSerializer.dump(CronItem(command=c * 3000))] for c in 'xyz']
+    buffer.add(first[0])
+    buffer.add(second[0])
+    buffer.add(first[1])
+    assert first[0].id in buffer and second[0].id not in buffer
+    buffer.add(third[0])
+    assert first[0].id not in buffer and third[0].id in buffer
+    assert buffer.size <= 4000
+    assert 2 == buffer.stats()['evicted']
+    for p in third[1:]:
+        buffer.add(p)
+    assert 1 == buffer.stats()['completed'] and 0 == buffer.size
+
+
+def test_forged_packets_are_dropped_before_queueing():
+    signer = Signer('secret')
+    queue = asyncio.Queue()
+    protocol = StatusProtocol(queue, signer)
+    packet = next(UdpSerializer.dump(Status('127.0.0.1', 0), 'secret'))
+    protocol.datagram_received(packet, ('127.0.0.1', 12345))
+    protocol.datagram_received(packet[:-1] + bytes([packet[-1] ^ 1]), ('127.0.0.1', 12345))
+    protocol.datagram_received(next(UdpSerializer.dump(Status('127.0.0.1', 0), 'other secret')), ('127.0.0.1', 12345))
+    protocol.datagram_received(next(UdpSerializer.dump(Status('127.0.0.1', 0))), ('127.0.0.1', 12345))
+    assert 1 == queue.qsize()
+    assert {'verified': 1, 'rejected': 3} == signer.stats()
+    assert Packet.decode(queue.get_nowait()) is not None
+
+
+def test_signed_legacy_messages_are_verified_once_reassembled():
+    signer = Signer('secret')
+    queue = asyncio.Queue()
+    # legacy packets are rejected unless we accept them during a rolling upgrade
+    for packet in legacy_packets(LEGACY_JOB, 'secret'):
+        StatusProtocol(queue, signer).datagram_received(packet, ('127.0.0.1', 12345))
+    assert queue.empty() and {'verified': 0, 'rejected': 1} == signer.stats()
+    signer = Signer('secret')
+    protocol = StatusProtocol(queue, signer, accept_legacy=True)
+    # the padding of the last packet follows the signature, and a pickle may contain spaces
+    job = pickle.loads(LEGACY_JOB)
+    job.command = ' '.join(['echo'] * 300)
+    for packet in legacy_packets(pickle.dumps(job), 'secret'):
+        protocol.datagram_received(packet, ('127.0.0.1', 12345))
+    packets = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert 1 < len(packets)
+    assert {'verified': 0, 'rejected': 0} == signer.stats()
+    assert job == UdpSerializer.load(packets, 'secret')
+    assert UdpSerializer.load(legacy_packets(LEGACY_JOB, 'secret'), 'secret') is not None
+    assert UdpSerializer.load(legacy_packets(LEGACY_JOB, 'other secret'), 'secret') is None
+    assert UdpSerializer.load(legacy_packets(LEGACY_JOB), 'secret') is None
+    forged = LEGACY_JOB.replace(b'hello world', b'rm -rf /ld;')
+    packet = legacy_packets(LEGACY_JOB, 'secret')[0]
+    assert UdpSerializer.load([packet.replace(b'hello world', b'rm -rf /ld;')], 'secret') is None
+    assert UdpSerializer.load(legacy_packets(forged), 'secret') is None
+
+
+def test_digest_dumps_loads_and_differences():
+    jobs = [CronItem(command="echo 'hello world {0}'".format(i)) for i in range(100)]
+    digest = Digest.of('127.0.0.1', jobs)
+    result = UdpSerializer.load(list(UdpSerializer.dump(digest)))
+    assert '127.0.0.1' == result.ip
+    assert digest.buckets == result.buckets
+    assert not digest.differences(result)
+    jobs[0].update_version()
+    assert {Digest.bucket(jobs[0])} == Digest.of('127.0.0.1', jobs).differences(result)
+    assert {Digest.bucket(jobs[1])} == Digest.of('127.0.0.1', jobs[:1] + jobs[2:]).differences(Digest.of('127.0.0.1', jobs))
+
+
+class PacketList(object):
+
+    def __init__(self):
+        self.packets = []
+
+    async def send(self, packets):
+        packets = list(packets)
+        self.packets.append(packets)
+        return len(packets)
+
+
+def test_coalescer_packs_small_messages_in_one_datagram():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sender = PacketList()
+    coalescer = Coalescer(sender, 'secret', window=0.001)
+    loop.run_until_complete(coalescer.send([Status('127.0.0.1', 0), Run(CronItem(command="echo 'hello world'"))]))
+    loop.run_until_complete(coalescer.send([Toggle(CronItem(command="echo 'hello world'"))]))
+    assert [] == sender.packets
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert 1 == len(sender.packets) and 1 == len(sender.packets[0])
+    batch = UdpSerializer.load(sender.packets[0], 'secret')
+    assert isinstance(batch, Batch)
+    assert [Status, Run, Toggle] == [type(m) for m in batch.messages]
+    assert {'messages': 3, 'datagrams': 1} == coalescer.stats()
+    loop.close()
+
+
+def test_coalescer_splits_at_packet_size():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sender = PacketList()
+    coalescer = Coalescer(sender)
+    jobs = [CronItem(command="echo 'hello world {0}'".format(i)) for i in range(200)]
+    large = CronItem(command=''.join(random.choice(string.ascii_letters) for _ in range(3 * Packet.data_size)))
+    loop.run_until_complete(coalescer.send(jobs[:100] + [large] + jobs[100:]))
+    loop.run_until_complete(coalescer.flush())
+    assert all(len(p) <= Packet.header.size + Packet.data_size for packets in sender.packets for p in packets)
+    received = []
+    for packets in sender.packets:
+        obj = UdpSerializer.load(packets)
+        received.extend(obj.messages if isinstance(obj, Batch) else [obj])
+    assert [j.command for j in jobs[:100] + [large] + jobs[100:]] == [j.command for j in received]
+    assert len(sender.packets) < 20
+    loop.close()
+
+
+def test_recently_seen_evicts_least_recently_seen():
+    seen = RecentlySeen(capacity=2)
+    for key in 'abc':
+        assert not seen.seen(key)
+        seen.add(key)
+    assert 'a' not in seen
+    assert seen.seen('b')
+    seen.add('d')
+    assert 'b' in seen and 'c' not in seen
+    assert {'entries': 2, 'hits': 1, 'misses': 3, 'evicted': 2} == seen.stats()
+
+
+def test_unbatch_splits_without_decoding():
+    messages = [schema.dumps(Status('127.0.0.1', 0)), schema.dumps(CronItem(command="echo 'hello world'"))]
+    assert messages == schema.unbatch(schema.batch(messages))
+    assert [messages[0]] == schema.unbatch(messages[0])
+    assert [schema.CRON_ITEM_TAG] == [schema.tag(m) for m in messages if isinstance(schema.loads(m), CronItem)]
+    assert schema.tag(pickle.dumps(messages)) is None
+
+
+def test_bounded_lane_drops_oldest():
+    now = [0.0]
+    lane = Lane('bulk', maxsize=2, clock=lambda: now[0])
+    for item in range(3):
+        lane.put(item)
+        now[0] += 1
+    assert 1 == lane.get()
+    assert 2 == lane.peek()
+    lane.put(3)
+    assert 1 == lane.drop_while(lambda item: item < 3)
+    stats = lane.stats()
+    assert 1 == stats['depth'] and 4 == stats['enqueued'] and 1 == stats['served'] and 2 == stats['dropped']
+    assert 2.0 == stats['wait']['max']
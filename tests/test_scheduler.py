@@ -22,6 +22,7 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+from dcron.cost import RunObserver
 from dcron.cron.cronitem import CronItem
 from dcron.protocols.messages import Status
 from dcron.scheduler import Scheduler
@@ -47,6 +48,180 @@ def test_rebalancing():
     storage.cluster_jobs.append(cj2)
     scheduler = Scheduler(storage, 60)
     assert not scheduler.check_cluster_state()
-    scheduler.re_balance()
+    storage.cluster_jobs.extend(scheduler.re_balance())
     assert scheduler.check_cluster_state()
 
+
+def test_stale_nodes_are_disconnected():
+    storage = Storage()
+    stale = Status('node1', 0)
+    stale.time -= 120
+    storage.cluster_status = [stale, Status('node2', 0)]
+    scheduler = Scheduler(storage, 60)
+    states = {node.ip: node.state for node in scheduler.active_nodes()}
+    assert {'node1': 'disconnected', 'node2': 'running'} == states
+
+
+def test_hash_placement_only_moves_jobs_of_nodes_leaving():
+    storage = Storage()
+    storage.cluster_status = [Status('node{0}'.format(i), 0) for i in range(10)]
+    for i in range(1000):
+        job = CronItem(command="echo {0}".format(i))
+        job.set_all("{0} * * * *".format(i % 60))
+        storage.cluster_jobs.append(job)
+    scheduler = Scheduler(storage, 60, 'hash')
+    moved = scheduler.re_balance()
+    assert 1000 == len(moved)
+    storage.cluster_jobs.extend(moved)
+    assert scheduler.check_cluster_state()
+    before = {job.identity: job.assigned_to for job in storage.cluster_jobs}
+    assert 10 == len(set(before.values()))
+
+    storage.node_state('node3').time -= 120
+    moved = scheduler.re_balance()
+    storage.cluster_jobs.extend(moved)
+    assert {job.identity for job in moved} == {k for k, v in before.items() if v == 'node3'}
+    assert 'node3' not in storage.cluster_jobs.nodes()
+    assert 50 < len(moved) < 150
+
+    storage.cluster_status.append(Status('node3', 0))
+    joined = scheduler.re_balance()
+    assert len(moved) == len(joined)
+    storage.cluster_jobs.extend(joined)
+    assert before == {job.identity: job.assigned_to for job in storage.cluster_jobs}
+
+
+def test_fail_over_only_moves_orphaned_jobs():
+    storage = Storage()
+    storage.cluster_status = [Status('node{0}'.format(i), 0) for i in range(4)]
+    for i in range(100):
+        job = CronItem(command="echo {0}".format(i))
+        job.set_all("{0} * * * *".format(i % 60))
+        storage.cluster_jobs.append(job)
+    scheduler = Scheduler(storage, 60, 'hash')
+    storage.cluster_jobs.extend(scheduler.re_balance())
+    assert scheduler.check_cluster_state()
+    assert [] == scheduler.fail_over('node0')
+
+    storage.node_state('node2').time -= 120
+    assert not scheduler.check_cluster_state()
+    orphans = {job.identity: job.version for job in storage.cluster_jobs.assigned_to('node2')}
+    moved = scheduler.fail_over('node0')
+    assert set(orphans) == {job.identity for job in moved}
+    assert all(job.version > orphans[job.identity] for job in moved)
+    assert all(job.assigned_to in ('node0', 'node1', 'node3') for job in moved)
+    # nothing changed until the reassignment comes in
+    assert len(orphans) == len(storage.cluster_jobs.assigned_to('node2'))
+
+    storage.cluster_jobs.extend(moved)
+    assert scheduler.check_cluster_state()
+    # jobs failed over to where a re-balance would put them
+    assert [] == scheduler.re_balance()
+
+
+def test_only_one_node_fails_over_orphans():
+    storage = Storage()
+    storage.cluster_status = [Status('node{0}'.format(i), 0) for i in range(4)]
+    for i in range(100):
+        job = CronItem(command="echo {0}".format(i))
+        job.set_all("{0} * * * *".format(i % 60))
+        storage.cluster_jobs.append(job)
+    storage.cluster_jobs.extend(Scheduler(storage, 60, 'hash').re_balance())
+    storage.node_state('node0').time -= 120
+
+    # every node sees the orphans of node0, with the shuffle placement they would each move them elsewhere
+    schedulers = {ip: Scheduler(storage, 60) for ip in ('node1', 'node2', 'node3')}
+    moved = {ip: scheduler.fail_over(ip) for ip, scheduler in schedulers.items()}
+    assert moved['node1'] and not moved['node2'] and not moved['node3']
+    storage.cluster_jobs.extend(moved['node1'])
+    assert all(scheduler.check_cluster_state() for scheduler in schedulers.values())
+
+
+def test_load_placement_follows_spare_capacity():
+    storage = Storage()
+    storage.cluster_status = [Status('node0', 0, 8), Status('node1', 0, 4), Status('node2', 3.5, 4)]
+    for i in range(100):
+        job = CronItem(command="echo {0}".format(i))
+        job.set_all("{0} * * * *".format(i % 60))
+        storage.cluster_jobs.append(job)
+    scheduler = Scheduler(storage, 60, 'load')
+    moved = scheduler.re_balance()
+    assert 100 == len(moved)
+    storage.cluster_jobs.extend(moved)
+    assert scheduler.check_cluster_state()
+    counts = {node: len(storage.cluster_jobs.assigned_to(node)) for node in ('node0', 'node1', 'node2')}
+    # 8 and 4 spare cpus, the busy node keeps its floor of half a cpu
+    assert {'node0': 64, 'node1': 32, 'node2': 4} == counts
+
+    # a little more load on a node moves nothing
+    storage.cluster_status.append(Status('node0', 1.5, 8))
+    assert [] == scheduler.re_balance()
+
+    # a node that gets busy sheds jobs down to its share
+    for _ in range(3):
+        storage.cluster_status.append(Status('node1', 3.9, 4))
+    moved = scheduler.re_balance()
+    storage.cluster_jobs.extend(moved)
+    assert moved and all(job.assigned_to != 'node1' for job in moved)
+    assert len(storage.cluster_jobs.assigned_to('node1')) < counts['node1'] / 2
+
+
+def test_spread_placement_keeps_jobs_starting_together_apart():
+    storage = Storage()
+    storage.cluster_status = [Status('node{0}'.format(i), 0) for i in range(4)]
+    for i in range(80):
+        job = CronItem(command="echo {0}".format(i))
+        # half of the jobs start at the top of the hour, the others each at their own minute
+        job.set_all("{0} * * * *".format(0 if i % 2 else i // 2 + 1))
+        storage.cluster_jobs.append(job)
+    scheduler = Scheduler(storage, 60, 'spread')
+    storage.cluster_jobs.extend(scheduler.re_balance())
+    assert {} == scheduler.peaks['before']
+    assert {'node{0}'.format(i): 10 for i in range(4)} == scheduler.peaks['after']
+    assert all(20 == len(storage.cluster_jobs.assigned_to('node{0}'.format(i))) for i in range(4))
+    assert [] == scheduler.re_balance()
+
+    storage.node_state('node1').time -= 120
+    storage.cluster_jobs.extend(scheduler.fail_over('node0'))
+    assert {'node0': 14, 'node2': 13, 'node3': 13} == scheduler.peak_concurrency()
+
+
+def test_firings_over_a_week():
+    job = CronItem(command="echo")
+    job.set_all("*/15 2 * * 1-2")
+    assert [120, 135, 150, 165] == sorted(job.firings())
+    assert 1440 + 120 == min(job.firings(7)) and 8 == len(job.firings(7))
+    job.every_reboot()
+    assert not job.firings()
+
+
+def test_load_placement_balances_busy_seconds():
+    storage = Storage()
+    storage.cluster_status = [Status('node0', 0, 4), Status('node1', 0, 4)]
+    for i in range(100):
+        job = CronItem(command="echo {0}".format(i))
+        job.set_all("{0} * * * *".format(i % 60))
+        # a forty minute run and many short scripts
+        job.cost.observe(2400 if i == 0 else 0.2, 2 ** 20)
+        storage.cluster_jobs.append(job)
+    scheduler = Scheduler(storage, 60, 'load')
+    storage.cluster_jobs.extend(scheduler.re_balance())
+    heavy = next(job for job in storage.cluster_jobs if job.command == 'echo 0')
+    assert [heavy] == storage.cluster_jobs.assigned_to(heavy.assigned_to)
+    assert [] == scheduler.re_balance()
+
+
+def test_runs_are_observed_between_checks():
+    job = CronItem(command="sleep 1")
+    observer = RunObserver()
+    assert not observer.check(job, None, now=0)
+    assert not observer.check(job, 42, 1000, now=5)
+    assert not observer.check(job, 42, 3000, now=10)
+    assert observer.check(job, None, now=20)
+    assert 1 == job.cost.runs and 15 == job.cost.duration and 3000 == job.cost.rss
+    # the next run started before we saw the previous one end
+    observer.check(job, 43, 1000, now=30)
+    assert observer.check(job, 44, 1000, now=35)
+    assert 2 == job.cost.runs and 13 == round(job.cost.duration, 6) and job.cost.p95 > 15
+    observer.forget(set())
+    assert not observer.check(job, None, now=40)
@@ -24,7 +24,10 @@
 # SOFTWARE.
 
 import asyncio
+import json
 import shutil
+import time
+from datetime import datetime, timedelta
 from os import path
 from os.path import exists
 from tempfile import mkdtemp
@@ -32,10 +35,12 @@ from tempfile import mkdtemp
 from dcron.cron import crontab
 from dcron.cron.cronitem import CronItem
 from dcron.cron.crontab import CronTab
+from dcron.database import SqlStorage
 from dcron.processor import Processor
-from dcron.protocols.messages import Status
+from dcron.protocols.messages import Digest, Status
 from dcron.protocols.udpserializer import UdpSerializer
-from dcron.storage import Storage
+from dcron.records import RecordSerializer
+from dcron.storage import CronDecoder, CronEncoder, Storage, StatusStore
 
 
 def test_store_status_message():
@@ -138,3 +143,391 @@ def test_save_load():
     storage = Storage(path_prefix=tmp_dir)
     assert 1 == len(storage.cluster_jobs)
     shutil.rmtree(tmp_dir)
+
+
+def test_job_store_is_keyed_by_identity():
+    storage = Storage()
+    jobs = []
+    for i in range(4):
+        job = CronItem(command="echo 'hello world {0}'".format(i % 3))
+        job.set_all("{0} * * * *".format(i // 3))
+        job.assigned_to = 'node{0}'.format(i % 2)
+        jobs.append(job)
+    storage.cluster_jobs.extend(jobs)
+    assert 4 == len(storage.cluster_jobs)
+
+    copy = CronItem(command="echo 'hello world 0'")
+    copy.set_all("0 * * * *")
+    copy.assigned_to = 'node1'
+    copy.enable(False)
+    assert copy in storage.cluster_jobs
+    assert jobs[0] is storage.cluster_jobs.get(copy)
+    storage.cluster_jobs.append(copy)
+    assert 4 == len(storage.cluster_jobs)
+    assert copy is storage.cluster_jobs.get(jobs[0])
+    assert [jobs[2]] == storage.cluster_jobs.assigned_to('node0')
+    assert [jobs[1], jobs[3], copy] == storage.cluster_jobs.assigned_to('node1')
+    assert [copy] == storage.cluster_jobs.enabled(False)
+
+    storage.cluster_jobs.remove(jobs[2])
+    assert ['node1'] == storage.cluster_jobs.nodes()
+    assert storage.cluster_jobs.tombstone(jobs[2]).remove
+    try:
+        storage.cluster_jobs.remove(jobs[2])
+        assert False
+    except ValueError:
+        pass
+
+    storage.cluster_jobs = [jobs[1], jobs[1]]
+    assert [jobs[1]] == list(storage.cluster_jobs)
+    assert [jobs[1]] == storage.cluster_jobs.enabled()
+
+
+def test_status_history_is_a_ring_buffer_per_node():
+    storage = Storage()
+    storage.cluster_status = StatusStore(capacity=3)
+    start = datetime(2019, 1, 1)
+    for i in range(5):
+        for ip in ('node1', 'node2'):
+            status = Status(ip, i)
+            status.time = (start + timedelta(seconds=i)).isoformat()
+            storage.cluster_status.append(status)
+    late = Status('node1', 9)
+    late.time = start.isoformat()
+    storage.cluster_status.append(late)
+
+    assert 6 == len(storage.cluster_status)
+    assert [3.0, 4.0, 9.0] == [load for _, load in storage.cluster_status.history('node1')]
+    assert 4 == storage.node_state('node1').system_load
+    assert ['node1', 'node2'] == sorted(node.ip for node in storage.cluster_state())
+    assert 6 == len(storage.cluster_status.copy())
+
+
+def test_load_history_is_rolled_up_in_minutes_and_hours():
+    store = StatusStore(capacity=10)
+    start = datetime(2019, 1, 1).timestamp()
+    for i in range(3 * 360):
+        status = Status('node1', i % 60)
+        status.time = datetime.fromtimestamp(start + i * 10).isoformat()
+        store.append(status)
+
+    recent = store.series('node1', start + 3 * 3600 - 60, start + 3 * 3600)
+    assert 0 == recent['resolution'] and 6 == len(recent['points'])
+    minutes = store.series('node1', start + 3600, start + 7200)
+    assert 60 == minutes['resolution'] and 61 == len(minutes['points'])
+    assert [start + 3600, 0, 2.5, 5] == minutes['points'][0]
+    hours = store.series('node1', start, start + 3 * 3600, max_points=100)
+    assert 3600 == hours['resolution']
+    assert [[start + i * 3600, 0, 29.5, 59] for i in range(3)] == hours['points']
+
+    restored = StatusStore()
+    restored.load_rollups(json.loads(json.dumps(store.dump_rollups())))
+    assert hours == restored.series('node1', start, start + 3 * 3600, max_points=100)
+    assert store.series('unknown') is None
+
+
+def test_status_times_are_parsed_once():
+    storage = Storage()
+    legacy = Status('node1', 0)
+    legacy.time = datetime(2019, 1, 1, 12).isoformat()
+    storage.cluster_status.append(legacy)
+    assert datetime(2019, 1, 1, 12).timestamp() == storage.node_state('node1').time
+
+    status = Status('node2', 0)
+    encoded = json.dumps([status], cls=CronEncoder)
+    assert [status] == json.loads(encoded, cls=CronDecoder)
+
+
+def test_journal_is_replayed_after_a_crash():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    tmp_dir = mkdtemp()
+    storage = Storage(path_prefix=tmp_dir)
+    jobs = [CronItem(command="echo {0}".format(i)) for i in range(10)]
+    for job in jobs:
+        job.set_all("2 1 * * *")
+    storage.cluster_jobs.extend(jobs)
+    storage.cluster_status.append(Status('node1', 1))
+    loop.run_until_complete(storage.save())
+    assert 0 == storage.journal.size
+
+    storage.cluster_jobs.remove(jobs[0])
+    jobs[1].assigned_to = 'node1'
+    storage.cluster_jobs.append(jobs[1])
+    storage.cluster_status.append(Status('node1', 2))
+    loop.run_until_complete(storage.commit())
+    # group committed, a single fsync for all mutations
+    assert {'pending': 0, 'records': 3, 'commits': 1} == {k: v for k, v in storage.journal.stats().items() if k != 'size'}
+    storage.cluster_status.append(Status('node1', 3))
+    storage.close()
+
+    # a torn record of a crash while appending
+    with open(path.join(tmp_dir, 'cluster_journal.log'), 'a') as handle:
+        handle.write('{"job": {"_type": "Cron')
+
+    restored = Storage(path_prefix=tmp_dir)
+    assert 9 == len(restored.cluster_jobs)
+    assert jobs[0] not in restored.cluster_jobs
+    assert 'node1' == restored.cluster_jobs.get(jobs[1]).assigned_to
+    assert 2 == restored.node_state('node1').system_load
+    assert 2 == len(restored.cluster_status)
+    restored.close()
+
+    loop.close()
+    shutil.rmtree(tmp_dir)
+
+
+def test_snapshot_replaces_files_atomically_and_truncates_journal():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    tmp_dir = mkdtemp()
+    storage = Storage(path_prefix=tmp_dir)
+    job = CronItem(command="echo 'hello world'")
+    job.set_all("2 1 * * *")
+    storage.cluster_jobs.append(job)
+    loop.run_until_complete(storage.commit())
+    assert storage.journal.size > 0
+    assert not storage.needs_snapshot()
+    storage.snapshot_threshold = 0
+    assert storage.needs_snapshot()
+
+    loop.run_until_complete(storage.save())
+    assert 0 == storage.journal.size
+    assert not exists(path.join(tmp_dir, 'cluster_jobs.json.tmp'))
+
+    # statuses in the snapshot and still in the journal are not added twice
+    storage.cluster_status.append(Status('node1', 1))
+    loop.run_until_complete(storage.commit())
+    storage.cluster_jobs.remove(job)
+    loop.run_until_complete(storage.save())
+    storage.journal.record('status', storage.node_state('node1'))
+    loop.run_until_complete(storage.journal.commit())
+    storage.close()
+
+    restored = Storage(path_prefix=tmp_dir)
+    assert 0 == len(restored.cluster_jobs)
+    assert 1 == len(restored.cluster_status)
+    restored.close()
+
+    loop.close()
+    shutil.rmtree(tmp_dir)
+
+
+def test_tombstones_survive_a_restart():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    tmp_dir = mkdtemp()
+    storage = Storage(path_prefix=tmp_dir)
+    removed, unknown = CronItem(command="echo 'removed'"), CronItem(command="echo 'unknown'")
+    for job in (removed, unknown):
+        job.update_version()
+    storage.cluster_jobs.append(removed)
+    storage.cluster_jobs.remove(removed)
+    # removed before we ever had it
+    storage.cluster_jobs.bury(unknown)
+    loop.run_until_complete(storage.commit())
+    storage.close()
+
+    # from the journal
+    restored = Storage(path_prefix=tmp_dir)
+    assert {removed.identity, unknown.identity} == {job.identity for job in restored.cluster_jobs.tombstones()}
+    assert restored.cluster_jobs.digest().buckets == storage.cluster_jobs.digest().buckets
+    old = CronItem(command="echo 'old'")
+    restored.cluster_jobs.bury(old, time.time() - 1000)
+    loop.run_until_complete(restored.save())
+    restored.close()
+
+    # from the snapshot, with the time of their removal
+    restored = Storage(path_prefix=tmp_dir)
+    assert 0 == len(restored.cluster_jobs)
+    assert restored.cluster_jobs.tombstone(unknown).version == unknown.version
+    restored.cluster_jobs.expire(time.time() - 500)
+    assert restored.cluster_jobs.tombstone(old) is None
+    assert restored.cluster_jobs.digest().buckets == storage.cluster_jobs.digest().buckets
+    restored.close()
+
+    loop.close()
+    shutil.rmtree(tmp_dir)
+
+
+def test_jobs_are_saved_as_flat_records_with_shared_tables():
+    cron = CronTab(tab="""* * * * * command""")
+    jobs = []
+    for i in range(4):
+        job = CronItem(command="echo {0}".format(i), user='root', cron=cron)
+        job.set_all("*/15 {0} * * mon-fri".format(i % 2))
+        job.last_run = datetime(2019, 1, 1, 12, 30)
+        job.append_log("test log message")
+        jobs.append(job)
+    jobs[1].cost.observe(0.25, 2 ** 20)
+
+    data = json.loads(json.dumps(RecordSerializer().dump_jobs(jobs)))
+    assert 1 == len(data['crontabs']) and 2 == len(data['schedules'])
+
+    identities = []
+    loaded = RecordSerializer.load_jobs(data, identities=identities)
+    assert jobs == loaded
+    assert [job.identity for job in jobs] == identities
+    assert loaded[0].cron is loaded[3].cron
+    assert loaded[0].parts is not loaded[2].parts
+    assert [str(job) for job in jobs] == [str(job) for job in loaded]
+    assert jobs[0].last_run == loaded[0].last_run and jobs[0].log == loaded[0].log
+    assert [job.cost for job in jobs] == [job.cost for job in loaded]
+
+
+def test_legacy_caches_are_loaded():
+    tmp_dir = mkdtemp()
+    job = CronItem(command="echo 'hello world'")
+    job.set_all("2 1 * * *")
+    with open(path.join(tmp_dir, 'cluster_jobs.json'), 'w') as handle:
+        handle.write(json.dumps([job], cls=CronEncoder))
+    with open(path.join(tmp_dir, 'cluster_status.json'), 'w') as handle:
+        handle.write(json.dumps([Status('node1', 1)], cls=CronEncoder))
+
+    storage = Storage(path_prefix=tmp_dir)
+    assert [job] == storage.cluster_jobs.copy()
+    assert 1 == storage.node_state('node1').system_load
+    storage.close()
+    shutil.rmtree(tmp_dir)
+
+
+def test_sqlite_storage_keeps_the_job_store_interface():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    tmp_dir = mkdtemp()
+    storage = SqlStorage(path_prefix=tmp_dir)
+    cron = CronTab(tab="""* * * * * command""")
+    jobs = []
+    for i in range(6):
+        job = CronItem(command="echo {0}".format(i % 3), cron=cron)
+        job.set_all("{0} * * * *".format(i))
+        job.assigned_to = 'node{0}'.format(i % 2) if i else None
+        jobs.append(job)
+    storage.cluster_jobs.extend(jobs)
+    assert 6 == len(storage.cluster_jobs)
+
+    jobs[1].enable(False)
+    jobs[1].append_log("first run")
+    jobs[1].cost.observe(0.5, 2 ** 20)
+    storage.cluster_jobs.append(jobs[1])
+    assert 6 == len(storage.cluster_jobs)
+    assert not storage.cluster_jobs.get(jobs[1]).enabled
+    assert jobs[1].cost == storage.cluster_jobs.get(jobs[1]).cost
+    assert [jobs[1]] == storage.cluster_jobs.enabled(False)
+    assert {None, 'node0', 'node1'} == set(storage.cluster_jobs.nodes())
+    assert {jobs[1].identity, jobs[3].identity, jobs[5].identity} == {j.identity for j in storage.cluster_jobs.assigned_to('node1')}
+    assert [jobs[0]] == storage.cluster_jobs.assigned_to(None)
+    assert sorted(jobs, key=lambda j: (j.command, j.assigned_to or '*')) == storage.cluster_jobs.ordered()
+
+    storage.cluster_jobs.remove(jobs[2])
+    assert jobs[2] not in storage.cluster_jobs
+    assert [jobs[2].identity] == [tombstone.identity for tombstone in storage.cluster_jobs.tombstones()]
+    try:
+        storage.cluster_jobs.remove(jobs[2])
+        assert False
+    except ValueError:
+        pass
+
+    jobs[1].append_log("second run")
+    storage.cluster_jobs.append(jobs[1])
+    loop.run_until_complete(storage.commit())
+    storage.close()
+
+    storage = SqlStorage(path_prefix=tmp_dir)
+    assert 5 == len(storage.cluster_jobs)
+    restored = storage.cluster_jobs.get(jobs[1])
+    assert ["first run", "second run"] == restored._log
+    assert str(jobs[1]) == str(restored)
+    assert 2 == storage.connection.execute("SELECT count(*) FROM executions").fetchone()[0]
+    storage.close()
+
+    loop.close()
+    shutil.rmtree(tmp_dir)
+
+
+def test_sqlite_storage_keeps_status_history():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    storage = SqlStorage()
+    processor = Processor(12345, storage, cron=CronTab(tab="""* * * * * command"""))
+    message = Status('127.0.0.1', 10)
+    for packet in UdpSerializer.dump(message):
+        processor.queue.put_nowait(packet)
+    loop.run_until_complete(processor.process())
+    assert message == storage.node_state('127.0.0.1')
+
+    start = datetime(2019, 1, 1).timestamp()
+    for i in range(3 * 360):
+        status = Status('node1', i % 60)
+        status.time = start + i * 10
+        storage.cluster_status.append(status)
+    assert {'127.0.0.1', 'node1'} == {s.ip for s in storage.cluster_state()}
+    assert start + 1079 * 10 == storage.node_state('node1').time
+
+    recent = storage.cluster_status.series('node1', start + 3 * 3600 - 60, start + 3 * 3600)
+    assert 0 == recent['resolution'] and 6 == len(recent['points'])
+    minutes = storage.cluster_status.series('node1', start + 3600, start + 7200, max_points=100)
+    assert 60 == minutes['resolution'] and [start + 3600, 0, 2.5, 5] == minutes['points'][0]
+    hours = storage.cluster_status.series('node1', start, start + 3 * 3600 - 1, max_points=100)
+    assert [[start + i * 3600, 0, 29.5, 59] for i in range(3)] == hours['points']
+
+    storage.cluster_status.expire(start + 3600)
+    assert 720 + 1 == len(storage.cluster_status)
+    storage.close()
+
+    loop.close()
+
+
+def test_job_store_keeps_its_digest_up_to_date():
+    storage = Storage()
+    jobs = [CronItem(command="echo {0}".format(i)) for i in range(20)]
+    storage.cluster_jobs.extend(jobs)
+    jobs[3].assigned_to = 'node1'
+    jobs[3].update_version()
+    storage.cluster_jobs.append(jobs[3])
+    storage.cluster_jobs.remove(jobs[5])
+    removed = CronItem(command="echo removed")
+    removed.version = 7
+    storage.cluster_jobs.bury(removed)
+
+    expected = Digest.of(None, storage.cluster_jobs.copy() + storage.cluster_jobs.tombstones())
+    assert expected.buckets == storage.cluster_jobs.digest().buckets
+    assert expected.buckets != Digest.of(None, storage.cluster_jobs).buckets
+    assert Digest.of(None, jobs, 16).buckets != storage.cluster_jobs.digest(size=16).buckets
+
+    storage.cluster_jobs.expire(time.time() + 1)
+    storage.cluster_jobs.clear()
+    assert [0] * Digest.size == storage.cluster_jobs.digest().buckets
+
+
+def test_sqlite_storage_keeps_its_digest_without_decoding_jobs():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    tmp_dir = mkdtemp()
+    storage = SqlStorage(path_prefix=tmp_dir)
+    jobs = [CronItem(command="echo {0}".format(i)) for i in range(20)]
+    storage.cluster_jobs.extend(jobs)
+    storage.cluster_jobs.remove(jobs[5])
+    expected = Digest.of(None, storage.cluster_jobs.copy() + storage.cluster_jobs.tombstones())
+    assert expected.buckets == storage.cluster_jobs.digest().buckets
+
+    bucket = Digest.bucket(jobs[5])
+    differing = storage.cluster_jobs.hashed_into({bucket})
+    assert jobs[5].identity in {job.identity for job in differing}
+    assert all(Digest.bucket(job) == bucket for job in differing)
+    assert [job for job in differing if job.remove] == storage.cluster_jobs.tombstones()
+
+    loop.run_until_complete(storage.save())
+    storage.close()
+    reopened = SqlStorage(path_prefix=tmp_dir)
+    assert Digest.of(None, reopened.cluster_jobs).buckets == reopened.cluster_jobs.digest().buckets
+    reopened.close()
+
+    shutil.rmtree(tmp_dir)
+    loop.close()